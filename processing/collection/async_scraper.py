@@ -0,0 +1,317 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import asyncio
+import aiohttp
+from processing.logger import logger
+from tokped_scraper import (
+    ARRAY_REQUEST_URI,
+    PDP_REQUEST_URI,
+    REQUEST_TIMEOUT,
+    get_headers,
+    split_product_uri,
+    parse_product_keys,
+    align_details,
+    build_sid_payload,
+    build_listing_payload,
+    build_details_payload,
+    build_listing_batch,
+    build_details_batch,
+    parse_sid,
+    has_next_page,
+    estimate_page_count,
+    listing_window,
+    merge_listing_pages,
+    merge_listing_batches,
+    split_batch_response,
+    missing_items,
+    fill_missing,
+    LISTING_CONCURRENCY,
+    get_endpoint,
+    finish_download,
+    IMAGE_CHUNK_BYTES,
+)
+from rate_limit import (
+    BUCKETS,
+    RETRY_ATTEMPTS,
+    RETRY_STATUSES,
+    backoff_delay,
+    get_concurrency_limit,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection pool limits shared by every coroutine using the session
+ASYNC_CONNECTION_LIMIT = int(os.getenv("ASYNC_CONNECTION_LIMIT", 1000))
+ASYNC_LIMIT_PER_HOST = int(os.getenv("ASYNC_LIMIT_PER_HOST", 100))
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def create_session():
+    """Creates an aiohttp session backed by one pooled, keep-alive connector.
+
+    Must be called from inside a running event loop.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=ASYNC_CONNECTION_LIMIT,
+        limit_per_host=ASYNC_LIMIT_PER_HOST,
+        ttl_dns_cache=300,
+    )
+    # No total timeout: it would include the wait for a pooled connection, so
+    # requests queued behind ASYNC_LIMIT_PER_HOST would time out unsent
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def gather_bounded(func, items, limit):
+    """Runs `func(item)` for every item with at most `limit` coroutines in flight."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+async def send(session, method, uri, read, **kwargs):
+    """Sends a rate limited request, retrying throttled or failed attempts.
+
+    `read` is awaited with the response to produce the result. Every request
+    takes a token from the endpoint's bucket and a slot from its adaptive
+    concurrency limit, which shrinks whenever the endpoint pushes back.
+    """
+    endpoint = get_endpoint(uri)
+    concurrency = get_concurrency_limit(endpoint)
+
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        await BUCKETS[endpoint].acquire_async()
+        started = await concurrency.acquire()
+        throttled = False
+        retry_after = None
+        try:
+            async with session.request(method, uri, **kwargs) as response:
+                if response.status in RETRY_STATUSES:
+                    retry_after = response.headers.get("Retry-After")
+                response.raise_for_status()
+                return await read(response)
+        except (aiohttp.ClientResponseError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            retryable = not isinstance(e, aiohttp.ClientResponseError) or (
+                e.status in RETRY_STATUSES
+            )
+            if not retryable:
+                raise
+            throttled = True
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.warning(
+                f"Retrying {uri} in {delay:.1f}s after attempt {attempt + 1}: {str(e)}"
+            )
+        finally:
+            await concurrency.release(started, throttled)
+        await asyncio.sleep(delay)
+
+
+async def read_json(response):
+    return await response.json(content_type=None)
+
+
+async def read_bytes(response):
+    return await response.read()
+
+
+async def post_json(session, uri, headers, data):
+    return await send(session, "POST", uri, read_json, headers=headers, json=data)
+
+
+async def get_brand_sid(session, brand_uri):
+    """Converts Brand Official Store Name to SID"""
+    try:
+        response_json = await post_json(
+            session, ARRAY_REQUEST_URI, get_headers(brand_uri), build_sid_payload(brand_uri)
+        )
+        sid = parse_sid(response_json)
+        logger.info(f"Successfully retrieved SID for {brand_uri}: {sid}")
+        return sid
+    except (*REQUEST_ERRORS, KeyError, IndexError) as e:
+        logger.error(f"Failed to retrieve SID for {brand_uri}: {str(e)}")
+        return None
+
+
+async def get_listing_page(session, brand_uri, sid, page, headers):
+    """Fetches a single ShopProducts page, None on failure."""
+    try:
+        page_json = await post_json(
+            session, ARRAY_REQUEST_URI, headers, build_listing_payload(sid, page)
+        )
+        has_next_page(page_json)  # Validate the page structure
+        return page_json
+    except (*REQUEST_ERRORS, KeyError, IndexError, TypeError) as e:
+        logger.error(
+            f"Error retrieving product listings for {brand_uri} on page {page}: {str(e)}"
+        )
+        return None
+
+
+async def get_listing_pages(session, brand_uri, sid, pages, headers):
+    """Fetches several ShopProducts pages in one batched request.
+
+    Pages the batch could not return are retried one by one.
+    """
+    if len(pages) == 1:
+        return [await get_listing_page(session, brand_uri, sid, pages[0], headers)]
+
+    data = build_listing_batch(sid, pages)
+    try:
+        response_json = await post_json(session, ARRAY_REQUEST_URI, headers, data)
+        results = split_batch_response(response_json, len(pages))
+    except (*REQUEST_ERRORS, ValueError) as e:
+        logger.warning(
+            f"Batched listing request for {brand_uri} pages {pages} failed, retrying singly: {str(e)}"
+        )
+        results = [None] * len(pages)
+
+    # Fallbacks run together, bounded by the endpoint's limiter in send()
+    retried = await asyncio.gather(
+        *(
+            get_listing_page(session, brand_uri, sid, page, headers)
+            for page in missing_items(pages, results)
+        )
+    )
+    return fill_missing(results, retried)
+
+
+async def get_brand_listing(session, brand_uri, concurrency=LISTING_CONCURRENCY):
+    """Returns all products from a brand page
+
+    The first page is used to estimate the page count, the remaining pages
+    are then requested `concurrency` at a time.
+    """
+    sid = await get_brand_sid(session, brand_uri)
+    if not sid:
+        return []
+
+    headers = get_headers(brand_uri)
+    listings = []
+
+    first_page = await get_listing_page(session, brand_uri, sid, 1, headers)
+    if first_page is not None:
+        page_count = estimate_page_count(first_page)
+        more_pages = merge_listing_pages(listings, [first_page])
+        next_page = 2
+        while more_pages:
+            batches, next_page = listing_window(
+                next_page, page_count, max(concurrency, 1)
+            )
+            batches = await gather_bounded(
+                lambda pages: get_listing_pages(session, brand_uri, sid, pages, headers),
+                batches,
+                max(concurrency, 1),
+            )
+            more_pages = merge_listing_batches(listings, batches)
+
+    logger.info(f"Retrieved {len(listings)} pages of products for {brand_uri}")
+    return listings
+
+
+async def get_item_details(session, product_url):
+    try:
+        brand_uri, product_uri = split_product_uri(product_url)
+        return await post_json(
+            session,
+            PDP_REQUEST_URI,
+            get_headers(brand_uri, product_uri),
+            build_details_payload(brand_uri, product_uri),
+        )
+    except (*REQUEST_ERRORS, ValueError) as e:
+        logger.error(f"Error retrieving product details for {product_url}: {str(e)}")
+        return None
+
+
+async def get_item_details_batch(session, product_urls):
+    """Fetches details for several products in one PDPGetLayoutQuery request.
+
+    Returns details aligned with `product_urls`. Products the batch could not
+    return are retried with single requests.
+    """
+    valid = parse_product_keys(product_urls)
+    if not valid:
+        return [None] * len(product_urls)
+    if len(valid) == 1:
+        results = [await get_item_details(session, product_urls[valid[0][0]])]
+        return align_details(len(product_urls), valid, results)
+
+    data = build_details_batch(key for _, key in valid)
+    try:
+        response_json = await post_json(
+            session, PDP_REQUEST_URI, get_headers(*valid[0][1]), data
+        )
+        results = split_batch_response(response_json, len(valid))
+    except (*REQUEST_ERRORS, ValueError) as e:
+        logger.warning(
+            f"Batched details request for {len(valid)} products failed, retrying singly: {str(e)}"
+        )
+        results = [None] * len(valid)
+
+    # Fallbacks run together, bounded by the endpoint's limiter in send()
+    retried = await asyncio.gather(
+        *(
+            get_item_details(session, product_urls[i])
+            for i, _ in missing_items(valid, results)
+        )
+    )
+    return align_details(len(product_urls), valid, fill_missing(results, retried))
+
+
+async def get_image(session, image_url, brand_uri=""):
+    try:
+        return await send(
+            session, "GET", image_url, read_bytes, headers=get_headers(brand_uri)
+        )
+    except (*REQUEST_ERRORS, ValueError) as e:
+        logger.error(f"Error retrieving image from {image_url}: {str(e)}")
+        return None
+
+
+async def download_image(session, image_url, file_path, brand_uri="", min_bytes=0):
+    """Streams an image to `file_path` in chunks and returns the bytes written.
+
+    Returns 0 without keeping the file when the image is smaller than
+    `min_bytes`, checked against Content-Length before the body is read
+    where the server sends it, and None on failure.
+    """
+    part_path = f"{file_path}.part"
+
+    async def stream_to_disk(response):
+        if response.content_length and response.content_length < min_bytes:
+            return 0
+        written = 0
+        # File I/O runs on worker threads so a slow disk never stalls the loop
+        f = await asyncio.to_thread(open, part_path, "wb")
+        try:
+            async for chunk in response.content.iter_chunked(IMAGE_CHUNK_BYTES):
+                await asyncio.to_thread(f.write, chunk)
+                written += len(chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        return await asyncio.to_thread(
+            finish_download, part_path, file_path, written, min_bytes
+        )
+
+    try:
+        return await send(
+            session, "GET", image_url, stream_to_disk, headers=get_headers(brand_uri)
+        )
+    except (*REQUEST_ERRORS, ValueError, OSError) as e:
+        logger.error(f"Error retrieving image from {image_url}: {str(e)}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
@@ -3,6 +3,8 @@ import sys
 from datetime import datetime, timedelta
 import glob
 import json
+import asyncio
+import shutil
 from jsonpath_ng.ext import parse
 from concurrent.futures import ThreadPoolExecutor
 from typing import List
@@ -21,8 +23,32 @@ from processing.utils.utils import (
     sanitize_product_name,
     create_dir_if_not_exists,
 )
+from processing.utils.blob_store import IMAGE_STORE, get_blob_store
+from processing.extraction.fields import extract_product_info
 from dotenv import load_dotenv
-from tokped_scraper import get_brand_listing, get_item_details, get_image
+from tokped_scraper import (
+    get_brand_listing,
+    get_item_details_batch,
+    download_image,
+    chunk,
+    has_next_page,
+)
+from rate_limit import RETRY_QUEUE
+from image_pipeline import (
+    IMAGE_WORKERS,
+    ThroughputMeter,
+    iter_image_jobs,
+    run_threaded,
+    run_async,
+)
+import async_scraper
+from manifest import (
+    load_manifest,
+    save_manifest,
+    diff_products,
+    record_fetched,
+    record_delisted,
+)
 
 load_dotenv()
 
@@ -34,14 +60,14 @@ DETAILS_DIR = os.path.join(ROOT_DIR, "details")
 LISTING_DIR = os.path.join(ROOT_DIR, "listing")
 SCRAPE_OVERWRITE = os.getenv("SCRAPE_OVERWRITE") == "True"
 DETAILS_FILENAME = os.getenv("DETAILS_FILENAME")
+SCRAPE_ASYNC = os.getenv("SCRAPE_ASYNC") == "True"
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", 500))
+LISTING_BRAND_CONCURRENCY = int(os.getenv("LISTING_BRAND_CONCURRENCY", 1))
+SCRAPE_DETAILS_BATCH_SIZE = int(os.getenv("SCRAPE_DETAILS_BATCH_SIZE", 1))
+SCRAPE_INCREMENTAL = os.getenv("SCRAPE_INCREMENTAL") == "True"
 
-BASIC_PARSER = parse("$..basicInfo")
-PARENT_ID_PARSER = parse("$..parentID")
-DESC_PARSER = parse("$..content[?(@.title=='Deskripsi')].subtitle")
-CHILD_PARSER = parse("$..pdpGetLayout..children[*]")
-PRICE_PARSER = parse("$..price.value")
+IMAGE_PARSER = parse("$..urlMaxRes")
 EXTRACT_FILENAME = os.getenv("EXTRACT_FILENAME")
-CATEGORY_BREADCRUMB_URI = "https://www.tokopedia.com/p/"
 
 
 def read_brands(source_file: str) -> List[str]:
@@ -52,23 +78,73 @@ def read_brands(source_file: str) -> List[str]:
 
 def scrape_listing(source_file: str = SOURCE_FILE):
     """Scrapes all listings from brands."""
+    if SCRAPE_ASYNC:
+        return asyncio.run(scrape_listing_async(source_file))
+
     brands = read_brands(source_file)
 
-    for brand in brands:
-        try:
-            logger.info(f"Fetching brand list for {brand}")
-            brand_listing = get_brand_listing(brand_uri=brand)
+    with ThreadPoolExecutor(max_workers=LISTING_BRAND_CONCURRENCY) as executor:
+        executor.map(scrape_brand_listing, brands)
 
-            file_path = os.path.join(LISTING_DIR, brand, f"listing_{WRITE_DATE}.json")
-            save_json(brand_listing, file_path)
-        except Exception as e:
-            logger.error(f"Error scraping brand {brand}: {str(e)}")
 
+def scrape_brand_listing(brand: str):
+    try:
+        logger.info(f"Fetching brand list for {brand}")
+        brand_listing = get_brand_listing(brand_uri=brand)
+        save_listing(brand, brand_listing)
+        if listing_incomplete(brand_listing):
+            RETRY_QUEUE.push("listing", {"brand": brand})
+    except Exception as e:
+        logger.error(f"Error scraping brand {brand}: {str(e)}")
 
-def scrape_products():
-    """Scrapes details for all products in the unified file."""
+
+async def scrape_listing_async(source_file: str = SOURCE_FILE):
+    """Scrapes all brand listings concurrently over one pooled session."""
+    brands = read_brands(source_file)
+
+    async with async_scraper.create_session() as session:
+
+        async def scrape_brand(brand):
+            try:
+                logger.info(f"Fetching brand list for {brand}")
+                brand_listing = await async_scraper.get_brand_listing(session, brand)
+                save_listing(brand, brand_listing)
+                if listing_incomplete(brand_listing):
+                    RETRY_QUEUE.push("listing", {"brand": brand})
+            except Exception as e:
+                logger.error(f"Error scraping brand {brand}: {str(e)}")
+
+        await async_scraper.gather_bounded(
+            scrape_brand, brands, LISTING_BRAND_CONCURRENCY
+        )
+
+
+def listing_incomplete(brand_listing: list) -> bool:
+    """True when the listing stopped before its last page."""
+    return not brand_listing or has_next_page(brand_listing[-1])
+
+
+def save_listing(brand: str, brand_listing: list):
+    file_path = os.path.join(LISTING_DIR, brand, f"listing_{WRITE_DATE}.json")
+    save_json(brand_listing, file_path)
+
+
+def load_listing_products(
+    latest_only: bool = False, incomplete: set = None
+) -> List[dict]:
+    """Reads saved listings and returns their products tagged with their brand.
+
+    With `latest_only` only the most recent listing of each brand is read.
+    Brands whose listing stopped before its last page are added to
+    `incomplete` when given.
+    """
     scraped_products = []
     json_files = glob.glob(os.path.join(LISTING_DIR, "**", "listing_*.json"))
+    if latest_only:
+        latest_files = {}
+        for json_file in sorted(json_files):
+            latest_files[os.path.dirname(json_file)] = json_file
+        json_files = list(latest_files.values())
     parser = parse("$..GetShopProduct.data")
 
     for json_file in json_files:
@@ -76,6 +152,8 @@ def scrape_products():
             with open(json_file, "r") as jf:
                 data = json.load(jf)
             brand = os.path.basename(os.path.dirname(json_file))
+            if incomplete is not None and listing_incomplete(data):
+                incomplete.add(brand)
 
             # Insert brand into the JSON object
             brand_parser = parse("$..GetShopProduct.data[*].brand")
@@ -87,68 +165,224 @@ def scrape_products():
         except Exception as e:
             logger.error(f"Error processing file {json_file}: {str(e)}")
 
-    products = [
-        product for product_list in scraped_products for product in product_list
+    return [product for product_list in scraped_products for product in product_list]
+
+
+def scrape_products():
+    """Scrapes details for all products in the unified file.
+
+    With SCRAPE_INCREMENTAL only new or changed listings are refetched, as
+    tracked by the crawl manifest.
+    """
+    incomplete = set()
+    products = load_listing_products(
+        latest_only=SCRAPE_INCREMENTAL, incomplete=incomplete
+    )
+
+    manifest = None
+    if SCRAPE_INCREMENTAL:
+        manifest = load_manifest()
+        # A truncated listing says nothing about the products it missed
+        products, delisted = diff_products(manifest, products, incomplete)
+        record_delisted(manifest, delisted)
+        for product in products:
+            product["refresh"] = True
+
+    if SCRAPE_ASYNC:
+        asyncio.run(scrape_products_async(products, manifest))
+    else:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            executor.map(
+                partial(scrape_product_details_batch, manifest=manifest),
+                batch_products(products),
+            )
+
+    if manifest is not None:
+        save_manifest(manifest)
+
+
+async def scrape_products_async(products: List[dict], manifest: dict = None):
+    """Scrapes product details with up to SCRAPE_CONCURRENCY products in flight."""
+    async with async_scraper.create_session() as session:
+
+        async def scrape_batch(batch):
+            to_fetch = [product for product in batch if needs_details(product)]
+            try:
+                details = await async_scraper.get_item_details_batch(
+                    session, [product["product_url"] for product in to_fetch]
+                )
+            except Exception as e:
+                logger.error(f"Error scraping batch of {len(to_fetch)} products: {str(e)}")
+                details = [None] * len(to_fetch)
+            save_product_batch(batch, to_fetch, details, manifest)
+
+        await async_scraper.gather_bounded(
+            scrape_batch,
+            batch_products(products),
+            max(SCRAPE_CONCURRENCY // SCRAPE_DETAILS_BATCH_SIZE, 1),
+        )
+
+
+def batch_products(products: List[dict]) -> List[List[dict]]:
+    """Groups products by brand into batches of SCRAPE_DETAILS_BATCH_SIZE."""
+    by_brand = {}
+    for product in products:
+        by_brand.setdefault(product["brand"], []).append(product)
+    return [
+        batch
+        for brand_products in by_brand.values()
+        for batch in chunk(brand_products, SCRAPE_DETAILS_BATCH_SIZE)
     ]
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        executor.map(scrape_product_details, products)
+
+def get_product_dir(product: dict) -> str:
+    sanitized_product_name = sanitize_product_name(product["name"])
+    return os.path.join(DETAILS_DIR, product["brand"], sanitized_product_name)
+
+
+def get_details_path(product: dict) -> str:
+    return os.path.join(get_product_dir(product), DETAILS_FILENAME)
+
+
+def needs_details(product: dict) -> bool:
+    return (
+        product.get("refresh", False)
+        or SCRAPE_OVERWRITE
+        or not os.path.isfile(get_details_path(product))
+    )
 
 
 def scrape_product_details(product: dict):
     """Scrapes product details for a single product."""
+    scrape_product_details_batch([product])
+
+
+def scrape_product_details_batch(products: List[dict], manifest: dict = None):
+    """Scrapes product details for a batch of products with one request."""
+    to_fetch = [product for product in products if needs_details(product)]
     try:
-        product_name = product["name"]
-        product_brand = product["brand"]
-        product_url = product["product_url"]
-
-        sanitized_product_name = sanitize_product_name(product_name)
-
-        # Save product detail
-        product_dir = os.path.join(DETAILS_DIR, product_brand, sanitized_product_name)
-        details_path = os.path.join(product_dir, DETAILS_FILENAME)
-        details_exists = os.path.isfile(details_path)
-        if not details_exists or SCRAPE_OVERWRITE:
-            product_details = get_item_details(product_url)
-            save_json(product_details, details_path)
-        else:
-            logger.info(f"File exists, skipping details save: {product_dir}")
-
-        # Extract and simplify details to product_info
-        extract_path = os.path.join(product_dir, EXTRACT_FILENAME)
-        extract_exists = os.path.isfile(extract_path)
-        if not extract_exists or SCRAPE_OVERWRITE:
-            logger.info(f"Extracting file: {sanitized_product_name}")
-            product_info = extract_details(product_details)
-            save_json(product_info, extract_path)
-        else:
-            logger.info(f"File exists, skipping extraction: {product_dir}")
+        details = get_item_details_batch(
+            [product["product_url"] for product in to_fetch]
+        )
     except Exception as e:
-        logger.error(f"Error scraping product {product['name']}: {str(e)}")
+        logger.error(f"Error scraping batch of {len(to_fetch)} products: {str(e)}")
+        details = [None] * len(to_fetch)
+    save_product_batch(products, to_fetch, details, manifest)
+
+
+def save_product_batch(
+    products: List[dict],
+    fetched_products: List[dict],
+    details,
+    manifest: dict = None,
+):
+    """Saves a batch of products, recording fetched ones in the crawl manifest.
+
+    Products whose fetch failed are queued for retry instead.
+    """
+    fetched = {
+        product["product_url"]: product_details
+        for product, product_details in zip(fetched_products, details)
+    }
+    for product in products:
+        try:
+            product_details = fetched.get(product["product_url"])
+            if product["product_url"] in fetched and product_details is None:
+                RETRY_QUEUE.push("details", {"product": product})
+                continue
+            save_product_details(product, product_details)
+            if manifest is not None and product_details is not None:
+                record_fetched(manifest, product, product_details)
+        except Exception as e:
+            logger.error(f"Error scraping product {product['name']}: {str(e)}")
 
 
-def scrape_images():
-    """Scrapes images from product details."""
-    logger.info("Globbing Image URIs to Collect.")
-    json_files = glob.glob(os.path.join(DETAILS_DIR, "**", "**", DETAILS_FILENAME))
-    parser = parse("$..urlMaxRes")
+def save_product_details(product: dict, product_details):
+    """Saves fetched details and the extracted product_info next to them.
 
-    for json_file in json_files:
-        try:
-            with open(json_file, "r") as jf:
-                data = json.load(jf)
-            links = [link.value for link in parser.find(data)]
+    `product_details` is None when the details were not refetched, in which
+    case the file already on disk is used for extraction.
+    """
+    product_dir = get_product_dir(product)
+    details_path = os.path.join(product_dir, DETAILS_FILENAME)
 
-            dir_parts = json_file.split("/")
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                executor.map(partial(fetch_image, dir_parts=dir_parts), links)
+    # Save product detail
+    if product_details is not None:
+        save_json(product_details, details_path)
+    else:
+        logger.info(f"File exists, skipping details save: {product_dir}")
+
+    # Extract and simplify details to product_info
+    extract_path = os.path.join(product_dir, EXTRACT_FILENAME)
+    extract_exists = os.path.isfile(extract_path)
+    if product_details is not None or not extract_exists or SCRAPE_OVERWRITE:
+        logger.info(f"Extracting file: {os.path.basename(product_dir)}")
+        if product_details is None:
+            with open(details_path, "r") as jf:
+                product_details = json.load(jf)
+        product_info = extract_details(product_details)
+        save_json(product_info, extract_path)
+    else:
+        logger.info(f"File exists, skipping extraction: {product_dir}")
 
-        except Exception as e:
-            logger.error(f"Error processing images for {json_file}: {str(e)}")
 
+def get_image_links(json_file: str) -> List[str]:
+    with open(json_file, "r") as jf:
+        data = json.load(jf)
+    return [link.value for link in IMAGE_PARSER.find(data)]
 
-def fetch_image(link, dir_parts):
-    """Fetch and write image file"""
+
+def scrape_images():
+    """Scrapes images from product details through one bounded download pipeline."""
+    logger.info("Globbing Image URIs to Collect.")
+    json_files = glob.glob(os.path.join(DETAILS_DIR, "**", "**", DETAILS_FILENAME))
+
+    duplicates = []
+    jobs = iter_image_jobs(json_files, get_image_links, duplicates)
+    meter = ThroughputMeter()
+
+    if SCRAPE_ASYNC:
+        asyncio.run(scrape_images_async(jobs, meter))
+    else:
+        failures = run_threaded(jobs, partial(fetch_image, meter=meter))
+        if failures:
+            logger.error(f"{failures} image jobs failed with an error")
+
+    copy_duplicate_images(duplicates)
+    if IMAGE_STORE:
+        get_blob_store().save()
+    meter.log("Finished image pipeline")
+
+
+async def scrape_images_async(jobs, meter: ThroughputMeter = None):
+    """Downloads images for all products over one pooled session."""
+    async with async_scraper.create_session() as session:
+
+        async def fetch(link, dir_parts):
+            file_path = get_image_path(link, dir_parts)
+            if os.path.isfile(file_path) and not SCRAPE_OVERWRITE:
+                logger.info(f"Image Exists: {link}, skipping download")
+                record_image(meter, "exists")
+                return
+            create_dir_if_not_exists(os.path.dirname(file_path))
+            written = await async_scraper.download_image(
+                session,
+                link,
+                file_path,
+                brand_uri=dir_parts[-3],
+                min_bytes=IMAGE_MIN_BYTES,
+            )
+            # Blob store hashing and bookkeeping stay off the event loop
+            await asyncio.to_thread(
+                handle_download, link, dir_parts, file_path, written, meter
+            )
+
+        failures = await run_async(jobs, fetch, IMAGE_WORKERS)
+        if failures:
+            logger.error(f"{failures} image jobs failed with an error")
+
+
+def get_image_path(link, dir_parts):
     image_name = link.split("/")[-1]
     product_brand = dir_parts[-3]  # Adjusted to use the correct index for brand
     product_name = dir_parts[-2]  # Adjusted to use the correct index for product name
@@ -156,87 +390,153 @@ def fetch_image(link, dir_parts):
     if image_name[-4:] not in (".png", ".jpg"):
         image_name += ".jpg"
 
-    file_dir = os.path.join(DETAILS_DIR, product_brand, product_name, "images")
-    file_path = os.path.join(file_dir, image_name)
+    return os.path.join(DETAILS_DIR, product_brand, product_name, "images", image_name)
+
+
+def fetch_image(link, dir_parts, meter: ThroughputMeter = None):
+    """Fetch and write image file"""
+    file_path = get_image_path(link, dir_parts)
     file_exists = os.path.isfile(file_path)
     if not file_exists or SCRAPE_OVERWRITE:
-        image_file = get_image(link, brand_uri=product_brand)
-        if len(image_file) >= IMAGE_MIN_BYTES:
-            create_dir_if_not_exists(file_dir)
-            with open(file_path, "wb+") as f:
-                f.write(image_file)
-            logger.info(f"Image saved at {file_path}")
-        else:
-            logger.info(f"Skipped saving image: {link} (too small/broken image)")
+        create_dir_if_not_exists(os.path.dirname(file_path))
+        written = download_image(
+            link, file_path, brand_uri=dir_parts[-3], min_bytes=IMAGE_MIN_BYTES
+        )
+        handle_download(link, dir_parts, file_path, written, meter)
     else:
         logger.info(f"Image Exists: {link}, skipping download")
+        record_image(meter, "exists")
+
+
+def handle_download(link, dir_parts, file_path, written, meter: ThroughputMeter = None):
+    if written is None:
+        RETRY_QUEUE.push("image", {"link": link, "dir_parts": dir_parts})
+        record_image(meter, "failed")
+    elif written:
+        logger.info(f"Image saved at {file_path}")
+        if IMAGE_STORE:
+            store_image(file_path)
+        record_image(meter, "saved", written)
+    else:
+        logger.info(f"Skipped saving image: {link} (too small/broken image)")
+        record_image(meter, "skipped")
 
 
-def extract_details(product_json):
+def store_image(file_path: str):
     try:
-        # Extract relevant information using JSONPath parsers
-        basic_info = BASIC_PARSER.find(product_json)
-        if basic_info:
-            basic_info = basic_info[0].value
-            product_id = basic_info.get("id")
-            shop_id = basic_info.get("shopID")
-            shop_name = basic_info.get("shopName")
-            url = basic_info.get("url")
-            category_breadcrumb = basic_info.get("category").get("breadcrumbURL")
-            category_tree = category_breadcrumb.replace(
-                CATEGORY_BREADCRUMB_URI, ""
-            ).split("/")
-            category = category_tree[-1]
-        else:
-            product_id = shop_id = shop_name = url = category = category_tree = None
-
-        parsed_parent_id = PARENT_ID_PARSER.find(product_json)
-        parsed_desc = DESC_PARSER.find(product_json)
-        parsed_children = CHILD_PARSER.find(product_json)
-        parsed_price = PRICE_PARSER.find(product_json)
-
-        # Get values if they exist
-        parent_id = parsed_parent_id[0].value if parsed_parent_id else None
-        description = parsed_desc[0].value if parsed_desc else None
-        price = parsed_price[0].value if parsed_price else None
-
-        flattened_children = (
-            [
-                {
-                    "productID": child.value["productID"],
-                    "optionName": ", ".join(child.value["optionName"]),
-                }
-                for child in parsed_children
-            ]
-            if parsed_children
-            else None
-        )
+        get_blob_store().store(file_path)
+    except Exception as e:
+        logger.error(f"Error adding {file_path} to the blob store: {str(e)}")
+
+
+def record_image(meter: ThroughputMeter, status: str, num_bytes: int = 0):
+    if meter is not None:
+        meter.record(status, num_bytes)
 
-        # Create dictionary to store extracted details
-        out_json = {
-            "product_id": product_id,
-            "shop_id": shop_id,
-            "shop_name": shop_name,
-            "url": url,
-            "price": price,
-            "parent_id": parent_id,
-            "description": description,
-            "category": category,
-            "category_tree": category_tree,
-            "children": flattened_children,
-        }
-
-        return out_json
 
+def copy_duplicate_images(duplicates: list):
+    """Links images shared between products from their first download."""
+    for link, dir_parts, source_dir_parts in duplicates:
+        file_path = get_image_path(link, dir_parts)
+        source_path = get_image_path(link, source_dir_parts)
+        if os.path.isfile(file_path) and not SCRAPE_OVERWRITE:
+            continue
+        if not os.path.isfile(source_path):
+            continue
+        try:
+            create_dir_if_not_exists(os.path.dirname(file_path))
+            if os.path.lexists(file_path):
+                os.remove(file_path)
+            if IMAGE_STORE and os.path.islink(source_path):
+                blob_store = get_blob_store()
+                rel_path = os.path.relpath(source_path, ROOT_DIR)
+                source_sha = blob_store.links.get(rel_path)
+                if source_sha is not None:
+                    blob_store.link(file_path, source_sha)
+                    continue
+                # A link the store does not know about, copy its target instead
+                logger.warning(f"{source_path} is not in the blob store index")
+            try:
+                os.link(source_path, file_path)
+            except OSError:
+                shutil.copyfile(source_path, file_path)
+            logger.info(f"Image copied from {source_path} to {file_path}")
+        except OSError as e:
+            logger.error(f"Error copying image {source_path} to {file_path}: {str(e)}")
+
+
+def extract_details(product_json):
+    try:
+        return extract_product_info(product_json)
     except Exception as e:
         logger.error(f"Failed to process {product_json}: {e}")
 
 
+def retry_listing(payload: dict, manifest: dict = None) -> bool:
+    brand_listing = get_brand_listing(brand_uri=payload["brand"])
+    if brand_listing:
+        save_listing(payload["brand"], brand_listing)
+    return not listing_incomplete(brand_listing)
+
+
+def retry_details(payload: dict, manifest: dict = None) -> bool:
+    product = payload["product"]
+    product_details = get_item_details_batch([product["product_url"]])[0]
+    if product_details is None:
+        return False
+    save_product_details(product, product_details)
+    if manifest is not None:
+        record_fetched(manifest, product, product_details)
+    return True
+
+
+def retry_image(payload: dict, manifest: dict = None) -> bool:
+    link, dir_parts = payload["link"], payload["dir_parts"]
+    file_path = get_image_path(link, dir_parts)
+    create_dir_if_not_exists(os.path.dirname(file_path))
+    written = download_image(
+        link, file_path, brand_uri=dir_parts[-3], min_bytes=IMAGE_MIN_BYTES
+    )
+    if written and IMAGE_STORE:
+        store_image(file_path)
+    return written is not None
+
+
+RETRY_HANDLERS = {
+    "listing": retry_listing,
+    "details": retry_details,
+    "image": retry_image,
+}
+
+
+def retry_failed():
+    """Retries queued jobs whose backoff has elapsed, requeueing failures.
+
+    Recovered details are recorded in the crawl manifest like freshly
+    scraped ones, so incremental runs do not fetch them again.
+    """
+    manifest = load_manifest() if SCRAPE_INCREMENTAL else None
+    for job in RETRY_QUEUE.due():
+        kind, payload = job["kind"], job["payload"]
+        try:
+            success = RETRY_HANDLERS[kind](payload, manifest)
+        except Exception as e:
+            logger.error(f"Error retrying {kind} job {payload}: {str(e)}")
+            success = False
+        if success:
+            RETRY_QUEUE.complete(kind, payload)
+        else:
+            RETRY_QUEUE.push(kind, payload)
+    if manifest is not None:
+        save_manifest(manifest)
+
+
 def main():
     try:
         start_time = time.time()
         logger.info("Start Scraping Run")
 
+        retry_failed()
         scrape_listing()
         scrape_products()
         scrape_images()
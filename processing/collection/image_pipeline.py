@@ -0,0 +1,138 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import time
+import asyncio
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable, Iterator, List
+from processing.logger import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 64))
+PROGRESS_LOG_SECONDS = 30
+
+
+class ThroughputMeter:
+    """Thread-safe counters for the image pipeline, logged periodically."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start_time = time.time()
+        self.last_log = self.start_time
+        self.counts = {"saved": 0, "skipped": 0, "exists": 0, "failed": 0}
+        self.bytes = 0
+
+    def record(self, status: str, num_bytes: int = 0):
+        with self.lock:
+            self.counts[status] += 1
+            self.bytes += num_bytes
+            current = time.time()
+            if current - self.last_log < PROGRESS_LOG_SECONDS:
+                return
+            self.last_log = current
+        self.log("Image pipeline progress")
+
+    def log(self, prefix: str):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        with self.lock:
+            counts = dict(self.counts)
+            num_bytes = self.bytes
+        logger.info(
+            f"{prefix}: {counts}, "
+            f"{counts['saved'] / elapsed:.1f} images/s, "
+            f"{num_bytes / elapsed / 1e6:.2f} MB/s over {elapsed:.0f}s"
+        )
+
+
+def iter_image_jobs(
+    json_files: Iterable[str], get_links: Callable[[str], List[str]], duplicates: list
+) -> Iterator[tuple]:
+    """Yields one (link, dir_parts) download job per distinct image URL.
+
+    Repeats of a URL within a product (e.g. shared by variants) are dropped.
+    Repeats in other products are appended to `duplicates` as
+    (link, dir_parts, source_dir_parts) so they can be copied once the first
+    download finished instead of being fetched again.
+    """
+    first_seen = {}
+    for json_file in json_files:
+        try:
+            links = get_links(json_file)
+        except Exception as e:
+            logger.error(f"Error processing images for {json_file}: {str(e)}")
+            continue
+
+        dir_parts = json_file.split("/")
+        for link in dict.fromkeys(links):
+            source_dir_parts = first_seen.get(link)
+            if source_dir_parts is None:
+                first_seen[link] = dir_parts
+                yield link, dir_parts
+            else:
+                duplicates.append((link, dir_parts, source_dir_parts))
+
+
+def run_threaded(
+    jobs: Iterable[tuple], fetch: Callable, workers: int = IMAGE_WORKERS
+) -> int:
+    """Runs `fetch(*job)` on one shared pool, keeping the number of queued jobs bounded.
+
+    Returns the number of jobs that raised, each of which is logged.
+    """
+    failures = 0
+
+    def check(done):
+        nonlocal failures
+        for future in done:
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                logger.error(f"Error fetching image {pending[future][0]}: {str(e)}")
+            del pending[future]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for job in jobs:
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                check(done)
+            pending[executor.submit(fetch, *job)] = job
+        done, _ = wait(pending)
+        check(done)
+    return failures
+
+
+async def run_async(
+    jobs: Iterable[tuple], fetch: Callable, workers: int = IMAGE_WORKERS
+) -> int:
+    """Runs `await fetch(*job)` with `workers` consumers pulling from one job iterator.
+
+    Jobs are drawn on a worker thread, since producing them reads product JSON
+    files, and one at a time, since a generator cannot be advanced
+    concurrently. Returns the number of jobs that raised.
+    """
+    jobs = iter(jobs)
+    draw_lock = asyncio.Lock()
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        while True:
+            async with draw_lock:
+                job = await asyncio.to_thread(next, jobs, None)
+            if job is None:
+                return
+            try:
+                await fetch(*job)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Error fetching image {job[0]}: {str(e)}")
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return failures
@@ -0,0 +1,114 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import json
+import hashlib
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, List, Tuple
+from processing.logger import logger
+from processing.utils.utils import save_json
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+MANIFEST_PATH = os.path.join(ROOT_DIR, "listing", "manifest.json")
+
+# Listing fields that trigger a details refetch when they change
+LISTING_FIELDS = ("name", "product_url", "price")
+
+manifest_lock = Lock()
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def content_hash(data) -> str:
+    """Stable sha256 of a JSON-serialisable value."""
+    encoded = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def listing_hash(product: dict) -> str:
+    return content_hash({field: product.get(field) for field in LISTING_FIELDS})
+
+
+def listing_price(product: dict):
+    return (product.get("price") or {}).get("text_idr")
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> Dict[str, dict]:
+    """Loads the crawl manifest keyed by product_id, empty if missing."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.info(f"No crawl manifest at {path}, starting a new one")
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding crawl manifest {path}: {e}")
+    return {}
+
+
+def save_manifest(manifest: Dict[str, dict], path: str = MANIFEST_PATH):
+    with manifest_lock:
+        save_json(manifest, path)
+
+
+def diff_products(
+    manifest: Dict[str, dict], products: List[dict], incomplete_brands: set = ()
+) -> Tuple[List[dict], List[str]]:
+    """Compares today's listing against the manifest.
+
+    Returns the products that are new, changed or relisted, and the ids of
+    products that disappeared from the listings of the brands crawled today.
+    Brands in `incomplete_brands` stopped before their last page, so their
+    missing products are not delisted.
+    """
+    changed = []
+    seen = set()
+    for product in products:
+        product_id = str(product["product_id"])
+        seen.add(product_id)
+        entry = manifest.get(product_id)
+        if (
+            not entry
+            or entry.get("listing_hash") != listing_hash(product)
+            or entry.get("delisted_at")
+        ):
+            changed.append(product)
+
+    brands = {product["brand"] for product in products} - set(incomplete_brands)
+    delisted = [
+        product_id
+        for product_id, entry in manifest.items()
+        if product_id not in seen
+        and entry.get("brand") in brands
+        and not entry.get("delisted_at")
+    ]
+    logger.info(
+        f"Incremental crawl: {len(changed)} new/changed, {len(products) - len(changed)} unchanged, {len(delisted)} delisted"
+    )
+    return changed, delisted
+
+
+def record_fetched(manifest: Dict[str, dict], product: dict, product_details):
+    """Records a successful details fetch for a product."""
+    entry = {
+        "brand": product["brand"],
+        "name": product["name"],
+        "price": listing_price(product),
+        "listing_hash": listing_hash(product),
+        "details_hash": content_hash(product_details),
+        "last_fetched": now(),
+        "delisted_at": None,
+    }
+    with manifest_lock:
+        manifest[str(product["product_id"])] = entry
+
+
+def record_delisted(manifest: Dict[str, dict], product_ids: List[str]):
+    delisted_at = now()
+    with manifest_lock:
+        for product_id in product_ids:
+            manifest[product_id]["delisted_at"] = delisted_at
@@ -26,6 +26,7 @@ def get_product_query():
               GetShopProduct(shopID: $sid, source: $source, filter: {page: $page, perPage: $perPage, fkeyword: $keyword, fmenu: $etalaseId, sort: $sort, user_districtId: $user_districtId, user_cityId: $user_cityId, user_lat: $user_lat, user_long: $user_long}) {
                 status
                 errors
+                totalData
                 links {
                   prev
                   next
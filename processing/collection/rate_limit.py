@@ -0,0 +1,243 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import json
+import time
+import random
+import asyncio
+import weakref
+from threading import Lock
+from typing import List
+from processing.logger import logger
+from processing.utils.utils import create_dir_if_not_exists
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+RETRY_QUEUE_PATH = os.path.join(ROOT_DIR, "listing", "retry_queue.jsonl")
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", 3))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 1))
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", 60))
+RETRY_QUEUE_MAX_ATTEMPTS = int(os.getenv("RETRY_QUEUE_MAX_ATTEMPTS", 5))
+RETRY_QUEUE_BACKOFF = float(os.getenv("RETRY_QUEUE_BACKOFF", 300))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Requests per second, burst size and concurrency bounds per endpoint
+ENDPOINT_LIMITS = {
+    "listing": {
+        "rate": float(os.getenv("RATE_LIMIT_LISTING", 10)),
+        "burst": int(os.getenv("RATE_BURST_LISTING", 20)),
+        "max_concurrency": int(os.getenv("MAX_CONCURRENCY_LISTING", 32)),
+    },
+    "details": {
+        "rate": float(os.getenv("RATE_LIMIT_DETAILS", 20)),
+        "burst": int(os.getenv("RATE_BURST_DETAILS", 40)),
+        "max_concurrency": int(os.getenv("MAX_CONCURRENCY_DETAILS", 64)),
+    },
+    "image": {
+        "rate": float(os.getenv("RATE_LIMIT_IMAGE", 200)),
+        "burst": int(os.getenv("RATE_BURST_IMAGE", 400)),
+        "max_concurrency": int(os.getenv("MAX_CONCURRENCY_IMAGE", 512)),
+    },
+}
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BACKOFF, cap: float = RETRY_BACKOFF_MAX):
+    """Exponential backoff with jitter for the given zero-based attempt."""
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+class TokenBucket:
+    """Thread-safe token bucket usable from both threads and coroutines."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long the caller must wait to use it."""
+        with self.lock:
+            current = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (current - self.updated) * self.rate
+            )
+            self.updated = current
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """AIMD concurrency limit for one endpoint.
+
+    The limit grows by roughly one per window of successful requests and is
+    halved when a request is throttled or times out, at most once per window:
+    throttles of requests sent before the last decrease are ignored, so a
+    burst of them backs off once. Only the async path (async_scraper.send)
+    adapts; the threaded path used by default (SCRAPE_ASYNC=False) keeps
+    fixed concurrency, bounded by its pool sizes, the token buckets and
+    urllib3's retry backoff.
+    """
+
+    def __init__(self, name: str, maximum: int, minimum: int = 1):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, maximum // 4))
+        self.in_flight = 0
+        self.last_decrease = float("-inf")
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """Waits for a slot and returns the time the request starts."""
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < max(int(self.limit), self.minimum)
+            )
+            self.in_flight += 1
+            return time.monotonic()
+
+    async def release(self, started: float, throttled: bool = False):
+        async with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                if started >= self.last_decrease:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                    logger.info(
+                        f"Throttled on {self.name}, concurrency limit lowered to {int(self.limit)}"
+                    )
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+BUCKETS = {
+    name: TokenBucket(limits["rate"], limits["burst"])
+    for name, limits in ENDPOINT_LIMITS.items()
+}
+
+# asyncio primitives are bound to one event loop, so keep a set per loop
+_concurrency_limits = weakref.WeakKeyDictionary()
+
+
+def get_concurrency_limit(name: str) -> AdaptiveConcurrency:
+    limits = _concurrency_limits.setdefault(asyncio.get_running_loop(), {})
+    if name not in limits:
+        limits[name] = AdaptiveConcurrency(
+            name, ENDPOINT_LIMITS[name]["max_concurrency"]
+        )
+    return limits[name]
+
+
+class RetryQueue:
+    """JSONL queue of failed scrape jobs, persisted across runs.
+
+    Jobs are keyed by kind and payload, so a job that fails again is
+    rescheduled with its attempts carried forward rather than queued twice.
+    Every change appends the job's latest state and the last line of a key
+    wins; the file is compacted when first loaded. A job leaves the queue
+    only once `complete` is called or it runs out of attempts, so a crash
+    mid-retry loses nothing.
+    """
+
+    def __init__(self, path: str = RETRY_QUEUE_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.jobs = None  # key -> latest entry, loaded on first use
+
+    @staticmethod
+    def key(kind: str, payload: dict) -> str:
+        return json.dumps([kind, payload], sort_keys=True)
+
+    def load(self) -> dict:
+        if self.jobs is None:
+            self.jobs = {}
+            try:
+                with open(self.path, "r") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        key = self.key(entry["kind"], entry["payload"])
+                        if entry.get("done"):
+                            self.jobs.pop(key, None)
+                        else:
+                            self.jobs[key] = entry
+            except FileNotFoundError:
+                return self.jobs
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in self.jobs.values())
+            os.replace(temp_path, self.path)
+        return self.jobs
+
+    def append(self, entry: dict):
+        create_dir_if_not_exists(os.path.dirname(self.path))
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def push(self, kind: str, payload: dict):
+        """Queues a failed job, or reschedules it one attempt later if queued."""
+        with self.lock:
+            jobs = self.load()
+            key = self.key(kind, payload)
+            queued = jobs.get(key)
+            attempts = queued["attempts"] + 1 if queued else 0
+            if attempts >= RETRY_QUEUE_MAX_ATTEMPTS:
+                jobs.pop(key, None)
+                self.append({"kind": kind, "payload": payload, "done": True})
+                logger.error(
+                    f"Giving up on {kind} job after {attempts} attempts: {payload}"
+                )
+                return
+
+            entry = {
+                "kind": kind,
+                "payload": payload,
+                "attempts": attempts,
+                "next_attempt": time.time()
+                + backoff_delay(attempts, RETRY_QUEUE_BACKOFF, cap=86400),
+            }
+            jobs[key] = entry
+            self.append(entry)
+        logger.warning(f"Queued {kind} job for retry (attempt {attempts + 1})")
+
+    def complete(self, kind: str, payload: dict):
+        """Removes a job that succeeded."""
+        with self.lock:
+            if self.load().pop(self.key(kind, payload), None) is not None:
+                self.append({"kind": kind, "payload": payload, "done": True})
+
+    def due(self) -> List[dict]:
+        """Jobs whose backoff has elapsed; they stay queued until completed."""
+        with self.lock:
+            jobs = self.load()
+            current = time.time()
+            due = [
+                dict(entry)
+                for entry in jobs.values()
+                if entry["next_attempt"] <= current
+            ]
+            pending = len(jobs) - len(due)
+        logger.info(f"Retry queue: {len(due)} jobs due, {pending} pending")
+        return due
+
+
+RETRY_QUEUE = RetryQueue()
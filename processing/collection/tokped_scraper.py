@@ -3,17 +3,63 @@ import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 
+import math
 import requests
 import re
+from concurrent.futures import ThreadPoolExecutor
 from processing.logger import logger
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 from queries import get_product_query, get_sid_query, get_product_details_query
+from rate_limit import BUCKETS, RETRY_ATTEMPTS, RETRY_BACKOFF, RETRY_STATUSES
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # Configuration constants
 ARRAY_REQUEST_URI = "https://gql.tokopedia.com/graphql/ShopProducts"
 PDP_REQUEST_URI = "https://gql.tokopedia.com/graphql/PDPGetLayoutQuery"
 REGEX_PRODUCT_URI = r"(https?://www\.)?tokopedia\.com/([\w\d]+?)/([\w\d-]+)\??"
 REQUEST_TIMEOUT = 10  # Timeout for all requests (in seconds)
+LISTING_PER_PAGE = 80
+IMAGE_CHUNK_BYTES = 64 * 1024
+POOL_MAXSIZE = int(os.getenv("SCRAPE_POOL_MAXSIZE", 32))
+LISTING_CONCURRENCY = int(os.getenv("LISTING_CONCURRENCY", 1))
+LISTING_BATCH_SIZE = int(os.getenv("LISTING_BATCH_SIZE", 1))
+ENDPOINTS = {ARRAY_REQUEST_URI: "listing", PDP_REQUEST_URI: "details"}
+
+
+def create_session():
+    """Creates a requests session that keeps connections alive between calls."""
+    session = requests.Session()
+    retries = Retry(
+        total=RETRY_ATTEMPTS,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # GraphQL reads are POSTs and safe to retry
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared across threads so every request reuses pooled TCP+TLS connections
+SESSION = create_session()
+
+
+def get_endpoint(uri):
+    """Maps a request URI to its rate limit bucket name."""
+    return ENDPOINTS.get(uri, "image")
+
+
+def throttle(uri):
+    """Blocks until the endpoint's token bucket allows another request."""
+    BUCKETS[get_endpoint(uri)].acquire()
 
 
 def get_headers(brand_uri, product_uri=None):
@@ -43,26 +89,159 @@ def get_headers(brand_uri, product_uri=None):
     return headers
 
 
+def build_sid_payload(brand_uri):
+    return [
+        {
+            "operationName": "ShopInfoCore",
+            "variables": {"domain": brand_uri, "id": 0},
+            "query": get_sid_query(),
+        }
+    ]
+
+
+def build_listing_payload(sid, page):
+    return [
+        {
+            "operationName": "ShopProducts",
+            "variables": {
+                "source": "shop",
+                "sid": sid,
+                "page": page,
+                "perPage": LISTING_PER_PAGE,
+                "etalaseId": "etalase",
+                "sort": 1,
+            },
+            "query": get_product_query(),
+        }
+    ]
+
+
+def build_details_payload(brand_uri, product_uri):
+    return [
+        {
+            "operationName": "PDPGetLayoutQuery",
+            "variables": {
+                "shopDomain": brand_uri,
+                "productKey": product_uri,
+                "layoutID": "",
+                "apiVersion": 1,
+                "tokonow": {"shopID": "0", "whID": "0", "serviceType": ""},
+                "extParam": "src%3Dshop",
+            },
+            "query": get_product_details_query(),
+        }
+    ]
+
+
+def parse_sid(response_json):
+    return response_json[0]["data"]["shopInfoByID"]["result"][0]["shopCore"]["shopID"]
+
+
+def has_next_page(page_json):
+    return bool(page_json[0]["data"]["GetShopProduct"]["links"]["next"])
+
+
+def split_batch_response(response_json, size):
+    """Splits a batched GraphQL array response into single-operation responses.
+
+    Each entry is shaped like the response of an unbatched request. Operations
+    that returned errors or empty data come back as None.
+    """
+    if not isinstance(response_json, list) or len(response_json) != size:
+        return [None] * size
+
+    results = []
+    for operation in response_json:
+        if not isinstance(operation, dict):
+            results.append(None)
+            continue
+        data = operation.get("data")
+        if operation.get("errors") or not data or None in data.values():
+            results.append(None)
+        else:
+            results.append([operation])
+    return results
+
+
+def chunk(items, size):
+    return [items[i : i + size] for i in range(0, len(items), max(size, 1))]
+
+
+def estimate_page_count(page_json):
+    """Estimates the number of listing pages from the first page, 0 if unknown."""
+    total_data = page_json[0]["data"]["GetShopProduct"].get("totalData")
+    if not total_data:
+        return 0
+    return math.ceil(int(total_data) / LISTING_PER_PAGE)
+
+
+def next_page_window(next_page, page_count, concurrency):
+    """Returns the pages to request in parallel after `next_page - 1`.
+
+    Uses the estimated page count while it is ahead of us, otherwise
+    speculatively requests `concurrency` pages.
+    """
+    last_page = page_count if page_count >= next_page else next_page + concurrency - 1
+    return list(range(next_page, last_page + 1))
+
+
+def merge_listing_pages(listings, pages):
+    """Appends pages in order until one fails or is the last page.
+
+    Returns True when more pages remain to be fetched.
+    """
+    for page_json in pages:
+        if page_json is None:
+            return False
+        listings.append(page_json)
+        if not has_next_page(page_json):
+            return False
+    return True
+
+
+def listing_window(next_page, page_count, concurrency):
+    """Returns the page batches of the next listing window and the page after it."""
+    window = next_page_window(next_page, page_count, concurrency * LISTING_BATCH_SIZE)
+    return chunk(window, LISTING_BATCH_SIZE), window[-1] + 1
+
+
+def merge_listing_batches(listings, batches):
+    """Merges a window's fetched page batches, see merge_listing_pages."""
+    return merge_listing_pages(listings, [page for batch in batches for page in batch])
+
+
+def build_listing_batch(sid, pages):
+    return [op for page in pages for op in build_listing_payload(sid, page)]
+
+
+def build_details_batch(keys):
+    return [op for key in keys for op in build_details_payload(*key)]
+
+
+def missing_items(items, results):
+    """Items whose batched result is missing and must be requested singly."""
+    return [item for item, result in zip(items, results) if result is None]
+
+
+def fill_missing(results, retried):
+    """Fills the missing batched results, in order, with their single retries."""
+    retried = iter(retried)
+    return [result if result is not None else next(retried) for result in results]
+
+
 def get_brand_sid(brand_uri):
     """Converts Brand Official Store Name to SID"""
     try:
         headers = get_headers(brand_uri)
-        data = [
-            {
-                "operationName": "ShopInfoCore",
-                "variables": {"domain": brand_uri, "id": 0},
-                "query": get_sid_query(),
-            }
-        ]
-
-        response = requests.post(
+        data = build_sid_payload(brand_uri)
+
+        throttle(ARRAY_REQUEST_URI)
+        response = SESSION.post(
             ARRAY_REQUEST_URI, headers=headers, json=data, timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()  # Raise an error for bad HTTP status codes
 
-        sid = response.json()[0]["data"]["shopInfoByID"]["result"][0]["shopCore"][
-            "shopID"
-        ]
+        sid = parse_sid(response.json())
         logger.info(f"Successfully retrieved SID for {brand_uri}: {sid}")
         return sid
     except (RequestException, KeyError) as e:
@@ -70,48 +249,97 @@ def get_brand_sid(brand_uri):
         return None
 
 
-def get_brand_listing(brand_uri):
-    """Returns all products from a brand page"""
+def get_listing_page(brand_uri, sid, page, headers):
+    """Fetches a single ShopProducts page, None on failure."""
+    try:
+        data = build_listing_payload(sid, page)
+
+        throttle(ARRAY_REQUEST_URI)
+        response = SESSION.post(
+            ARRAY_REQUEST_URI, headers=headers, json=data, timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+
+        page_json = response.json()
+        has_next_page(page_json)  # Validate the page structure
+        return page_json
+    except (RequestException, KeyError, IndexError, TypeError) as e:
+        logger.error(
+            f"Error retrieving product listings for {brand_uri} on page {page}: {str(e)}"
+        )
+        return None
+
+
+def get_listing_pages(brand_uri, sid, pages, headers):
+    """Fetches several ShopProducts pages in one batched request.
+
+    Pages the batch could not return are retried one by one.
+    """
+    if len(pages) == 1:
+        return [get_listing_page(brand_uri, sid, pages[0], headers)]
+
+    data = build_listing_batch(sid, pages)
+    try:
+        throttle(ARRAY_REQUEST_URI)
+        response = SESSION.post(
+            ARRAY_REQUEST_URI, headers=headers, json=data, timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        results = split_batch_response(response.json(), len(pages))
+    except (RequestException, ValueError) as e:
+        logger.warning(
+            f"Batched listing request for {brand_uri} pages {pages} failed, retrying singly: {str(e)}"
+        )
+        results = [None] * len(pages)
+
+    retried = [
+        get_listing_page(brand_uri, sid, page, headers)
+        for page in missing_items(pages, results)
+    ]
+    return fill_missing(results, retried)
+
+
+def get_brand_listing(brand_uri, concurrency=LISTING_CONCURRENCY):
+    """Returns all products from a brand page
+
+    With `concurrency` above 1 the first page is used to estimate the page
+    count and the remaining pages are fetched in parallel.
+    """
     sid = get_brand_sid(brand_uri)
     if not sid:
         return []
 
     headers = get_headers(brand_uri)
     listings = []
-    i = 1
 
-    while True:
-        try:
-            data = [
-                {
-                    "operationName": "ShopProducts",
-                    "variables": {
-                        "source": "shop",
-                        "sid": sid,
-                        "page": i,
-                        "perPage": 80,
-                        "etalaseId": "etalase",
-                        "sort": 1,
-                    },
-                    "query": get_product_query(),
-                }
-            ]
-
-            response = requests.post(
-                ARRAY_REQUEST_URI, headers=headers, json=data, timeout=REQUEST_TIMEOUT
-            )
-            response.raise_for_status()
+    if concurrency > 1:
+        first_page = get_listing_page(brand_uri, sid, 1, headers)
+        if first_page is not None:
+            page_count = estimate_page_count(first_page)
+            more_pages = merge_listing_pages(listings, [first_page])
+            next_page = 2
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                while more_pages:
+                    batches, next_page = listing_window(
+                        next_page, page_count, concurrency
+                    )
+                    batches = executor.map(
+                        lambda pages: get_listing_pages(brand_uri, sid, pages, headers),
+                        batches,
+                    )
+                    more_pages = merge_listing_batches(listings, batches)
+    else:
+        i = 1
+        while True:
+            page_json = get_listing_page(brand_uri, sid, i, headers)
+            if page_json is None:
+                break
 
-            listings.append(response.json())
+            listings.append(page_json)
 
-            if not response.json()[0]["data"]["GetShopProduct"]["links"]["next"]:
+            if not has_next_page(page_json):
                 break
             i += 1
-        except (RequestException, KeyError) as e:
-            logger.error(
-                f"Error retrieving product listings for {brand_uri} on page {i}: {str(e)}"
-            )
-            break
 
     logger.info(f"Retrieved {len(listings)} pages of products for {brand_uri}")
     return listings
@@ -126,27 +354,37 @@ def split_product_uri(product_url):
     return brand_uri, product_uri
 
 
+def parse_product_keys(product_urls):
+    """Returns (index, (brand_uri, product_uri)) for every valid product URL.
+
+    Invalid URLs are logged and left out, so their details stay None.
+    """
+    valid = []
+    for i, product_url in enumerate(product_urls):
+        try:
+            valid.append((i, split_product_uri(product_url)))
+        except ValueError as e:
+            logger.error(f"Error retrieving product details for {product_url}: {str(e)}")
+    return valid
+
+
+def align_details(size, valid, results):
+    """Places results for the valid products at their index in the request."""
+    details = [None] * size
+    for (i, _), result in zip(valid, results):
+        details[i] = result
+    return details
+
+
 def get_item_details(product_url):
     try:
         brand_uri, product_uri = split_product_uri(product_url)
         headers = get_headers(brand_uri, product_uri)
 
-        data = [
-            {
-                "operationName": "PDPGetLayoutQuery",
-                "variables": {
-                    "shopDomain": brand_uri,
-                    "productKey": product_uri,
-                    "layoutID": "",
-                    "apiVersion": 1,
-                    "tokonow": {"shopID": "0", "whID": "0", "serviceType": ""},
-                    "extParam": "src%3Dshop",
-                },
-                "query": get_product_details_query(),
-            }
-        ]
-
-        response = requests.post(
+        data = build_details_payload(brand_uri, product_uri)
+
+        throttle(PDP_REQUEST_URI)
+        response = SESSION.post(
             PDP_REQUEST_URI, headers=headers, json=data, timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
@@ -156,9 +394,46 @@ def get_item_details(product_url):
         return None
 
 
+def get_item_details_batch(product_urls):
+    """Fetches details for several products in one PDPGetLayoutQuery request.
+
+    Returns details aligned with `product_urls`. Products the batch could not
+    return are retried with single requests.
+    """
+    valid = parse_product_keys(product_urls)
+    if not valid:
+        return [None] * len(product_urls)
+    if len(valid) == 1:
+        results = [get_item_details(product_urls[valid[0][0]])]
+        return align_details(len(product_urls), valid, results)
+
+    data = build_details_batch(key for _, key in valid)
+    try:
+        throttle(PDP_REQUEST_URI)
+        response = SESSION.post(
+            PDP_REQUEST_URI,
+            headers=get_headers(*valid[0][1]),
+            json=data,
+            timeout=REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        results = split_batch_response(response.json(), len(valid))
+    except (RequestException, ValueError) as e:
+        logger.warning(
+            f"Batched details request for {len(valid)} products failed, retrying singly: {str(e)}"
+        )
+        results = [None] * len(valid)
+
+    retried = [
+        get_item_details(product_urls[i]) for i, _ in missing_items(valid, results)
+    ]
+    return align_details(len(product_urls), valid, fill_missing(results, retried))
+
+
 def get_image(image_url, brand_uri=""):
     try:
-        response = requests.get(
+        throttle(image_url)
+        response = SESSION.get(
             image_url, headers=get_headers(brand_uri), timeout=REQUEST_TIMEOUT
         )
         response.raise_for_status()
@@ -166,3 +441,46 @@ def get_image(image_url, brand_uri=""):
     except (RequestException, ValueError) as e:
         logger.error(f"Error retrieving image from {image_url}: {str(e)}")
         return None
+
+
+def finish_download(part_path, file_path, written, min_bytes):
+    """Moves a completed download into place unless it is below `min_bytes`."""
+    if written < min_bytes:
+        os.remove(part_path)
+        return 0
+    os.replace(part_path, file_path)
+    return written
+
+
+def download_image(image_url, file_path, brand_uri="", min_bytes=0):
+    """Streams an image to `file_path` in chunks and returns the bytes written.
+
+    Returns 0 without keeping the file when the image is smaller than
+    `min_bytes`, checked against Content-Length before the body is read
+    where the server sends it, and None on failure.
+    """
+    part_path = f"{file_path}.part"
+    try:
+        throttle(image_url)
+        with SESSION.get(
+            image_url,
+            headers=get_headers(brand_uri),
+            timeout=REQUEST_TIMEOUT,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length and content_length < min_bytes:
+                return 0
+
+            written = 0
+            with open(part_path, "wb") as f:
+                for chunk in response.iter_content(IMAGE_CHUNK_BYTES):
+                    f.write(chunk)
+                    written += len(chunk)
+        return finish_download(part_path, file_path, written, min_bytes)
+    except (RequestException, ValueError, OSError) as e:
+        logger.error(f"Error retrieving image from {image_url}: {str(e)}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
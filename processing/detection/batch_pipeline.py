@@ -0,0 +1,121 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
+from processing.logger import logger
+
+_END = object()
+
+
+class BatchPipeline:
+    """Three-stage decode -> batched inference -> write pipeline.
+
+    Items are decoded on a pool of `decode_workers`, grouped into batches of
+    `batch_size` for a single `infer` caller (so one model instance serves the
+    whole run), and each batch output is handed to a pool of `write_workers`.
+    Both hand-offs are bounded by `queue_size`, so memory stays flat however
+    many items are fed in.
+    """
+
+    def __init__(
+        self,
+        decode: Callable,
+        infer: Callable,
+        write: Callable,
+        batch_size: int,
+        decode_workers: int = 4,
+        write_workers: int = 4,
+        queue_size: int = 64,
+        decode_executor=None,
+    ):
+        self.decode = decode
+        self.infer = infer
+        self.write = write
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.decode_executor = decode_executor
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.write_slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.counts = {"written": 0, "failed": 0}
+
+    def _count(self, status: str):
+        with self.lock:
+            self.counts[status] += 1
+
+    def _feed(self, items: Iterable, executor):
+        """Submits decodes in order; blocks once `queue_size` are waiting."""
+        try:
+            for item in items:
+                self.decoded.put((item, executor.submit(self.decode, item)))
+        except Exception as e:
+            logger.error(f"Error feeding the detection pipeline: {e}")
+        finally:
+            self.decoded.put(_END)
+
+    def _batches(self):
+        """Yields lists of (item, decoded) of up to `batch_size` from the decode queue."""
+        batch = []
+        while True:
+            entry = self.decoded.get()
+            if entry is _END:
+                break
+            item, future = entry
+            try:
+                decoded = future.result()
+            except Exception as e:
+                logger.error(f"Error decoding {item}: {e}")
+                decoded = None
+            if decoded is None:
+                self._count("failed")
+                continue
+
+            batch.append((item, decoded))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _write(self, batch: List[tuple], outputs, index: int):
+        try:
+            item, decoded = batch[index]
+            self._count("written" if self.write(item, decoded, outputs, index) else "failed")
+        except Exception as e:
+            logger.error(f"Error writing {batch[index][0]}: {e}")
+            self._count("failed")
+        finally:
+            self.write_slots.release()
+
+    def run(self, items: Iterable) -> dict:
+        decode_executor = self.decode_executor or ThreadPoolExecutor(
+            max_workers=self.decode_workers
+        )
+        with decode_executor, ThreadPoolExecutor(
+            max_workers=self.write_workers
+        ) as write_executor:
+            feeder = threading.Thread(
+                target=self._feed, args=(items, decode_executor), daemon=True
+            )
+            feeder.start()
+
+            for batch in self._batches():
+                outputs = self.infer(batch)
+                if outputs is None:
+                    for _ in batch:
+                        self._count("failed")
+                    continue
+
+                for index in range(len(batch)):
+                    self.write_slots.acquire()
+                    write_executor.submit(self._write, batch, outputs, index)
+
+            feeder.join()
+        return dict(self.counts)
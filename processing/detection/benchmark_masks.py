@@ -0,0 +1,91 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from pycocotools import mask as mask_api
+from utils import mask_utils
+
+
+def full_canvas(masks, boxes, height, width):
+    """Pastes full-size masks and encodes each, as detection did before."""
+    pasted = mask_utils.paste_instance_masks(masks, boxes, height, width)
+    return [mask_api.encode(np.asfortranarray(mask)) for mask in pasted]
+
+
+def cropped(masks, boxes, height, width):
+    """Pastes box-local crops and encodes them from their offset."""
+    return [
+        mask_api.frPyObjects(
+            {
+                "counts": mask_utils.encode_cropped_mask(crop, offset, height, width),
+                "size": [height, width],
+            },
+            height,
+            width,
+        )
+        for crop, offset in mask_utils.paste_instance_masks_cropped(
+            masks, boxes, height, width
+        )
+    ]
+
+
+def measure(paste, masks, boxes, height, width, repeat):
+    """Returns seconds per call, peak traced allocation and the last encoding."""
+    tracemalloc.start()
+    encoded = paste(masks, boxes, height, width)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        encoded = paste(masks, boxes, height, width)
+    return (time.perf_counter() - start_time) / repeat, peak, encoded
+
+
+def random_detections(rng, num_detections, mask_size, height, width):
+    """Random mask logits and [x, y, w, h] boxes, some reaching past the image."""
+    masks = rng.random((num_detections, mask_size, mask_size)).astype(np.float32)
+    corners = rng.uniform(-0.1, 0.9, (num_detections, 2)) * (width, height)
+    sizes = rng.uniform(0.05, 0.6, (num_detections, 2)) * (width, height)
+    return masks, np.concatenate([corners, sizes], axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark cropped mask pasting against full-canvas pasting."
+    )
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--detections", type=int, default=100)
+    parser.add_argument("--mask-size", type=int, default=28)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    masks, boxes = random_detections(
+        rng, args.detections, args.mask_size, args.height, args.width
+    )
+
+    full_time, full_peak, expected = measure(
+        full_canvas, masks, boxes, args.height, args.width, args.repeat
+    )
+    crop_time, crop_peak, actual = measure(
+        cropped, masks, boxes, args.height, args.width, args.repeat
+    )
+    mismatches = sum(a["counts"] != b["counts"] for a, b in zip(expected, actual))
+
+    print(f"Image: {args.height}x{args.width}, {args.detections} detections")
+    print(f"full canvas:  {full_time * 1e3:.1f} ms, peak {full_peak / 1e6:.1f} MB")
+    print(f"cropped:      {crop_time * 1e3:.1f} ms, peak {crop_peak / 1e6:.1f} MB")
+    print(f"Speedup:      {full_time / crop_time:.1f}x")
+    print(f"Mismatches:   {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import argparse
+import glob
+import json
+import random
+import time
+import numpy as np
+from preprocess import process_image
+from runners import MODEL_DIR, SavedModelRunner, TFLiteRunner
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+IMAGE_PATTERN = os.path.join(ROOT_DIR, "details/**/images/*.[jp][pn]g")
+
+
+def load_batches(image_pattern, num_images, batch_size, image_size, seed):
+    """Preprocessed uint8 batches of sampled images, as detect.py feeds them."""
+    image_files = sorted(
+        {os.path.realpath(f) for f in glob.glob(image_pattern, recursive=True)}
+    )
+    image_files = random.Random(seed).sample(
+        image_files, min(num_images, len(image_files))
+    )
+    batches = []
+    for start in range(0, len(image_files), batch_size):
+        images = np.zeros((batch_size, image_size, image_size, 3), dtype=np.uint8)
+        count = 0
+        for image_file in image_files[start : start + batch_size]:
+            processed = process_image(image_file, image_size)
+            if processed is not None:
+                images[count] = processed[0]
+                count += 1
+        if count:
+            batches.append((images, count))
+    return batches
+
+
+def detections(outputs, index, min_score):
+    """Boxes, classes and scores of one image at or above `min_score`."""
+    num_detections = int(outputs["num_detections"][index])
+    scores = outputs["detection_scores"][index, :num_detections]
+    keep = scores >= min_score
+    return (
+        outputs["detection_boxes"][index, :num_detections][keep],
+        outputs["detection_classes"][index, :num_detections][keep].astype(int),
+        scores[keep],
+    )
+
+
+def box_iou(box, boxes):
+    """IoU of one (ymin, xmin, ymax, xmax) box against many."""
+    ymin = np.maximum(box[0], boxes[:, 0])
+    xmin = np.maximum(box[1], boxes[:, 1])
+    ymax = np.minimum(box[2], boxes[:, 2])
+    xmax = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def match(reference, candidate, iou_thresh):
+    """Greedily matches reference detections to same-class candidates by score.
+
+    Returns (matched, reference count, candidate count, IoUs, score deltas).
+    """
+    ref_boxes, ref_classes, ref_scores = reference
+    boxes, classes, scores = candidate
+    used = np.zeros(len(boxes), dtype=bool)
+    ious, deltas = [], []
+    for i in np.argsort(-ref_scores):
+        same_class = np.flatnonzero((classes == ref_classes[i]) & ~used)
+        if not len(same_class):
+            continue
+        overlaps = box_iou(ref_boxes[i], boxes[same_class])
+        best = int(np.argmax(overlaps))
+        if overlaps[best] >= iou_thresh:
+            used[same_class[best]] = True
+            ious.append(overlaps[best])
+            deltas.append(abs(scores[same_class[best]] - ref_scores[i]))
+    return len(ious), len(ref_boxes), len(boxes), ious, deltas
+
+
+def run(runner, batches, warmup):
+    """Outputs per batch and per-image latencies in seconds."""
+    for images, _ in batches[:warmup]:
+        runner(images)
+    outputs, latencies = [], []
+    for images, count in batches:
+        start_time = time.perf_counter()
+        outputs.append(runner(images))
+        latencies.append((time.perf_counter() - start_time) / count)
+    return outputs, latencies
+
+
+def model_size(model_path):
+    if os.path.isdir(model_path):
+        return sum(
+            os.path.getsize(os.path.join(dir_path, f))
+            for dir_path, _, files in os.walk(model_path)
+            for f in files
+        )
+    return os.path.getsize(model_path)
+
+
+def report(name, model_path, load_time, latencies, reference, outputs, batches, args):
+    row = {
+        "runner": name,
+        "model_size_mb": model_size(model_path) / 1e6,
+        "load_s": load_time,
+        "latency_ms_mean": float(np.mean(latencies) * 1e3),
+        "latency_ms_p50": float(np.percentile(latencies, 50) * 1e3),
+        "latency_ms_p95": float(np.percentile(latencies, 95) * 1e3),
+    }
+    if reference is not None:
+        matched = num_reference = num_candidate = 0
+        ious, deltas = [], []
+        for ref_output, output, (_, count) in zip(reference, outputs, batches):
+            for index in range(count):
+                m, r, c, i, d = match(
+                    detections(ref_output, index, args.min_score),
+                    detections(output, index, args.min_score),
+                    args.iou,
+                )
+                matched += m
+                num_reference += r
+                num_candidate += c
+                ious.extend(i)
+                deltas.extend(d)
+        row.update(
+            {
+                "recall": matched / max(num_reference, 1),
+                "precision": matched / max(num_candidate, 1),
+                "mean_iou": float(np.mean(ious)) if ious else 0.0,
+                "mean_score_delta": float(np.mean(deltas)) if deltas else 0.0,
+            }
+        )
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report accuracy and latency of TFLite exports against the "
+        "fp32 SavedModel."
+    )
+    parser.add_argument("--saved-model-dir", default=MODEL_DIR)
+    parser.add_argument(
+        "--tflite", nargs="+", required=True, help="TFLite models to compare"
+    )
+    parser.add_argument("--image-pattern", default=IMAGE_PATTERN)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument(
+        "--batch-size", type=int, default=int(os.getenv("DETECT_BATCH_SIZE", 8))
+    )
+    parser.add_argument(
+        "--image-size", type=int, default=int(os.getenv("DETECT_IMAGE_SIZE", 640))
+    )
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--min-score", type=float, default=float(os.getenv("DETECT_MIN_THRESH", 0))
+    )
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    batches = load_batches(
+        args.image_pattern, args.images, args.batch_size, args.image_size, args.seed
+    )
+    if not batches:
+        sys.exit(f"No images match {args.image_pattern}")
+
+    start_time = time.perf_counter()
+    runner = SavedModelRunner(args.saved_model_dir)
+    load_time = time.perf_counter() - start_time
+    reference, latencies = run(runner, batches, args.warmup)
+    rows = [
+        report(
+            "saved_model",
+            args.saved_model_dir,
+            load_time,
+            latencies,
+            None,
+            reference,
+            batches,
+            args,
+        )
+    ]
+    del runner
+
+    for model_path in args.tflite:
+        for xnnpack in (True, False):
+            start_time = time.perf_counter()
+            runner = TFLiteRunner(model_path, num_threads=args.threads, xnnpack=xnnpack)
+            load_time = time.perf_counter() - start_time
+            outputs, latencies = run(runner, batches, args.warmup)
+            name = os.path.basename(model_path) + ("" if xnnpack else " (no xnnpack)")
+            rows.append(
+                report(
+                    name,
+                    model_path,
+                    load_time,
+                    latencies,
+                    reference,
+                    outputs,
+                    batches,
+                    args,
+                )
+            )
+
+    num_images = sum(count for _, count in batches)
+    print(
+        f"{num_images} images, batch {args.batch_size}, "
+        f"min score {args.min_score}, IoU {args.iou}"
+    )
+    print(
+        f"{'runner':<34}{'MB':>8}{'load s':>8}{'ms/img':>9}{'p95':>9}"
+        f"{'recall':>8}{'prec':>8}{'IoU':>7}{'dscore':>8}"
+    )
+    for row in rows:
+        if "recall" in row:
+            accuracy = (
+                f"{row['recall']:>8.3f}{row['precision']:>8.3f}"
+                f"{row['mean_iou']:>7.3f}{row['mean_score_delta']:>8.3f}"
+            )
+        else:
+            accuracy = f"{'ref':>8}"
+        print(
+            f"{row['runner']:<34}{row['model_size_mb']:>8.1f}{row['load_s']:>8.1f}"
+            f"{row['latency_ms_mean']:>9.1f}{row['latency_ms_p95']:>9.1f}{accuracy}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import io
+import json
+import urllib.request
+import numpy as np
+from typing import Dict, Optional
+from processing.logger import logger
+from dotenv import load_dotenv
+
+# Kept free of TensorFlow so the search app can call the detection service
+
+load_dotenv()
+
+DETECT_SERVICE_URL = os.getenv("DETECT_SERVICE_URL", "http://127.0.0.1:8501")
+DETECT_SERVICE_TIMEOUT = float(os.getenv("DETECT_SERVICE_TIMEOUT", 60))
+
+
+def post(path: str, body: bytes, url: str = DETECT_SERVICE_URL) -> bytes:
+    request = urllib.request.Request(
+        f"{url}{path}",
+        data=body,
+        headers={"Content-Type": "application/octet-stream"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=DETECT_SERVICE_TIMEOUT) as response:
+        return response.read()
+
+
+def detect_image(image_bytes: bytes, url: str = DETECT_SERVICE_URL) -> Optional[dict]:
+    """Detects objects in an encoded image with the detection service.
+
+    Returns height, width, boxes (ymin, xmin, ymax, xmax in image pixels),
+    classes, scores and attributes, or None if the request failed.
+    """
+    try:
+        return json.loads(post("/detect", image_bytes, url))
+    except Exception as e:
+        logger.error(f"Error calling detection service at {url}: {e}")
+        return None
+
+
+def infer_images(
+    images: np.ndarray, url: str = DETECT_SERVICE_URL
+) -> Dict[str, np.ndarray]:
+    """Raw serving outputs of a batch of preprocessed images, as runners return them."""
+    buffer = io.BytesIO()
+    np.save(buffer, images, allow_pickle=False)
+    outputs = np.load(io.BytesIO(post("/infer", buffer.getvalue(), url)))
+    return {key: outputs[key] for key in outputs.files}
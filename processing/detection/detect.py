@@ -3,17 +3,31 @@ import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 import glob
+import json
 import numpy as np
-import tensorflow as tf
 from PIL import Image
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from tqdm import tqdm
 from dotenv import load_dotenv
-from utils import mask_utils, box_utils
-from utils.object_detection import visualization_utils
+from utils import mask_utils
 from pycocotools import mask as mask_api
 from processing.logger import logger
+from processing.utils.blob_store import group_by_blob
+from batch_pipeline import BatchPipeline
+from preprocess import DETECT_IMAGE_SIZE, decode_job
+from detection_manifest import (
+    load_manifest,
+    save_manifest,
+    detection_config,
+    image_sha,
+    record_image_sha,
+    is_detected,
+    record_detection,
+)
+from result_store import DetectionStore, ShardWriter
 from datetime import timedelta
 import time
 import threading
@@ -28,17 +42,66 @@ LABEL_MAP_DIR = os.getenv("LABEL_MAP_DIR")
 LABEL_MAP_FILE = os.getenv("LABEL_MAP_FILE")
 MODEL_DIR = os.path.join(ROOT_DIR, os.getenv("MODEL_DIR"))
 
-DETECT_MAX_BOXES = os.getenv("DETECT_MAX_BOXES")
-DETECT_MIN_THRESH = os.getenv("DETECT_MIN_THRESH")
+DETECT_BATCH_SIZE = int(os.getenv("DETECT_BATCH_SIZE", 8))
+DETECT_DECODE_WORKERS = int(os.getenv("DETECT_DECODE_WORKERS", 4))
+DETECT_DECODE_EXECUTOR = os.getenv("DETECT_DECODE_EXECUTOR", "thread")
+DETECT_WRITE_WORKERS = int(os.getenv("DETECT_WRITE_WORKERS", 4))
+DETECT_QUEUE_SIZE = int(os.getenv("DETECT_QUEUE_SIZE", 64))
+DETECT_MAX_BOXES = int(os.getenv("DETECT_MAX_BOXES", 100))
+DETECT_MIN_THRESH = float(os.getenv("DETECT_MIN_THRESH", 0))
+DETECT_FILTER_CLASSES = os.getenv("DETECT_FILTER_CLASSES") == "True"
+TAXONOMY_PATH = os.path.join(ROOT_DIR, "processing/indexing/taxonomy.json")
 OVERWITE_DETECTION = os.getenv("OVERWITE_DETECTION") == "True"
 OUTPUT_SUBDIR = os.getenv("OUTPUT_SUBDIR")
 
-thread_local = threading.local()
+_runner = None
+_runner_lock = threading.Lock()
 
-def get_model(model_dir):
-    if not hasattr(thread_local, "model"):
-        thread_local.model = tf.saved_model.load(model_dir)
-    return thread_local.model
+
+def get_runner():
+    """Loads and warms up the configured runner once; every stage shares it."""
+    from runners import DETECT_RUNNER, start_runner
+
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = start_runner(DETECT_BATCH_SIZE, DETECT_IMAGE_SIZE, DETECT_RUNNER)
+        return _runner
+
+
+def load_class_allow_list():
+    """Detection classes that taxonomy.json maps product categories to, None if unfiltered."""
+    if not DETECT_FILTER_CLASSES:
+        return None
+    try:
+        with open(TAXONOMY_PATH, "r") as mapping_file:
+            taxonomy = json.load(mapping_file)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.error(f"Error loading taxonomy for class filtering: {e}")
+        return None
+    return sorted({int(code.split(": ")[0]) for code in taxonomy.values()})
+
+
+CLASS_ALLOW_LIST = load_class_allow_list()
+
+
+def select_detections(np_scores, np_classes):
+    """Indices of detections kept for post-processing, highest score first.
+
+    Applies DETECT_MIN_THRESH, the taxonomy class allow-list and then keeps
+    the top DETECT_MAX_BOXES.
+    """
+    keep = np_scores >= DETECT_MIN_THRESH
+    if CLASS_ALLOW_LIST is not None:
+        keep &= np.isin(np_classes, CLASS_ALLOW_LIST)
+    indices = np.nonzero(keep)[0]
+    indices = indices[np.argsort(-np_scores[indices], kind="stable")]
+    return indices[:DETECT_MAX_BOXES]
+
+
+def get_output_path(image_file):
+    output_dir = os.path.join(os.path.dirname(image_file), OUTPUT_SUBDIR)
+    return os.path.join(output_dir, os.path.basename(image_file) + ".npy")
 
 
 # def read_labels():
@@ -59,20 +122,6 @@ def get_model(model_dir):
 #     return label_map_dict
 
 
-def process_image(image_file):
-    """Processes an image file and returns it as a tensor."""
-    try:
-        image = Image.open(image_file).convert("RGB")
-        result = np.array(image)[:, :, :3]  # Remove alpha channel
-        # input_tensor = tf.convert_to_tensor(result[np.newaxis, :, :, :], dtype=tf.uint8)
-        input_tensor = tf.convert_to_tensor(result, dtype=tf.uint8)
-        logger.info(f"Processed image {image_file}")
-        return input_tensor, result.shape
-    except Exception as e:
-        logger.error(f"Error processing image {image_file}: {e}")
-        return None, None
-
-
 def adjust_boxes(np_boxes, image_info, width, height):
     """Adjusts bounding boxes to the dimensions of the image."""
     np_boxes = np_boxes / np.tile(image_info[1:2, :], (1, 2))
@@ -86,26 +135,36 @@ def adjust_boxes(np_boxes, image_info, width, height):
     return adjusted_boxes
 
 
-def process_masks(np_boxes, output_results, height, width):
-    """Processes instance masks if available in the model output."""
-    np_masks = output_results.get("detection_masks", None)
-    encoded_masks = None
-    if np_masks is not None:
-        np_masks = mask_utils.paste_instance_masks(
-            np_masks[0, : len(np_boxes)],
-            box_utils.yxyx_to_xywh(np_boxes),
-            height,
-            width,
+def process_masks(np_boxes, np_masks, height, width):
+    """Pastes and encodes the image's instance masks if the model outputs them.
+
+    Only the box-local crop of each mask is materialised and encoded straight
+    into the image frame.
+    """
+    if np_masks is None:
+        return None
+    from utils import box_utils
+
+    encoded_masks = []
+    for crop, offset in mask_utils.paste_instance_masks_cropped(
+        np_masks, box_utils.yxyx_to_xywh(np_boxes), height, width
+    ):
+        counts = mask_utils.encode_cropped_mask(crop, offset, height, width)
+        encoded_masks.append(
+            mask_api.frPyObjects(
+                {"counts": counts, "size": [height, width]}, height, width
+            )
         )
-        encoded_masks = [mask_api.encode(np.asfortranarray(mask)) for mask in np_masks]
-        logger.info("Masks processed successfully.")
-    return np_masks, encoded_masks
+    logger.info("Masks processed successfully.")
+    return encoded_masks
 
 
 def visualize_detections(
     result, np_boxes, np_classes, np_scores, label_map_dict, np_masks
 ):
     """Visualizes bounding boxes and labels on the image array."""
+    from utils.object_detection import visualization_utils
+
     image_with_detections = visualization_utils.visualize_boxes_and_labels_on_result(
         result,
         np_boxes,
@@ -121,37 +180,59 @@ def visualize_detections(
     return image_with_detections
 
 
-def infer_single_image(image_file, model_dir):
-    """Performs inference on a single image file and returns detection results."""
-    output_dir = os.path.join(os.path.dirname(image_file), OUTPUT_SUBDIR)
-    output_path = os.path.join(output_dir, os.path.basename(image_file) + ".npy")
-    if os.path.exists(output_path) and not OVERWITE_DETECTION:
-        logger.info(f"{output_path} exists, skipping detection")
+def infer_batch(runner, batch):
+    """Runs one serving call on a batch of preprocessed images.
+
+    `batch` holds (image group, (padded image, (height, width), scale)) pairs.
+    The last batch is padded with blank images so every call has the same shape,
+    except for runners that pad batches themselves, e.g. the detection service.
+    """
+    batch_size = (
+        len(batch) if getattr(runner, "pads_batches", False) else DETECT_BATCH_SIZE
+    )
+    images = np.zeros(
+        (batch_size, DETECT_IMAGE_SIZE, DETECT_IMAGE_SIZE, 3), dtype=np.uint8
+    )
+    for i, (_, (image, _, _)) in enumerate(batch):
+        images[i] = image
+
+    try:
+        return runner(images)
+    except Exception as e:
+        logger.error(f"Error during batch inference on {batch[0][0][0]}: {e}")
         return None
 
-    input_tensor, (height, width, _) = process_image(image_file)
-    input_tensor = tf.expand_dims(input_tensor, axis=0)
-    if input_tensor is None:
-        logger.info(f"Processing image {output_path} failed, skipping detection")
-        return None  # Skip if image processing failed
 
+def postprocess_detection(output_results, index, image_file, height, width, scale):
+    """Splits one image's detections out of a batched model output."""
     try:
-        model = get_model(model_dir)  # Retrieve thread-specific model instance
-        output_results = model.signatures["serving_default"](input_tensor)
-        num_detections = int(output_results["num_detections"][0])
-        np_boxes = output_results["detection_boxes"][0, :num_detections]
-        np_scores = output_results["detection_scores"][0, :num_detections].numpy()
-        np_classes = (
-            output_results["detection_classes"][0, :num_detections].numpy().astype(int)
-        )
+        num_detections = int(output_results["num_detections"][index])
+        np_scores = output_results["detection_scores"][index, :num_detections]
+        np_classes = output_results["detection_classes"][
+            index, :num_detections
+        ].astype(int)
+
+        # Drop detections index building will never use before any box or
+        # mask work
+        selected = select_detections(np_scores, np_classes)
+        np_scores = np_scores[selected]
+        np_classes = np_classes[selected]
+        np_boxes = output_results["detection_boxes"][index, selected]
         np_attributes = output_results.get("detection_attributes", None)
-
-        # Adjust bounding boxes
-        np_image_info = output_results["image_info"][0]
-        np_boxes = adjust_boxes(np_boxes, np_image_info, width, height)
+        if np_attributes is not None:
+            np_attributes = np_attributes[index, selected]
+        np_masks = output_results.get("detection_masks", None)
+        if np_masks is not None:
+            np_masks = np_masks[index, selected]
+
+        # Boxes are relative to the padded input, which spans
+        # DETECT_IMAGE_SIZE / scale pixels of the original image on each side
+        canvas_size = DETECT_IMAGE_SIZE / scale
+        np_image_info = output_results["image_info"][index]
+        np_boxes = adjust_boxes(np_boxes, np_image_info, canvas_size, canvas_size)
 
         # Process masks if available
-        np_masks, encoded_masks = process_masks(np_boxes, output_results, height, width)
+        encoded_masks = process_masks(np_boxes, np_masks, height, width)
 
         # Visualization
         # image_with_detections = visualize_detections(
@@ -165,10 +246,12 @@ def infer_single_image(image_file, model_dir):
 
         out = {
             "image_file": image_file,
+            "height": height,
+            "width": width,
             "boxes": np_boxes,
             "classes": np_classes,
             "scores": np_scores,
-            "attributes": np_attributes.numpy() if np_attributes is not None else None,
+            "attributes": np_attributes,
             "masks": encoded_masks,
             # "visualized_image": image_with_detections,
         }
@@ -181,24 +264,109 @@ def infer_single_image(image_file, model_dir):
         return None
 
 
-def save_detection(result):
-    """Saves the visualized image back to the original folder or a subdirectory."""
-    # Define the output path, using the original directory with a subdirectory for processed files
-    image_file = result["image_file"]
-    output_dir = os.path.join(os.path.dirname(image_file), OUTPUT_SUBDIR)
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, os.path.basename(image_file))
+def load_legacy_detection(image_file):
+    """Reads a pickled per-image .npy output written by earlier versions."""
+    detection_data = np.load(get_output_path(image_file), allow_pickle=True).item()
+    masks = detection_data.get("masks") or []
+    if masks:
+        height, width = masks[0]["size"]
+    else:
+        with Image.open(image_file) as image:
+            width, height = image.size
+    attributes = detection_data.get("attributes")
+    if attributes is not None:
+        attributes = np.asarray(attributes).reshape(-1, attributes.shape[-1])
+    return {
+        **detection_data,
+        "height": height,
+        "width": width,
+        "attributes": attributes,
+    }
+
+
+def import_legacy_detections(image_groups, shas, store, writer):
+    """Moves existing .npy outputs into the store so they are not detected again."""
+    imported = 0
+    for sha, group in zip(shas, image_groups):
+        legacy_path = get_output_path(group[0])
+        if sha in store or not os.path.exists(legacy_path):
+            continue
+        try:
+            writer.add(sha, group[0], load_legacy_detection(group[0]))
+            imported += 1
+        except Exception as e:
+            logger.error(f"Error importing detection output {legacy_path}: {e}")
+    writer.flush()
+    if imported:
+        logger.info(f"Imported {imported} legacy detection outputs into the store")
+    return imported
+
+
+def write_detection(job, processed, output_results, index, writer):
+    """Post-processes one image of a batch output and queues it for the store."""
+    sha, group = job
+    _, (height, width), scale = processed
+    result = postprocess_detection(
+        output_results, index, group[0], height, width, scale
+    )
+    if result:
+        writer.add(sha, group[0], result)
+    return result is not None
+
+
+def get_decode_executor():
+    """Process pool for decoding when DETECT_DECODE_EXECUTOR is "process".
+
+    Workers are spawned rather than forked since the model is already loaded.
+    A spawned worker re-imports this module as __mp_main__, so everything
+    that pulls in TensorFlow (runners, box_utils, visualization_utils) is
+    imported inside the functions using it. None lets the pipeline decode on
+    threads.
+    """
+    if DETECT_DECODE_EXECUTOR != "process":
+        return None
+    return ProcessPoolExecutor(
+        max_workers=DETECT_DECODE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
 
-    np.save(output_path, result)
-    logger.info(f"Saved detection output to {output_path}")
+def group_sha(manifest, group):
+    """Content hash of a group of paths sharing one blob, cached for every path.
 
-    # # Convert array to image and save
-    # visualized_image = Image.fromarray(result)
-    # visualized_image.save(output_path)
-    # logger.info(f"Saved visualized image to {output_path}")
+    Readers such as the v1 import list look detections up by image path.
+    """
+    sha = image_sha(manifest, group[0])
+    for image_file in group[1:]:
+        record_image_sha(manifest, image_file, sha)
+    return sha
+
+
+def plan_detection(image_groups, shas, manifest, store, config):
+    """Returns the (sha, group) jobs still to detect.
+
+    Images whose content is in the store under the same config are skipped,
+    and repeated content is only detected once.
+    """
+    jobs = []
+    pending = set()
+    for sha, group in zip(shas, image_groups):
+        if sha in pending:
+            continue
+        if (
+            not OVERWITE_DETECTION
+            and sha in store
+            and is_detected(manifest, sha, config)
+        ):
+            continue
+        pending.add(sha)
+        jobs.append((sha, group))
+    return jobs
 
 
 def main():
+    from runners import DETECT_RUNNER, runner_model_path
+
     # # Load the model
     # global MODEL
     # MODEL = tf.saved_model.load(MODEL_DIR)
@@ -207,27 +375,62 @@ def main():
     # image_pattern = "details/**/**/images/*.[jp][pn]g"
     image_pattern = os.path.join(ROOT_DIR, "details/**/**/images/*.[jp][pn]g")
     image_files = glob.glob(image_pattern)
-    results_lock = threading.Lock()
-    results = [0]
-
-    tf.config.run_functions_eagerly(True)
-
-    # Run inference with a ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = {
-            # executor.submit(infer_single_image, image_file, label_map_dict, MODEL): image_file
-            executor.submit(infer_single_image, image_file, MODEL_DIR): image_file
-            for image_file in image_files
-        }
-        for future in tqdm(futures, desc="Processing images"):
-            result = future.result()
+    # Images stored as the same blob are only run through the model once
+    image_groups = list(group_by_blob(image_files).values())
+    manifest = load_manifest()
+    config = detection_config(
+        runner_model_path(DETECT_RUNNER),
+        DETECT_RUNNER,
+        image_size=DETECT_IMAGE_SIZE,
+        min_thresh=DETECT_MIN_THRESH,
+        max_boxes=DETECT_MAX_BOXES,
+        classes=CLASS_ALLOW_LIST,
+    )
+    with ThreadPoolExecutor(max_workers=DETECT_DECODE_WORKERS) as executor:
+        shas = list(executor.map(partial(group_sha, manifest), image_groups))
+
+    store = DetectionStore()
+    writer = ShardWriter(
+        on_flush=lambda flushed: [
+            record_detection(manifest, sha, image_file, config)
+            for sha, image_file in flushed
+        ]
+    )
+    if import_legacy_detections(image_groups, shas, store, writer):
+        store.load()
 
-            if result:
-                save_detection(result)
-                with results_lock:
-                    results[0] += 1
+    jobs = plan_detection(image_groups, shas, manifest, store, config)
+    logger.info(
+        f"Found {len(image_files)} images, {len(image_groups)} distinct, {len(jobs)} to detect"
+    )
 
-    logger.info(f"Processed {results[0]} images")
+    counts = {"written": 0, "failed": 0}
+    try:
+        # Incremental runs with nothing new never pay for loading the model
+        if jobs:
+            # One shared, warmed-up model behind the configured runner
+            runner = get_runner()
+
+            # Decode pool -> batched inference on this thread -> mask encoding pool
+            pipeline = BatchPipeline(
+                decode=decode_job,
+                infer=partial(infer_batch, runner),
+                write=partial(write_detection, writer=writer),
+                batch_size=DETECT_BATCH_SIZE,
+                decode_workers=DETECT_DECODE_WORKERS,
+                write_workers=DETECT_WRITE_WORKERS,
+                queue_size=DETECT_QUEUE_SIZE,
+                decode_executor=get_decode_executor(),
+            )
+            counts = pipeline.run(tqdm(jobs, desc="Processing images"))
+    finally:
+        writer.flush()
+        save_manifest(manifest)
+
+    store.load()
+    store.compact()
+
+    logger.info(f"Processed {counts['written']} images, {counts['failed']} failed")
 
 
 if __name__ == "__main__":
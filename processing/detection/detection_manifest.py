@@ -0,0 +1,124 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import json
+from threading import Lock
+from typing import Dict
+from processing.logger import logger
+from processing.utils.utils import save_json
+from processing.utils.blob_store import file_sha256
+from processing.collection.manifest import content_hash, now
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+# Kept next to the outputs so it is synced with details/
+DETECTION_MANIFEST_PATH = os.path.join(ROOT_DIR, "details", "detection_manifest.json")
+DETECT_MODEL_VERSION = os.getenv("DETECT_MODEL_VERSION")
+
+manifest_lock = Lock()
+
+
+def load_manifest(path: str = DETECTION_MANIFEST_PATH) -> Dict[str, dict]:
+    """Loads the detection manifest, empty if missing.
+
+    `images` caches the content hash of each image path by size and mtime,
+    `detections` maps a content hash to the image and config it was detected with.
+    """
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logger.info(f"No detection manifest at {path}, starting a new one")
+        manifest = {}
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding detection manifest {path}: {e}")
+        manifest = {}
+    manifest.setdefault("images", {})
+    manifest.setdefault("detections", {})
+    return manifest
+
+
+def save_manifest(manifest: Dict[str, dict], path: str = DETECTION_MANIFEST_PATH):
+    with manifest_lock:
+        save_json(manifest, path)
+
+
+def model_version(model_path: str) -> str:
+    """DETECT_MODEL_VERSION if set, otherwise the hash of the exported graph.
+
+    `model_path` is a SavedModel directory or a single model file, e.g. a TFLite export.
+    """
+    if DETECT_MODEL_VERSION:
+        return DETECT_MODEL_VERSION
+    if os.path.isdir(model_path):
+        model_path = os.path.join(model_path, "saved_model.pb")
+    return file_sha256(model_path)
+
+
+def model_file_hash(model_path: str):
+    """Hash of the model file itself, None if it is not available locally."""
+    if os.path.isdir(model_path):
+        model_path = os.path.join(model_path, "saved_model.pb")
+    if not os.path.isfile(model_path):
+        logger.warning(f"No model file at {model_path} to hash for detection config")
+        return None
+    return file_sha256(model_path)
+
+
+def detection_config(model_path: str, backend: str, **settings) -> str:
+    """Hash of everything that changes detection outputs for the same image.
+
+    The backend and the model file hash are included even when
+    DETECT_MODEL_VERSION is set, since e.g. a TFLite export and its SavedModel
+    share a version but not their outputs.
+    """
+    return content_hash(
+        {
+            "model_version": model_version(model_path),
+            "model_hash": model_file_hash(model_path),
+            "backend": backend,
+            **settings,
+        }
+    )
+
+
+def image_sha(manifest: Dict[str, dict], image_file: str) -> str:
+    """Content hash of an image, reusing the cached hash while size and mtime match."""
+    rel_path = os.path.relpath(image_file, ROOT_DIR)
+    stat = os.stat(image_file)
+    cached = manifest["images"].get(rel_path)
+    if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+        return cached["sha"]
+
+    sha = file_sha256(image_file)
+    record_image_sha(manifest, image_file, sha, stat)
+    return sha
+
+
+def record_image_sha(manifest: Dict[str, dict], image_file: str, sha: str, stat=None):
+    """Caches the content hash of an image path, e.g. one sharing a hashed blob."""
+    stat = stat or os.stat(image_file)
+    with manifest_lock:
+        manifest["images"][os.path.relpath(image_file, ROOT_DIR)] = {
+            "sha": sha,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+
+
+def is_detected(manifest: Dict[str, dict], sha: str, config: str) -> bool:
+    entry = manifest["detections"].get(sha)
+    return bool(entry) and entry["config"] == config
+
+
+def record_detection(manifest: Dict[str, dict], sha: str, image_file: str, config: str):
+    with manifest_lock:
+        manifest["detections"][sha] = {
+            "image": os.path.relpath(image_file, ROOT_DIR),
+            "config": config,
+            "detected_at": now(),
+        }
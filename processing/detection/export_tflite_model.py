@@ -19,34 +19,123 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import glob
 import os
+import random
 
 from absl import flags
+from absl import logging
+import numpy as np
 import tensorflow.compat.v1 as tf
+import tensorflow.compat.v2 as tf2
+
+from preprocess import process_image
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string('saved_model_dir', None, 'The saved model directory.')
 flags.DEFINE_string('output_dir', None, 'The export tflite model directory.')
+flags.DEFINE_enum(
+    'quantization', 'none', ['none', 'dynamic', 'int8'],
+    'Post-training quantization: `none` keeps fp32, `dynamic` quantizes '
+    'weights to int8, `int8` also quantizes activations from a calibration '
+    'set and falls back to float for ops without int8 kernels.')
+flags.DEFINE_string(
+    'calibration_image_pattern',
+    os.path.join(ROOT_DIR, 'details/**/images/*.[jp][pn]g'),
+    'The glob of images to sample the int8 calibration set from.')
+flags.DEFINE_integer(
+    'num_calibration_images', 200, 'Number of images to calibrate int8 on.')
+flags.DEFINE_integer(
+    'calibration_seed', 0, 'Seed for sampling calibration images.')
+
+
+def serving_input_spec(saved_model_dir, signature_key='serving_default'):
+  """Returns the name and TensorSpec of the serving signature's image input."""
+  model = tf2.saved_model.load(saved_model_dir)
+  _, input_specs = model.signatures[signature_key].structured_input_signature
+  (name, spec), = input_specs.items()
+  return name, spec
+
+
+def calibration_dataset(saved_model_dir,
+                        image_pattern,
+                        num_images,
+                        seed=0):
+  """Returns a representative dataset of detection inputs for int8 calibration.
+
+  Images are preprocessed exactly as detect.py does, and batched to the
+  serving signature's batch size.
+  """
+  name, spec = serving_input_spec(saved_model_dir)
+  batch_size, image_size = spec.shape[0] or 1, spec.shape[1]
+  # Symlinked images of several products share one stored file
+  image_files = sorted(
+      {os.path.realpath(f) for f in glob.glob(image_pattern, recursive=True)})
+  image_files = random.Random(seed).sample(
+      image_files, min(num_images, len(image_files)))
+  if not image_files:
+    raise ValueError('No calibration images match %s' % image_pattern)
+  logging.info('Calibrating on %d images', len(image_files))
+
+  def dataset():
+    for start in range(0, len(image_files), batch_size):
+      images = np.zeros(
+          (batch_size, image_size, image_size, 3), dtype=np.uint8)
+      for i, image_file in enumerate(image_files[start:start + batch_size]):
+        processed = process_image(image_file, image_size)
+        if processed is not None:
+          images[i] = processed[0]
+      yield {name: images.astype(spec.dtype.as_numpy_dtype)}
+
+  return dataset
+
 
+def export(saved_model_dir,
+           tflite_model_dir,
+           quantization='none',
+           calibration_image_pattern=None,
+           num_calibration_images=200,
+           calibration_seed=0):
+  """Exports tflite model.
 
-def export(saved_model_dir, tflite_model_dir):
-  """Exports tflite model."""
-  converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+  Returns the path of the written model: model.tflite, or
+  model_<quantization>.tflite for quantized exports.
+  """
+  # The v2 converter keeps the serving signature, which runners.py calls.
+  converter = tf2.lite.TFLiteConverter.from_saved_model(
+      saved_model_dir, signature_keys=['serving_default'])
   converter.target_spec.supported_ops = [
       tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS
   ]
+  if quantization != 'none':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if quantization == 'int8':
+    converter.representative_dataset = calibration_dataset(
+        saved_model_dir, calibration_image_pattern, num_calibration_images,
+        calibration_seed)
 
   tflite_model = converter.convert()
-  tflite_model_path = os.path.join(tflite_model_dir, 'model.tflite')
+  model_name = ('model.tflite' if quantization == 'none' else
+                'model_%s.tflite' % quantization)
+  tflite_model_path = os.path.join(tflite_model_dir, model_name)
 
   with tf.gfile.GFile(tflite_model_path, 'wb') as f:
     f.write(tflite_model)
+  logging.info('Exported %s', tflite_model_path)
+  return tflite_model_path
 
 
 def main(argv):
   del argv  # Unused.
-  export(FLAGS.saved_model_dir, FLAGS.output_dir)
+  export(FLAGS.saved_model_dir,
+         FLAGS.output_dir,
+         FLAGS.quantization,
+         FLAGS.calibration_image_pattern,
+         FLAGS.num_calibration_images,
+         FLAGS.calibration_seed)
 
 
 if __name__ == '__main__':
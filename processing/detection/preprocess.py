@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import numpy as np
+from PIL import Image
+from processing.logger import logger
+from dotenv import load_dotenv
+
+# Kept free of TensorFlow so spawned decode workers start quickly
+
+load_dotenv()
+
+DETECT_IMAGE_SIZE = int(os.getenv("DETECT_IMAGE_SIZE", 640))
+
+
+def process_image(image_file, image_size=DETECT_IMAGE_SIZE):
+    """Resizes an image to fit the square serving size and pads the remainder.
+
+    JPEGs are decoded with DCT scaling at the smallest power-of-two reduction
+    still at least `image_size`, so large product photos are never decoded at
+    full resolution. Returns the padded uint8 array, the original
+    (height, width) and the resize scale from the original frame, or None if
+    the image could not be decoded.
+    """
+    try:
+        with Image.open(image_file) as image:
+            width, height = image.size
+            scale = image_size / max(height, width)
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # No-op for formats without reduced decoding, e.g. PNG
+            image.draft("RGB", target)
+            image = image.convert("RGB")
+            if image.size != target:
+                image = image.resize(target, Image.BILINEAR, reducing_gap=3.0)
+            padded = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+            padded[: target[1], : target[0]] = image
+        logger.info(f"Processed image {image_file}")
+        return padded, (height, width), scale
+    except Exception as e:
+        logger.error(f"Error processing image {image_file}: {e}")
+        return None
+
+
+def decode_job(job):
+    """Decodes the first image of a (sha, image_group) detection job."""
+    _, group = job
+    return process_image(group[0])
@@ -0,0 +1,250 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import glob
+import shutil
+import numpy as np
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+from processing.logger import logger
+from processing.utils.utils import record_removed
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+DETECTION_STORE_DIR = os.path.join(ROOT_DIR, "detections")
+DETECT_SHARD_SIZE = int(os.getenv("DETECT_SHARD_SIZE", 5000))
+DETECT_MAX_SHARDS = int(os.getenv("DETECT_MAX_SHARDS", 32))
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("sha", "S64"),
+        ("start", "<i8"),
+        ("count", "<i4"),
+        ("height", "<i4"),
+        ("width", "<i4"),
+    ]
+)
+
+
+def write_shard(shard_dir: str, results: List[tuple]):
+    """Writes (sha, result) pairs as one immutable shard.
+
+    Detections of all images are concatenated into fixed-dtype arrays, RLE mask
+    counts into masks.bin, and index.npy holds each image's row range.
+    """
+    index = np.zeros(len(results), dtype=INDEX_DTYPE)
+    boxes, scores, classes, attributes, masks = [], [], [], [], []
+    start = 0
+    for i, (sha, result) in enumerate(results):
+        count = len(result["scores"])
+        index[i] = (sha.encode(), start, count, result["height"], result["width"])
+        start += count
+        boxes.append(
+            np.asarray(result["boxes"], dtype=np.float32).reshape(count, 4)
+        )
+        scores.append(np.asarray(result["scores"], dtype=np.float32))
+        classes.append(np.asarray(result["classes"], dtype=np.int32))
+        result_attributes = result.get("attributes")
+        if result_attributes is not None and np.size(result_attributes):
+            attributes.append(
+                np.asarray(result_attributes, dtype=np.float32)[:count]
+            )
+        else:
+            attributes.append(None)
+        encoded = result.get("masks") or []
+        masks.extend(mask["counts"] for mask in encoded)
+        masks.extend(b"" for _ in range(count - len(encoded)))
+
+    num_attributes = max((a.shape[-1] for a in attributes if a is not None), default=0)
+    attributes = [
+        a if a is not None else np.zeros((len(s), num_attributes), dtype=np.float32)
+        for a, s in zip(attributes, scores)
+    ]
+    mask_offsets = np.zeros(len(masks) + 1, dtype=np.int64)
+    mask_offsets[1:] = np.cumsum([len(counts) for counts in masks])
+
+    arrays = {
+        "index": index,
+        "boxes": np.concatenate(boxes or [np.zeros((0, 4), np.float32)]),
+        "scores": np.concatenate(scores or [np.zeros(0, np.float32)]),
+        "classes": np.concatenate(classes or [np.zeros(0, np.int32)]),
+        "attributes": np.concatenate(attributes or [np.zeros((0, 0), np.float32)]),
+        "mask_offsets": mask_offsets,
+    }
+
+    temp_dir = os.path.join(
+        os.path.dirname(shard_dir), f".{os.path.basename(shard_dir)}"
+    )
+    os.makedirs(temp_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_dir, f"{name}.npy"), array)
+    with open(os.path.join(temp_dir, "masks.bin"), "wb") as f:
+        f.writelines(masks)
+    os.replace(temp_dir, shard_dir)
+
+
+def new_shard_name() -> str:
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+    return f"shard-{timestamp}-{os.getpid()}"
+
+
+class DetectionStore:
+    """Read side of the sharded detection store, keyed by image content hash.
+
+    Shards are memory-mapped and later shards win when an image was
+    detected more than once.
+    """
+
+    def __init__(self, store_dir: str = DETECTION_STORE_DIR):
+        self.store_dir = store_dir
+        self.shards: List[Dict[str, np.ndarray]] = []
+        self.entries: Dict[str, tuple] = {}  # sha -> shard, start, count, height, width
+        self.load()
+
+    def load(self):
+        self.shards = []
+        self.entries = {}
+        for shard_dir in sorted(glob.glob(os.path.join(self.store_dir, "shard-*"))):
+            index = np.load(os.path.join(shard_dir, "index.npy"))
+            shard = {"dir": shard_dir}
+            shard_id = len(self.shards)
+            self.shards.append(shard)
+            for sha, start, count, height, width in index.tolist():
+                self.entries[sha.decode()] = (shard_id, start, count, height, width)
+        logger.info(
+            f"Loaded detection store with {len(self.entries)} images in {len(self.shards)} shards"
+        )
+
+    def _array(self, shard_id: int, name: str) -> np.ndarray:
+        shard = self.shards[shard_id]
+        if name not in shard:
+            shard[name] = np.load(
+                os.path.join(shard["dir"], f"{name}.npy"), mmap_mode="r"
+            )
+        return shard[name]
+
+    def __contains__(self, sha: str) -> bool:
+        return sha in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, sha: str) -> Optional[dict]:
+        """Boxes (ymin, xmin, ymax, xmax), scores, classes and attributes of an image."""
+        entry = self.entries.get(sha)
+        if entry is None:
+            return None
+        shard_id, start, count, height, width = entry
+        rows = slice(start, start + count)
+        return {
+            "boxes": self._array(shard_id, "boxes")[rows],
+            "scores": self._array(shard_id, "scores")[rows],
+            "classes": self._array(shard_id, "classes")[rows],
+            "attributes": self._array(shard_id, "attributes")[rows],
+            "height": height,
+            "width": width,
+        }
+
+    def get_masks(self, sha: str) -> List[dict]:
+        """RLE masks of an image in pycocotools form, empty counts where none was kept."""
+        entry = self.entries.get(sha)
+        if entry is None:
+            return []
+        shard_id, start, count, height, width = entry
+        offsets = self._array(shard_id, "mask_offsets")[start : start + count + 1]
+        with open(os.path.join(self.shards[shard_id]["dir"], "masks.bin"), "rb") as f:
+            f.seek(int(offsets[0]))
+            data = f.read(int(offsets[-1] - offsets[0]))
+        return [
+            {
+                "size": [height, width],
+                "counts": data[offsets[i] - offsets[0] : offsets[i + 1] - offsets[0]],
+            }
+            for i in range(count)
+        ]
+
+    def largest_box(self, sha: str, class_id: int) -> Optional[tuple]:
+        """Largest (x1, y1, x2, y2) box of `class_id` in an image, if any."""
+        detections = self.get(sha)
+        if detections is None:
+            return None
+        boxes = detections["boxes"][detections["classes"] == class_id].astype(int)
+        if not len(boxes):
+            return None
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        y1, x1, y2, x2 = boxes[np.argmax(areas)]
+        return int(x1), int(y1), int(x2), int(y2)
+
+    def compact(self, max_shards: int = DETECT_MAX_SHARDS):
+        """Merges all shards into one once there are more than `max_shards`."""
+        if len(self.shards) <= max_shards:
+            return
+        results = [
+            (sha, {**self.get(sha), "masks": self.get_masks(sha)})
+            for sha in self.entries
+        ]
+        name = new_shard_name()
+        write_shard(os.path.join(self.store_dir, name), results)
+        # Recorded first so the shards' copies in GCS are deleted on the next sync
+        record_removed(
+            self.store_dir,
+            name,
+            [
+                path
+                for shard in self.shards
+                for path in glob.glob(os.path.join(shard["dir"], "*"))
+            ],
+        )
+        for shard in self.shards:
+            shutil.rmtree(shard["dir"])
+        logger.info(f"Compacted {len(self.shards)} detection shards")
+        self.load()
+
+
+class ShardWriter:
+    """Buffers detection results and flushes them as shards of `shard_size` images.
+
+    `on_flush` is called with the (sha, image_file) pairs of each flushed shard,
+    once they are durable.
+    """
+
+    def __init__(
+        self,
+        store_dir: str = DETECTION_STORE_DIR,
+        shard_size: int = DETECT_SHARD_SIZE,
+        on_flush: Callable[[List[tuple]], None] = None,
+    ):
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        self.on_flush = on_flush
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.buffer: List[tuple] = []
+
+    def add(self, sha: str, image_file: str, result: dict):
+        with self.lock:
+            self.buffer.append((sha, image_file, result))
+            if len(self.buffer) < self.shard_size:
+                return
+            buffer, self.buffer = self.buffer, []
+        self._write(buffer)
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if buffer:
+            self._write(buffer)
+
+    def _write(self, buffer: List[tuple]):
+        with self.flush_lock:
+            os.makedirs(self.store_dir, exist_ok=True)
+            shard_dir = os.path.join(self.store_dir, new_shard_name())
+            write_shard(shard_dir, [(sha, result) for sha, _, result in buffer])
+            logger.info(f"Wrote {len(buffer)} detections to {shard_dir}")
+            if self.on_flush:
+                self.on_flush([(sha, image_file) for sha, image_file, _ in buffer])
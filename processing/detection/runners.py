@@ -0,0 +1,239 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import json
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import (
+    convert_variables_to_constants_v2,
+)
+from typing import Dict
+from processing.logger import logger
+from processing.collection.manifest import content_hash
+from detection_manifest import model_version
+from client import DETECT_SERVICE_URL, infer_images
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+MODEL_DIR = os.path.join(ROOT_DIR, os.getenv("MODEL_DIR", ""))
+
+# "saved_model", "tflite" or "service"
+DETECT_RUNNER = os.getenv("DETECT_RUNNER", "saved_model")
+DETECT_TFLITE_MODEL = os.path.join(ROOT_DIR, os.getenv("DETECT_TFLITE_MODEL", ""))
+DETECT_TFLITE_THREADS = int(os.getenv("DETECT_TFLITE_THREADS", os.cpu_count() or 1))
+DETECT_TFLITE_XNNPACK = os.getenv("DETECT_TFLITE_XNNPACK", "True") == "True"
+DETECT_WARMUP_RUNS = int(os.getenv("DETECT_WARMUP_RUNS", 1))
+# Frozen serving graphs, keyed by model version and TensorFlow version
+DETECT_GRAPH_CACHE = os.getenv("DETECT_GRAPH_CACHE", "True") == "True"
+DETECT_GRAPH_CACHE_DIR = os.path.join(
+    ROOT_DIR, os.getenv("DETECT_GRAPH_CACHE_DIR", "processing/detection/graph_cache")
+)
+
+
+class SavedModelRunner:
+    """Runs the serving signature of an exported SavedModel."""
+
+    def __init__(self, model_dir: str = MODEL_DIR, signature: str = "serving_default"):
+        self.model_path = model_dir
+        self.model = tf.saved_model.load(model_dir)
+        self.infer = self.model.signatures[signature]
+
+    def __call__(self, images: np.ndarray) -> Dict[str, np.ndarray]:
+        outputs = self.infer(tf.constant(images))
+        return {key: value.numpy() for key, value in outputs.items()}
+
+
+class FrozenGraphRunner:
+    """Runs a serving signature frozen by `freeze_saved_model`.
+
+    Importing one constant GraphDef skips restoring the SavedModel's object
+    graph, variables and unused functions, so it loads much faster.
+    """
+
+    def __init__(self, graph_path: str):
+        self.model_path = graph_path
+        graph_def = tf.compat.v1.GraphDef()
+        with open(graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        with open(signature_path(graph_path), "r") as f:
+            signature = json.load(f)
+
+        wrapped = tf.compat.v1.wrap_function(
+            lambda: tf.compat.v1.import_graph_def(graph_def, name=""), []
+        )
+        graph = wrapped.graph
+        self.infer = wrapped.prune(
+            graph.get_tensor_by_name(signature["input"]),
+            {
+                key: graph.get_tensor_by_name(name)
+                for key, name in signature["outputs"].items()
+            },
+        )
+
+    def __call__(self, images: np.ndarray) -> Dict[str, np.ndarray]:
+        outputs = self.infer(tf.constant(images))
+        return {key: value.numpy() for key, value in outputs.items()}
+
+
+class TFLiteRunner:
+    """Runs the serving signature of a TFLite export on CPU.
+
+    XNNPACK is the interpreter's default delegate and picks up float and int8
+    kernels it supports; `num_threads` sizes both its pool and the builtin
+    kernels'. Ops left to TF Select run through the Flex delegate.
+    """
+
+    def __init__(
+        self,
+        model_path: str = DETECT_TFLITE_MODEL,
+        num_threads: int = DETECT_TFLITE_THREADS,
+        xnnpack: bool = DETECT_TFLITE_XNNPACK,
+        signature: str = "serving_default",
+    ):
+        self.model_path = model_path
+        resolver = tf.lite.experimental.OpResolverType
+        self.interpreter = tf.lite.Interpreter(
+            model_path=model_path,
+            num_threads=num_threads,
+            experimental_op_resolver_type=(
+                resolver.AUTO if xnnpack else resolver.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+            ),
+        )
+        self.infer = self.interpreter.get_signature_runner(signature)
+        self.input_name = next(iter(self.infer.get_input_details()))
+        # Interpreters are not thread safe
+        self.lock = threading.Lock()
+
+    def __call__(self, images: np.ndarray) -> Dict[str, np.ndarray]:
+        with self.lock:
+            outputs = self.infer(**{self.input_name: images})
+        # Output buffers are reused by the next call
+        return {key: np.array(value) for key, value in outputs.items()}
+
+
+class ServiceRunner:
+    """Runs batches on a resident detection service (service.py).
+
+    The service batches them together with other clients' requests on its
+    single warm model and pads those batches itself, so callers send only
+    their real images.
+    """
+
+    pads_batches = True
+
+    def __init__(self, url: str = DETECT_SERVICE_URL):
+        self.model_path = url
+
+    def __call__(self, images: np.ndarray) -> Dict[str, np.ndarray]:
+        return infer_images(images, self.model_path)
+
+
+def signature_path(graph_path: str) -> str:
+    return f"{os.path.splitext(graph_path)[0]}.json"
+
+
+def graph_cache_path(model_dir: str) -> str:
+    key = content_hash(
+        {"model_version": model_version(model_dir), "tensorflow": tf.__version__}
+    )
+    return os.path.join(DETECT_GRAPH_CACHE_DIR, f"{key[:16]}.pb")
+
+
+def freeze_saved_model(
+    model_dir: str, graph_path: str, signature: str = "serving_default"
+):
+    """Freezes a SavedModel signature's variables into a GraphDef at `graph_path`.
+
+    The input and output tensor names are written next to it for FrozenGraphRunner.
+    """
+    infer = tf.saved_model.load(model_dir).signatures[signature]
+    frozen = convert_variables_to_constants_v2(infer)
+    (image_input,) = [tensor for tensor in frozen.inputs if tensor.dtype != tf.resource]
+    names = {
+        "input": image_input.name,
+        "outputs": {
+            key: tensor.name for key, tensor in frozen.structured_outputs.items()
+        },
+    }
+
+    os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+    temp_path = f"{graph_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(frozen.graph.as_graph_def().SerializeToString())
+    with open(signature_path(graph_path), "w") as f:
+        json.dump(names, f)
+    os.replace(temp_path, graph_path)
+    logger.info(f"Froze {model_dir} serving graph to {graph_path}")
+
+
+def load_saved_model_runner(model_dir: str):
+    """Loads the frozen graph of a SavedModel, freezing it on first use.
+
+    Falls back to the SavedModel when the graph cache is off or freezing fails.
+    """
+    if not DETECT_GRAPH_CACHE:
+        return SavedModelRunner(model_dir)
+    try:
+        graph_path = graph_cache_path(model_dir)
+        if not os.path.exists(graph_path):
+            freeze_saved_model(model_dir, graph_path)
+        return FrozenGraphRunner(graph_path)
+    except Exception as e:
+        logger.error(
+            f"Error loading frozen graph of {model_dir}, using the SavedModel: {e}"
+        )
+        return SavedModelRunner(model_dir)
+
+
+def runner_model_path(backend: str = DETECT_RUNNER) -> str:
+    """Model directory or file the configured runner serves.
+
+    The detection service is assumed to serve MODEL_DIR of the same .env.
+    """
+    return DETECT_TFLITE_MODEL if backend == "tflite" else MODEL_DIR
+
+
+def load_runner(backend: str = DETECT_RUNNER, model_path: str = None):
+    """Loads a runner for `backend`, from its configured model unless given one."""
+    if backend == "service":
+        logger.info(f"Using the detection service at {DETECT_SERVICE_URL}")
+        return ServiceRunner()
+    model_path = model_path or runner_model_path(backend)
+    logger.info(f"Loading {backend} detection runner from {model_path}")
+    if backend == "tflite":
+        return TFLiteRunner(model_path)
+    if backend == "saved_model":
+        return load_saved_model_runner(model_path)
+    raise ValueError(f"Unknown detection runner {backend}")
+
+
+def warm_up(runner, batch_size: int, image_size: int, runs: int = DETECT_WARMUP_RUNS):
+    """Runs blank batches at the serving shape.
+
+    Tracing, graph optimization and kernel selection are then paid before the
+    first real batch instead of inside it.
+    """
+    images = np.zeros((batch_size, image_size, image_size, 3), dtype=np.uint8)
+    for _ in range(runs):
+        runner(images)
+
+
+def start_runner(batch_size: int, image_size: int, backend: str = DETECT_RUNNER):
+    """Loads and warms up a runner, logging the startup time it took."""
+    start_time = time.perf_counter()
+    runner = load_runner(backend)
+    load_time = time.perf_counter() - start_time
+    warm_up(runner, batch_size, image_size)
+    startup_time = time.perf_counter() - start_time
+    logger.info(
+        f"Detection startup time: {startup_time:.2f}s "
+        f"(load {load_time:.2f}s, warm-up {startup_time - load_time:.2f}s, "
+        f"{type(runner).__name__} from {runner.model_path})"
+    )
+    return runner
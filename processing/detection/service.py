@@ -0,0 +1,235 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import io
+import json
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from processing.logger import logger
+from preprocess import process_image
+from detect import (
+    DETECT_BATCH_SIZE,
+    DETECT_IMAGE_SIZE,
+    adjust_boxes,
+    select_detections,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DETECT_SERVICE_HOST = os.getenv("DETECT_SERVICE_HOST", "127.0.0.1")
+DETECT_SERVICE_PORT = int(os.getenv("DETECT_SERVICE_PORT", 8501))
+# The service must run a local model, never "service" itself
+DETECT_SERVICE_RUNNER = os.getenv("DETECT_SERVICE_RUNNER", "saved_model")
+DETECT_SERVICE_MAX_LATENCY_MS = float(os.getenv("DETECT_SERVICE_MAX_LATENCY_MS", 10))
+DETECT_SERVICE_QUEUE_SIZE = int(os.getenv("DETECT_SERVICE_QUEUE_SIZE", 256))
+DETECT_SERVICE_TIMEOUT = float(os.getenv("DETECT_SERVICE_TIMEOUT", 60))
+
+
+class DynamicBatcher:
+    """Groups concurrently submitted images into batches for one runner.
+
+    A batch is run as soon as `batch_size` images are waiting, or
+    `max_latency` seconds after its first image arrived, whichever is first.
+    Batches are padded to `batch_size` so every call has the serving shape.
+    """
+
+    def __init__(
+        self,
+        runner,
+        batch_size: int = DETECT_BATCH_SIZE,
+        image_size: int = DETECT_IMAGE_SIZE,
+        max_latency: float = DETECT_SERVICE_MAX_LATENCY_MS / 1000,
+        queue_size: int = DETECT_SERVICE_QUEUE_SIZE,
+    ):
+        self.runner = runner
+        self.batch_size = batch_size
+        self.image_size = image_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray) -> Future:
+        """Queues one preprocessed image; the future resolves to its outputs.
+
+        Raises ValueError for an image not of the serving shape, which would
+        otherwise fail the whole batch it lands in.
+        """
+        self.check_shape(image)
+        future = Future()
+        self.requests.put((image, future))
+        return future
+
+    def check_shape(self, image: np.ndarray):
+        shape = (self.image_size, self.image_size, 3)
+        if np.shape(image) != shape:
+            raise ValueError(
+                f"Expected an image of shape {shape}, got {np.shape(image)}"
+            )
+
+    def _collect(self) -> List[tuple]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # A bad batch only fails its own requests, never the batching thread
+            try:
+                images = np.zeros(
+                    (self.batch_size, self.image_size, self.image_size, 3),
+                    dtype=np.uint8,
+                )
+                for i, (image, _) in enumerate(batch):
+                    images[i] = image
+                outputs = self.runner(images)
+            except Exception as e:
+                logger.error(
+                    f"Error during batch inference of {len(batch)} requests: {e}"
+                )
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                future.set_result({key: value[i] for key, value in outputs.items()})
+
+
+def detection_response(outputs: Dict[str, np.ndarray], height, width, scale) -> dict:
+    """Selected detections of one image in original image pixels."""
+    selected = select_detections(
+        outputs["detection_scores"][: int(outputs["num_detections"])],
+        outputs["detection_classes"][: int(outputs["num_detections"])].astype(int),
+    )
+    # Boxes are relative to the padded input, see detect.postprocess_detection
+    canvas_size = DETECT_IMAGE_SIZE / scale
+    boxes = adjust_boxes(
+        outputs["detection_boxes"][selected],
+        outputs["image_info"],
+        canvas_size,
+        canvas_size,
+    )
+    attributes = outputs.get("detection_attributes")
+    return {
+        "height": height,
+        "width": width,
+        "boxes": boxes.tolist(),
+        "classes": outputs["detection_classes"][selected].astype(int).tolist(),
+        "scores": outputs["detection_scores"][selected].tolist(),
+        "attributes": attributes[selected].tolist() if attributes is not None else None,
+    }
+
+
+class DetectionHandler(BaseHTTPRequestHandler):
+    """HTTP front of the dynamic batcher.
+
+    POST /detect takes an encoded image and returns its detections as JSON.
+    POST /infer takes a .npy batch of preprocessed images and returns the raw
+    serving outputs as .npz, so detect.py can share the service's model.
+    Clients send only real images, the batcher pads batches itself.
+    GET /health reports the runner being served.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        runner = self.server.batcher.runner
+        self.respond(
+            200,
+            "application/json",
+            json.dumps(
+                {"runner": type(runner).__name__, "model_path": runner.model_path}
+            ).encode(),
+        )
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.path == "/detect":
+                self.detect(body)
+            elif self.path == "/infer":
+                self.infer(body)
+            else:
+                self.send_error(404)
+        except ValueError as e:
+            # Malformed input, e.g. an image not of the serving shape
+            self.send_error(400, str(e))
+        except Exception as e:
+            logger.error(f"Error handling {self.path}: {e}")
+            self.send_error(500, str(e))
+
+    def detect(self, body: bytes):
+        processed = process_image(io.BytesIO(body))
+        if processed is None:
+            self.send_error(400, "Could not decode image")
+            return
+        image, (height, width), scale = processed
+        outputs = self.server.batcher.submit(image).result(DETECT_SERVICE_TIMEOUT)
+        response = detection_response(outputs, height, width, scale)
+        self.respond(200, "application/json", json.dumps(response).encode())
+
+    def infer(self, body: bytes):
+        batcher = self.server.batcher
+        images = np.load(io.BytesIO(body), allow_pickle=False)
+        if images.ndim != 4 or not len(images):
+            raise ValueError(f"Expected a batch of images, got {images.shape}")
+        # Checked up front so a bad request queues none of its images
+        for image in images:
+            batcher.check_shape(image)
+        futures = [batcher.submit(image) for image in images]
+        outputs = [future.result(DETECT_SERVICE_TIMEOUT) for future in futures]
+        stacked = {
+            key: np.stack([output[key] for output in outputs]) for key in outputs[0]
+        }
+        buffer = io.BytesIO()
+        np.savez(buffer, **stacked)
+        self.respond(200, "application/octet-stream", buffer.getvalue())
+
+    def respond(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def serve(host: str = DETECT_SERVICE_HOST, port: int = DETECT_SERVICE_PORT):
+    """Loads and warms up one model, then serves it until interrupted."""
+    from runners import start_runner
+
+    runner = start_runner(DETECT_BATCH_SIZE, DETECT_IMAGE_SIZE, DETECT_SERVICE_RUNNER)
+    server = ThreadingHTTPServer((host, port), DetectionHandler)
+    server.daemon_threads = True
+    server.batcher = DynamicBatcher(runner)
+    logger.info(f"Detection service listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Detection service stopped")
+
+
+if __name__ == "__main__":
+    serve()
@@ -107,6 +107,103 @@ def paste_instance_masks(masks,
   return segms
 
 
+def paste_instance_masks_cropped(masks,
+                                 detected_boxes,
+                                 image_height,
+                                 image_width):
+  """Paste instance masks, materialising only the box-local region of each.
+
+  Produces the same pixels as `paste_instance_masks`, but instead of one
+  `image_height x image_width` canvas per detection it returns the clipped
+  crop and its offset into the image frame.
+
+  Args:
+    masks: a numpy array of shape [N, mask_height, mask_width] representing the
+      instance masks w.r.t. the `detected_boxes`.
+    detected_boxes: a numpy array of shape [N, 4] representing the reference
+      bounding boxes.
+    image_height: an integer representing the height of the image.
+    image_width: an integer representing the width of the image.
+
+  Returns:
+    crops: a list of N (mask, (y_0, x_0)) tuples, where `mask` is a uint8 array
+      holding the pasted mask inside the image starting at row y_0, column x_0.
+  """
+  _, mask_height, mask_width = masks.shape
+  scale = max((mask_width + 2.0) / mask_width,
+              (mask_height + 2.0) / mask_height)
+
+  # Same expansion as paste_instance_masks, see the note there.
+  w_half = detected_boxes[:, 2] * .5 * scale
+  h_half = detected_boxes[:, 3] * .5 * scale
+  x_c = detected_boxes[:, 0] + detected_boxes[:, 2] * .5
+  y_c = detected_boxes[:, 1] + detected_boxes[:, 3] * .5
+  ref_boxes = np.stack(
+      [x_c - w_half, y_c - h_half, x_c + w_half, y_c + h_half],
+      axis=-1).astype(np.int32)
+
+  padded_mask = np.zeros((mask_height + 2, mask_width + 2), dtype=np.float32)
+  crops = []
+  for mask, ref_box in zip(masks, ref_boxes):
+    x_0 = min(max(ref_box[0], 0), image_width)
+    x_1 = min(max(ref_box[2] + 1, 0), image_width)
+    y_0 = min(max(ref_box[1], 0), image_height)
+    y_1 = min(max(ref_box[3] + 1, 0), image_height)
+    if x_1 <= x_0 or y_1 <= y_0:
+      crops.append((np.zeros((0, 0), dtype=np.uint8), (y_0, x_0)))
+      continue
+
+    padded_mask[1:-1, 1:-1] = mask
+    w = max(ref_box[2] - ref_box[0] + 1, 1)
+    h = max(ref_box[3] - ref_box[1] + 1, 1)
+    resized = cv2.resize(padded_mask, (w, h))
+    crop = resized[(y_0 - ref_box[1]):(y_1 - ref_box[1]),
+                   (x_0 - ref_box[0]):(x_1 - ref_box[0])]
+    crops.append((np.array(crop > 0.5, dtype=np.uint8), (y_0, x_0)))
+  return crops
+
+
+def encode_cropped_mask(crop, offset, image_height, image_width):
+  """Run-length encodes a cropped mask in the column-major COCO layout.
+
+  The runs are computed from the crop and its offset alone, so the full
+  image-sized mask is never built.
+
+  Args:
+    crop: a uint8 array of shape [h, w] holding the mask inside the image.
+    offset: the (y_0, x_0) position of the crop's top-left pixel.
+    image_height: an integer representing the height of the image.
+    image_width: an integer representing the width of the image.
+
+  Returns:
+    counts: a list of alternating zero/one run lengths, starting with zeros,
+      as accepted by pycocotools `frPyObjects` in the 'counts' field.
+  """
+  y_0, x_0 = offset
+  total = image_height * image_width
+  if not crop.size:
+    return [total]
+
+  # Row changes within each column, including leaving the crop at the bottom.
+  changes = np.diff(np.pad(crop.astype(np.int8), ((1, 1), (0, 0))), axis=0)
+  cols, rows = np.nonzero(changes.T)
+  positions = (x_0 + cols).astype(np.int64) * image_height + y_0 + rows
+
+  # A run ending at the bottom of one column and one starting at the top of
+  # the next meet at the same position and cancel out.
+  keep = np.ones(len(positions), dtype=bool)
+  repeated = np.nonzero(positions[1:] == positions[:-1])[0]
+  keep[repeated] = False
+  keep[repeated + 1] = False
+  positions = positions[keep]
+
+  counts = np.diff(np.concatenate([[0], positions, [total]]))
+  # COCO omits the empty trailing run when the mask covers the last pixel.
+  if len(counts) > 1 and counts[-1] == 0:
+    counts = counts[:-1]
+  return counts.tolist()
+
+
 def paste_instance_masks_v2(masks,
                             detected_boxes,
                             image_height,
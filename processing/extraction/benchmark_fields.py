@@ -0,0 +1,89 @@
+import os
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.append(ROOT_DIR)
+
+import argparse
+import glob
+import json
+import time
+from jsonpath_ng.ext import parse
+from processing.extraction.fields import (
+    collect_fields,
+    build_product_info,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DETAILS_FILENAME = os.getenv("DETAILS_FILENAME")
+
+# The JSONPath queries extraction used before the single-pass walker
+BASIC_PARSER = parse("$..basicInfo")
+PARENT_ID_PARSER = parse("$..parentID")
+DESC_PARSER = parse("$..content[?(@.title=='Deskripsi')].subtitle")
+CHILD_PARSER = parse("$..pdpGetLayout..children[*]")
+PRICE_PARSER = parse("$..price.value")
+
+
+def jsonpath_fields(product_json):
+    """Collects the same fields as `collect_fields` with the JSONPath parsers."""
+    first = lambda matches: matches[0].value if matches else None
+    return {
+        "basic_info": first(BASIC_PARSER.find(product_json)),
+        "parent_id": first(PARENT_ID_PARSER.find(product_json)),
+        "description": first(DESC_PARSER.find(product_json)),
+        "children": [child.value for child in CHILD_PARSER.find(product_json)],
+        "price": first(PRICE_PARSER.find(product_json)),
+    }
+
+
+def time_extractor(extract, documents, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        results = [build_product_info(extract(document)) for document in documents]
+    return (time.perf_counter() - start_time) / repeat, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the single-pass extractor against the JSONPath parsers."
+    )
+    parser.add_argument(
+        "--pattern",
+        default=os.path.join(ROOT_DIR, "details", "**", "**", DETAILS_FILENAME),
+        help="Glob of details files to benchmark on",
+    )
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(args.pattern))[: args.limit]
+    if not files:
+        print(f"No details files match {args.pattern}")
+        return
+
+    documents = []
+    for file in files:
+        with open(file, "r") as f:
+            documents.append(json.load(f))
+    size_mb = sum(os.path.getsize(file) for file in files) / 1e6
+
+    jsonpath_time, expected = time_extractor(jsonpath_fields, documents, args.repeat)
+    walker_time, actual = time_extractor(collect_fields, documents, args.repeat)
+    mismatches = [
+        file for file, a, b in zip(files, expected, actual) if a != b
+    ]
+
+    print(f"Files: {len(files)} ({size_mb:.1f} MB)")
+    print(f"jsonpath_ng:  {jsonpath_time:.3f}s ({jsonpath_time / len(files) * 1e3:.2f} ms/file)")
+    print(f"single pass:  {walker_time:.3f}s ({walker_time / len(files) * 1e3:.2f} ms/file)")
+    print(f"Speedup:      {jsonpath_time / walker_time:.1f}x")
+    print(f"Mismatches:   {len(mismatches)}")
+    for file in mismatches[:10]:
+        print(f"  {file}")
+
+
+if __name__ == "__main__":
+    main()
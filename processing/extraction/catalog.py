@@ -0,0 +1,259 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+import glob
+import polars as pl
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+from processing.logger import logger
+from processing.utils.blob_store import group_by_blob, storage_path
+from processing.utils.utils import create_dir_if_not_exists, record_removed
+from processing.detection.detection_manifest import load_manifest
+from processing.detection.result_store import DetectionStore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CATALOG_DIR = os.path.join(ROOT_DIR, "catalog")
+CATALOG_MAX_PARTS = int(os.getenv("CATALOG_MAX_PARTS", 16))
+
+IMAGE_PATTERN = "*.[jp][pn]g"
+
+# The brand column comes from the brand=<brand> partition directory
+CATALOG_SCHEMA = {
+    "product_path": pl.String,
+    "product_name": pl.String,
+    "product_id": pl.String,
+    "shop_id": pl.String,
+    "shop_name": pl.String,
+    "url": pl.String,
+    "price": pl.Int64,
+    "parent_id": pl.String,
+    "description": pl.String,
+    "category": pl.String,
+    "category_tree": pl.List(pl.String),
+    "children": pl.List(
+        pl.Struct({"productID": pl.String, "optionName": pl.String})
+    ),
+    "images": pl.List(
+        pl.Struct(
+            {
+                "path": pl.String,
+                "storage_path": pl.String,
+                "classes": pl.List(pl.Int64),
+                "scores": pl.List(pl.Float64),
+                "boxes": pl.List(pl.List(pl.Float64)),
+            }
+        )
+    ),
+    "source_mtime": pl.Float64,
+    "extracted_at": pl.Datetime("us", "UTC"),
+}
+
+
+_detections = None
+
+
+def get_detections():
+    """Detection manifest and store, loaded once per process."""
+    global _detections
+    if _detections is None:
+        _detections = (load_manifest(), DetectionStore())
+    return _detections
+
+
+def image_sha(image_path: str) -> Optional[str]:
+    """Content hash detection recorded for an image, without hashing it again."""
+    manifest, _ = get_detections()
+    cached = manifest["images"].get(os.path.relpath(image_path, ROOT_DIR))
+    if cached:
+        return cached["sha"]
+    if os.path.islink(image_path):
+        # Blobs are named by the hash of their content
+        return os.path.splitext(os.path.basename(os.path.realpath(image_path)))[0]
+    return None
+
+
+def source_mtime(product_dir: str, info_file: str) -> float:
+    """Latest change to product_info, the images or their detections."""
+    mtime = os.path.getmtime(info_file)
+    images_dir = os.path.join(product_dir, "images")
+    if os.path.isdir(images_dir):
+        mtime = max(mtime, os.path.getmtime(images_dir))
+
+    manifest, _ = get_detections()
+    for image in glob.glob(os.path.join(images_dir, IMAGE_PATTERN)):
+        entry = manifest["detections"].get(image_sha(image))
+        if entry:
+            detected_at = datetime.fromisoformat(entry["detected_at"]).timestamp()
+            mtime = max(mtime, detected_at)
+    return mtime
+
+
+def detection_summary(image_path: str) -> dict:
+    """Classes, scores and boxes of an image in the detection store, empty if not detected."""
+    _, store = get_detections()
+    sha = image_sha(image_path)
+    detections = store.get(sha) if sha else None
+    if detections is None:
+        return {"classes": [], "scores": [], "boxes": []}
+
+    return {
+        "classes": detections["classes"].tolist(),
+        "scores": detections["scores"].tolist(),
+        "boxes": detections["boxes"].tolist(),
+    }
+
+
+def image_entries(product_dir: str) -> List[dict]:
+    """Distinct images of a product with their detection summaries."""
+    images = glob.glob(os.path.join(product_dir, "images", IMAGE_PATTERN))
+    entries = []
+    for group in group_by_blob(sorted(images)).values():
+        image = group[0]
+        rel_path = os.path.relpath(image, ROOT_DIR)
+        entries.append(
+            {
+                "path": rel_path,
+                "storage_path": storage_path(image) if os.path.islink(image) else rel_path,
+                **detection_summary(image),
+            }
+        )
+    return entries
+
+
+def catalog_row(product_dir: str, product_info: dict, mtime: float) -> dict:
+    """Builds the catalog row for one product directory under details/."""
+    brand = os.path.basename(os.path.dirname(product_dir))
+    return {
+        "brand": brand,
+        "product_path": os.path.relpath(product_dir, ROOT_DIR),
+        "product_name": os.path.basename(product_dir),
+        **{
+            column: product_info.get(column)
+            for column in (
+                "product_id",
+                "shop_id",
+                "shop_name",
+                "url",
+                "price",
+                "parent_id",
+                "description",
+                "category",
+                "category_tree",
+                "children",
+            )
+        },
+        "images": image_entries(product_dir),
+        "source_mtime": mtime,
+    }
+
+
+def append_rows(rows: List[dict]):
+    """Writes one new part file per brand, leaving earlier parts untouched."""
+    if not rows:
+        logger.info("No catalog rows to write")
+        return
+
+    extracted_at = datetime.now(timezone.utc)
+    part_name = f"part-{extracted_at.strftime('%Y%m%d%H%M%S%f')}-{os.getpid()}.parquet"
+    frame = pl.DataFrame(
+        [{**row, "extracted_at": extracted_at} for row in rows],
+        schema={"brand": pl.String, **CATALOG_SCHEMA},
+        strict=False,
+    )
+    for (brand,), brand_frame in frame.group_by("brand"):
+        brand_dir = os.path.join(CATALOG_DIR, f"brand={brand}")
+        create_dir_if_not_exists(brand_dir)
+        brand_frame.drop("brand").write_parquet(os.path.join(brand_dir, part_name))
+    logger.info(f"Appended {len(rows)} products to the catalog")
+    compact_catalog()
+
+
+def get_part_files() -> List[str]:
+    return glob.glob(os.path.join(CATALOG_DIR, "brand=*", "*.parquet"))
+
+
+def catalog_version() -> tuple:
+    """Changes whenever parts are appended, compacted or synced down."""
+    parts = get_part_files()
+    return len(parts), max((os.path.getmtime(part) for part in parts), default=0)
+
+
+def latest(frame):
+    """Keeps the most recently extracted row of each product."""
+    return frame.sort("extracted_at").unique(
+        subset="product_path", keep="last", maintain_order=True
+    )
+
+
+def scan_catalog() -> Optional[pl.LazyFrame]:
+    """Lazy scan over every part with one row per product, None if empty."""
+    if not get_part_files():
+        return None
+    frame = pl.scan_parquet(
+        os.path.join(CATALOG_DIR, "brand=*", "*.parquet"),
+        hive_partitioning=True,
+        hive_schema={"brand": pl.String},
+    )
+    return latest(frame)
+
+
+def read_catalog(columns: Optional[List[str]] = None) -> pl.DataFrame:
+    """Reads the current catalog, optionally restricted to some columns."""
+    frame = scan_catalog()
+    if frame is None:
+        logger.warning(f"No product catalog found in {CATALOG_DIR}")
+        schema = {"brand": pl.String, **CATALOG_SCHEMA}
+        empty = pl.DataFrame(schema=schema)
+        return empty.select(columns) if columns else empty
+    if columns:
+        frame = frame.select(columns)
+    return frame.collect()
+
+
+def iter_catalog(columns: Optional[List[str]] = None) -> Iterator[dict]:
+    """Yields current catalog rows one brand partition at a time.
+
+    Memory is bounded by the largest brand rather than the whole catalog.
+    """
+    for brand_dir in sorted(glob.glob(os.path.join(CATALOG_DIR, "brand=*"))):
+        parts = glob.glob(os.path.join(brand_dir, "*.parquet"))
+        if not parts:
+            continue
+        frame = latest(pl.scan_parquet(parts))
+        if columns:
+            frame = frame.select([column for column in columns if column != "brand"])
+        brand = os.path.basename(brand_dir)[len("brand=") :]
+        for row in frame.collect().iter_rows(named=True):
+            if columns is None or "brand" in columns:
+                row["brand"] = brand
+            yield row
+
+
+def catalogued_mtimes() -> Dict[str, float]:
+    """Maps each catalogued product path to the source mtime it was built from."""
+    catalog = read_catalog(["product_path", "source_mtime"])
+    return dict(zip(catalog["product_path"], catalog["source_mtime"]))
+
+
+def compact_catalog(max_parts: int = CATALOG_MAX_PARTS):
+    """Rewrites brands with more than `max_parts` parts into a single part."""
+    for brand_dir in glob.glob(os.path.join(CATALOG_DIR, "brand=*")):
+        parts = sorted(glob.glob(os.path.join(brand_dir, "*.parquet")))
+        if len(parts) <= max_parts:
+            continue
+
+        compacted = latest(pl.read_parquet(parts))
+        name = os.path.basename(parts[-1]).replace("part-", "compact-")
+        temp_path = os.path.join(brand_dir, f".{name}")
+        compacted.write_parquet(temp_path)
+        os.replace(temp_path, os.path.join(brand_dir, name))
+        removed = [part for part in parts if os.path.basename(part) != name]
+        # Recorded first so the parts' copies in GCS are deleted on the next sync
+        record_removed(CATALOG_DIR, f"{os.path.basename(brand_dir)}-{name}", removed)
+        for part in removed:
+            os.remove(part)
+        logger.info(f"Compacted {len(parts)} catalog parts in {brand_dir}")
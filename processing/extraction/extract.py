@@ -10,90 +10,63 @@ ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 sys.path.append(ROOT_DIR)
 
 from processing.logger import logger
-from jsonpath_ng.ext import parse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import timedelta
 from processing.utils.utils import save_json
+from processing.extraction.fields import extract_product_info
+from processing.extraction import catalog
 import time
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # Optional faster decoder
+    orjson = None
+
+load_dotenv()
 
-# Define JSONPath parsers
-BASIC_PARSER = parse("$..basicInfo")
-PARENT_ID_PARSER = parse("$..parentID")
-DESC_PARSER = parse("$..content[?(@.title=='Deskripsi')].subtitle")
-CHILD_PARSER = parse("$..pdpGetLayout..children[*]")
-PRICE_PARSER = parse("$..price.value")
 EXTRACT_FILENAME = os.getenv("EXTRACT_FILENAME")
-CATEGORY_BREADCRUMB_URI = "https://www.tokopedia.com/p/"
 DETAILS_FILENAME = os.getenv("DETAILS_FILENAME")
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "thread")
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+EXTRACT_CHUNKSIZE = int(os.getenv("EXTRACT_CHUNKSIZE", 64))
+
+
+def load_json(json_file):
+    """Reads a JSON file, with orjson when it is installed."""
+    if orjson is not None:
+        with open(json_file, "rb") as f:
+            return orjson.loads(f.read())
+    with open(json_file, "r") as f:
+        return json.load(f)
+
 
+def extract_details(json_file, catalogued_mtime=None):
+    """Extracts product_info for a details file and returns its catalog row.
 
-def extract_details(json_file):
+    Returns None when the product is already extracted and its catalog row is
+    up to date.
+    """
     try:
         # Determine parent directory path
         parent_dir = os.path.dirname(json_file)
         output_file = os.path.join(parent_dir, EXTRACT_FILENAME)
 
         if os.path.exists(output_file):
-            logger.info(f"File exists, skipping extraction: {json_file}")
-            return
+            mtime = catalog.source_mtime(parent_dir, output_file)
+            if catalogued_mtime is not None and mtime <= catalogued_mtime:
+                logger.info(f"File exists, skipping extraction: {json_file}")
+                return None
+
+            # Extracted before, but missing or stale in the catalog
+            return catalog.catalog_row(parent_dir, load_json(output_file), mtime)
 
         logger.info(f"Processing file: {json_file}")
 
         # Open and parse JSON file
-        with open(json_file, "r") as f:
-            j = json.load(f)
-
-        # Extract relevant information using JSONPath parsers
-        basic_info = BASIC_PARSER.find(j)
-        if basic_info:
-            basic_info = basic_info[0].value
-            product_id = basic_info.get("id")
-            shop_id = basic_info.get("shopID")
-            shop_name = basic_info.get("shopName")
-            url = basic_info.get("url")
-            category_breadcrumb = basic_info.get("category").get("breadcrumbURL")
-            category_tree = category_breadcrumb.replace(
-                CATEGORY_BREADCRUMB_URI, ""
-            ).split("/")
-            category = category_tree[-1]
-        else:
-            product_id = shop_id = shop_name = url = category = category_tree = None
-
-        parsed_parent_id = PARENT_ID_PARSER.find(j)
-        parsed_desc = DESC_PARSER.find(j)
-        parsed_children = CHILD_PARSER.find(j)
-        parsed_price = PRICE_PARSER.find(j)
-
-        # Get values if they exist
-        parent_id = parsed_parent_id[0].value if parsed_parent_id else None
-        description = parsed_desc[0].value if parsed_desc else None
-        price = parsed_price[0].value if parsed_price else None
-
-        flattened_children = (
-            [
-                {
-                    "productID": child.value["productID"],
-                    "optionName": ", ".join(child.value["optionName"]),
-                }
-                for child in parsed_children
-            ]
-            if parsed_children
-            else None
-        )
+        j = load_json(json_file)
 
-        # Create dictionary to store extracted details
-        out_json = {
-            "product_id": product_id,
-            "shop_id": shop_id,
-            "shop_name": shop_name,
-            "url": url,
-            "price": price,
-            "parent_id": parent_id,
-            "description": description,
-            "category": category,
-            "category_tree": category_tree,
-            "children": flattened_children,
-        }
+        out_json = extract_product_info(j)
 
         # Log extracted information
         logger.info(f"Extracted details for {parent_dir}")
@@ -103,22 +76,46 @@ def extract_details(json_file):
 
         logger.info(f"Successfully wrote to {output_file}")
 
+        return catalog.catalog_row(
+            parent_dir, out_json, catalog.source_mtime(parent_dir, output_file)
+        )
+
     except Exception as e:
         logger.error(f"Failed to process {json_file}: {e}")
+        return None
 
 
 def main():
     # Get list of JSON files from the details directory
     files = glob.glob(os.path.join(ROOT_DIR, "details", "**", "**", DETAILS_FILENAME))
+    catalogued = catalog.catalogued_mtimes()
+    mtimes = [
+        catalogued.get(os.path.relpath(os.path.dirname(json_file), ROOT_DIR))
+        for json_file in files
+    ]
 
     # Track execution time
     start_time = time.time()
 
     logger.info("Starting JSON extraction process")
 
-    # Execute in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(extract_details, files)
+    # Execute in parallel. Parsing is CPU bound, so the process pool scales
+    # with cores where threads are serialised by the GIL
+    if EXTRACT_EXECUTOR == "process":
+        logger.info(
+            f"Extracting {len(files)} files with {EXTRACT_WORKERS} processes, chunks of {EXTRACT_CHUNKSIZE}"
+        )
+        with ProcessPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+            rows = list(
+                executor.map(
+                    extract_details, files, mtimes, chunksize=EXTRACT_CHUNKSIZE
+                )
+            )
+    else:
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            rows = list(executor.map(extract_details, files, mtimes))
+
+    catalog.append_rows([row for row in rows if row])
 
     logger.info(
         f"Completed JSON extraction process. Execution time: {timedelta(seconds=time.time() - start_time)}"
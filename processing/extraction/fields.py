@@ -0,0 +1,122 @@
+CATEGORY_BREADCRUMB_URI = "https://www.tokopedia.com/p/"
+DESCRIPTION_TITLE = "Deskripsi"
+MISSING = object()
+
+
+def _description(content):
+    if isinstance(content, dict):
+        content = list(content.values())
+    if not isinstance(content, list):
+        return MISSING
+    for item in content:
+        if (
+            isinstance(item, dict)
+            and item.get("title") == DESCRIPTION_TITLE
+            and "subtitle" in item
+        ):
+            return item["subtitle"]
+    return MISSING
+
+
+def _value(found):
+    return None if found is MISSING else found
+
+
+def collect_fields(product_json):
+    """Collects product_info fields from PDP details in a single walk.
+
+    The walk is the same pre-order JSONPath recursive descent uses, so the
+    values match the queries it replaces:
+
+        $..basicInfo                                   (first match)
+        $..parentID                                    (first match)
+        $..content[?(@.title=='Deskripsi')].subtitle   (first match)
+        $..pdpGetLayout..children[*]                   (all matches)
+        $..price.value                                 (first match)
+    """
+    basic_info = parent_id = description = price = MISSING
+    children = []
+
+    # (node, inside pdpGetLayout)
+    stack = [(product_json, False)]
+    while stack:
+        node, in_layout = stack.pop()
+
+        if isinstance(node, dict):
+            if basic_info is MISSING and "basicInfo" in node:
+                basic_info = node["basicInfo"]
+            if parent_id is MISSING and "parentID" in node:
+                parent_id = node["parentID"]
+            if description is MISSING and "content" in node:
+                description = _description(node["content"])
+            if price is MISSING and isinstance(node.get("price"), dict):
+                price = node["price"].get("value", MISSING)
+            if in_layout and "children" in node:
+                value = node["children"]
+                children.extend(value if isinstance(value, list) else [value])
+
+            stack.extend(
+                (value, in_layout or key == "pdpGetLayout")
+                for key, value in reversed(list(node.items()))
+                if isinstance(value, (dict, list))
+            )
+        elif isinstance(node, list):
+            stack.extend(
+                (value, in_layout)
+                for value in reversed(node)
+                if isinstance(value, (dict, list))
+            )
+
+    return {
+        "basic_info": _value(basic_info),
+        "parent_id": _value(parent_id),
+        "description": _value(description),
+        "children": children,
+        "price": _value(price),
+    }
+
+
+def build_product_info(fields):
+    """Builds the product_info dictionary from collected fields."""
+    basic_info = fields["basic_info"]
+    if basic_info:
+        product_id = basic_info.get("id")
+        shop_id = basic_info.get("shopID")
+        shop_name = basic_info.get("shopName")
+        url = basic_info.get("url")
+        category_breadcrumb = basic_info.get("category").get("breadcrumbURL")
+        category_tree = category_breadcrumb.replace(
+            CATEGORY_BREADCRUMB_URI, ""
+        ).split("/")
+        category = category_tree[-1]
+    else:
+        product_id = shop_id = shop_name = url = category = category_tree = None
+
+    flattened_children = (
+        [
+            {
+                "productID": child["productID"],
+                "optionName": ", ".join(child["optionName"]),
+            }
+            for child in fields["children"]
+        ]
+        if fields["children"]
+        else None
+    )
+
+    return {
+        "product_id": product_id,
+        "shop_id": shop_id,
+        "shop_name": shop_name,
+        "url": url,
+        "price": fields["price"],
+        "parent_id": fields["parent_id"],
+        "description": fields["description"],
+        "category": category,
+        "category_tree": category_tree,
+        "children": flattened_children,
+    }
+
+
+def extract_product_info(product_json):
+    return build_product_info(collect_fields(product_json))
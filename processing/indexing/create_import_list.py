@@ -2,12 +2,13 @@ import os
 import sys
 import glob
 import json
-import numpy as np
 from google.cloud import vision
 from datetime import date
 from index import get_older_product_set
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from processing.logger import logger
+from processing.detection.detection_manifest import load_manifest
+from processing.detection.result_store import DetectionStore
 
 # Define the root directory path for consistency
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
@@ -41,40 +42,25 @@ def load_info_file(info_path):
         return None
 
 
-def get_image_pairs(product_path):
-    """Find images and corresponding processed files if they exist."""
+def get_image_pairs(product_path, detection_manifest, store):
+    """Find images and the content hash of their detections in the store."""
     images_dict = {}
     image_files = glob.glob(os.path.join(product_path, "images", "*.[jp][pn]g"))
     for image_path in image_files:
-        processed_path = image_path.replace("/images/", "/images/processed/") + ".npy"
-        if os.path.exists(processed_path):
-            images_dict[image_path] = processed_path
+        cached = detection_manifest["images"].get(os.path.relpath(image_path, ROOT_DIR))
+        if cached and cached["sha"] in store:
+            images_dict[image_path] = cached["sha"]
         else:
-            logger.warning(f"Processed file missing for image: {image_path}")
+            logger.warning(f"Detection missing for image: {image_path}")
     return images_dict
 
 
-def get_bounding_boxes(image_pairs, category_code):
+def get_bounding_boxes(image_pairs, category_code, store):
     """Retrieve bounding boxes for a given category code."""
     boxes_dict = {}
-    for image_path, detect_path in image_pairs.items():
-        try:
-            detection_data = np.load(detect_path, allow_pickle=True).item()
-        except Exception as e:
-            logger.error(f"Error loading detection file {detect_path}: {e}")
-            continue
-
-        bounding_boxes = [
-            (x1, y1, x2, y2)
-            for i, class_id in enumerate(detection_data["classes"])
-            if class_id == int(category_code)
-            for y1, x1, y2, x2 in [detection_data["boxes"][i].astype(int)]
-        ]
-
-        if bounding_boxes:
-            largest_box = max(
-                bounding_boxes, key=lambda b: (b[2] - b[0]) * (b[3] - b[1])
-            )
+    for image_path, sha in image_pairs.items():
+        largest_box = store.largest_box(sha, int(category_code))
+        if largest_box:
             boxes_dict[image_path] = largest_box
             logger.debug(
                 f"Selected largest bounding box for {image_path}: {largest_box}"
@@ -82,7 +68,7 @@ def get_bounding_boxes(image_pairs, category_code):
     return boxes_dict
 
 
-def categorize_product(meta_dict, set_name):
+def categorize_product(meta_dict, set_name, store):
     """Categorize a product and prepare import lines based on metadata."""
     product_display_name = meta_dict["product_name"].split("/")[1]
     info_path = meta_dict["info"]
@@ -101,7 +87,7 @@ def categorize_product(meta_dict, set_name):
 
     mapped_category = CATEGORY_MAPPING[category]
     category_code, category_desc = mapped_category.split(": ")
-    bounding_boxes = get_bounding_boxes(image_pairs, category_code)
+    bounding_boxes = get_bounding_boxes(image_pairs, category_code, store)
 
     product_id = info.get("product_id", "Unknown")
     product_category = "apparel-v2"
@@ -133,6 +119,9 @@ def main():
     product_paths = glob.glob(os.path.join(ROOT_DIR, "details", "**", "**"))
 
     all_import_lines = []
+    # Detections are memory-mapped from the store instead of unpickled per image
+    detection_manifest = load_manifest()
+    store = DetectionStore()
 
     client = vision.ProductSearchClient()
     old_set_path, new_set_id = get_older_product_set(client)
@@ -151,9 +140,12 @@ def main():
                         product_path, os.path.join(ROOT_DIR, "details")
                     ),
                     "info": os.path.join(product_path, "product_info.json"),
-                    "images_detect_pairs": get_image_pairs(product_path),
+                    "images_detect_pairs": get_image_pairs(
+                        product_path, detection_manifest, store
+                    ),
                 },
                 set_name,
+                store,
             )
             for product_path in product_paths
             if os.path.exists(os.path.join(product_path, "product_info.json"))
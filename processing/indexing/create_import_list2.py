@@ -3,15 +3,14 @@ import sys
 
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 sys.path.append(ROOT_DIR)
-import glob
 import json
 import time
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import uuid
 from datetime import datetime, timedelta, timezone
-from threading import Lock
-from functools import partial
 from processing.logger import logger
+from typing import Dict, Iterator, List, Tuple
+from processing.extraction.catalog import iter_catalog
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -26,6 +25,10 @@ BUCKET_DIR = os.getenv("BUCKET_NAME")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
 DATETIME_FORMAT = os.getenv("DATETIME_FORMAT")
 EXTRACT_FILENAME = os.getenv("EXTRACT_FILENAME")
+# "full" writes every product image, "diff" only add/update/delete shards
+# against the snapshot of the previous run
+IMPORT_LIST_MODE = os.getenv("IMPORT_LIST_MODE", "full")
+SNAPSHOT_PATH = os.path.join(OUTPUT_DIR, f"snapshot_{PRODUCT_SET_NAME}.tsv")
 
 try:
     with open(
@@ -35,54 +38,34 @@ try:
     logger.info("Category mapping loaded successfully.")
 except FileNotFoundError:
     logger.error("Category mapping file not found.")
+    CATEGORY_MAPPING = {}
 
 
-# Utility Functions
-def get_product_images(product_path):
-    """Retrieve image file paths from the product directory."""
-    return glob.glob(os.path.join(product_path, "images", "*.[jp][pn]g"))
-
-
-def get_product_details(product_path):
-    """Load product details from the product_info.json file."""
-    try:
-        detail_path = glob.glob(os.path.join(product_path, EXTRACT_FILENAME))
-        if detail_path:
-            with open(detail_path[0], "r") as f:
-                return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.info(f"Error loading product details: {e}")
-    return {}
-
-
-def sanitize_image_path(image_path):
-    """Convert local image path to a GCS-friendly format."""
-    # image_path.replace("/home/root/quo/", "")
-    start_dir = "details"
-    normalized_path = os.path.normpath(image_path)
-    relative_path = normalized_path.split(start_dir, 1)[-1]
-    clean_path = os.path.join(start_dir, relative_path.lstrip(os.sep))
-    return clean_path
+# Category slug -> detection class code, parsed once instead of per product
+CATEGORY_CODES = {
+    category: mapped_code.split(": ")[0]
+    for category, mapped_code in CATEGORY_MAPPING.items()
+}
 
 
+# Utility Functions
 def get_category_code(product_info):
-    mapped_code = CATEGORY_MAPPING.get(product_info["category"], None)
-    code = mapped_code.split(": ")[0]
+    return CATEGORY_CODES[product_info["category"]]
 
-    return code
 
+def reference_image_id(product_id, image_uri):
+    """Deterministic reference image id, so re-imports and deletes hit one image."""
+    return hashlib.sha256(f"{product_id}/{image_uri}".encode()).hexdigest()[:32]
 
-def get_bounding_box(image, category_code):
-    head, tail = os.path.split(image)
 
-    processed_path = os.path.join(head, "processed", f"{tail}.npy")
-    if os.path.exists(processed_path) and category_code:
-        detection_data = np.load(processed_path, allow_pickle=True).item()
+def get_bounding_box(image, category_code):
+    """Largest box of the product's category in the image's detection summary."""
+    if category_code:
         bounding_boxes = [
             (x1, y1, x2, y2)
-            for i, class_id in enumerate(detection_data["classes"])
+            for class_id, box in zip(image["classes"], image["boxes"])
             if class_id == int(category_code)
-            for y1, x1, y2, x2 in [detection_data["boxes"][i].astype(int)]
+            for y1, x1, y2, x2 in [[int(value) for value in box]]
         ]
 
         if bounding_boxes:
@@ -90,80 +73,225 @@ def get_bounding_box(image, category_code):
                 bounding_boxes, key=lambda b: (b[2] - b[0]) * (b[3] - b[1])
             )
 
-            logger.info(f"Selected largest bounding box for {image}: {largest_box}")
+            logger.info(f"Selected largest bounding box for {image['path']}: {largest_box}")
             box_string = ",".join(map(str, largest_box))
             return f'"{box_string}"'
-    logger.warning(f"No bounding box found for {image}")
+    logger.warning(f"No bounding box found for {image['path']}")
     return ""  # Don't return None
 
 
-def compile_product_data(product_path, lines, lines_lock):
-    """Compile data for a single product and append to the shared lines list."""
-    images = get_product_images(product_path)
-    product_info = get_product_details(product_path)
-
-    if not images or not product_info:
-        logger.info(f"Missing images or details file for {product_path}")
+def compile_product_data(product) -> Iterator[Tuple[Tuple[str, str], str]]:
+    """Yields ((image uri, product id), import line) of a catalog row, one per image."""
+    images = product["images"]
+    if not images or not product["product_id"]:
+        logger.info(f"Missing images or details for {product['product_path']}")
         return
 
-    product_display_name = os.path.basename(product_path)
-    product_id = product_info.get("product_id", "Unknown")
+    product_display_name = product["product_name"]
+    product_id = product["product_id"]
     product_category = "apparel-v2"
     product_labels = (
-        f'category={product_info.get("category", "no-cat")},'
-        f'brand={product_info.get("shop_name", "Unknown")},'
-        f'price={product_info.get("price", 0)}'
+        f'category={product["category"] or "no-cat"},'
+        f'brand={product["shop_name"] or "Unknown"},'
+        f'price={product["price"] or 0}'
     )
+    category_code = get_category_code(product)
 
     for image in images:
-        image_loc = sanitize_image_path(image)
-        category_code = get_category_code(product_info)
+        image_uri = f'gs://quo-trial/{image["storage_path"]}'
+        image_id = reference_image_id(product_id, image_uri)
         bbox = get_bounding_box(image, category_code)
         csv_line = (
-            f'"gs://quo-trial/{image_loc}",,"{PRODUCT_SET_NAME}","{product_id}",'
+            f'"{image_uri}","{image_id}","{PRODUCT_SET_NAME}","{product_id}",'
             f'"{product_category}","{product_display_name}","{product_labels}",'
             f'{bbox if bbox else ""}\n'
         )
-        with lines_lock:
-            lines.append(csv_line)
-            logger.info(f"Appended {product_display_name}")
-
+        yield (image_uri, product_id), csv_line
+    logger.info(f"Compiled {product_display_name}")
+
+
+def new_run_id() -> str:
+    """Seconds and a random suffix, so runs within one DATETIME_FORMAT period differ."""
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    return f"{timestamp}-{uuid.uuid4().hex[:8]}"
+
+
+class ShardWriter:
+    """Writes import lines straight to CSV shards of at most `shard_size` lines.
+
+    A shard is written under a .tmp name and renamed once full or closed, so
+    the indexer, which picks up *.csv, never imports a partial shard. Leaving
+    the writer on an exception discards the shard being written instead.
+    """
+
+    def __init__(
+        self,
+        write_date: str,
+        run_id: str,
+        kind: str = "",
+        shard_size: int = BATCH_SIZE,
+    ):
+        self.write_date = write_date
+        self.run_id = run_id
+        self.kind = kind
+        self.shard_size = shard_size
+        self.shard_index = 0
+        self.file = None
+        self.lines = 0
+        self.total = 0
+        self.shards = []
+
+    @property
+    def filename(self) -> str:
+        shard = f"{self.kind}-{self.shard_index}" if self.kind else self.shard_index
+        return os.path.join(
+            OUTPUT_DIR,
+            f"index_{PRODUCT_SET_NAME}_{self.write_date}_{self.run_id}_{shard}.csv",
+        )
 
-def write_batch_to_file(lines, batch_index, write_date):
-    """Write a batch of lines to a file."""
-    filename = os.path.join(
-        OUTPUT_DIR, f"index_{PRODUCT_SET_NAME}_{write_date}_{batch_index}.csv"
-    )
-    try:
-        with open(filename, "w") as f:
-            f.writelines(lines)
+    def write(self, line: str):
+        if self.file is None:
+            self.shard_index += 1
+            # Shards are checkpointed by name once applied, so never replace one
+            if os.path.exists(self.filename):
+                raise FileExistsError(f"Import shard {self.filename} already exists")
+            self.file = open(f"{self.filename}.tmp", "x")
+        self.file.write(line)
+        self.lines += 1
+        self.total += 1
+        if self.lines >= self.shard_size:
+            self.close()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        os.replace(f"{self.filename}.tmp", self.filename)
         logger.info(
-            f"Batch {batch_index} written to {filename} with {len(lines)} lines."
+            f"Batch {self.shard_index} written to {self.filename} "
+            f"with {self.lines} lines."
         )
-    except IOError as e:
-        logger.info(f"Error writing to file {filename}: {e}")
+        self.shards.append(self.filename)
+        self.file = None
+        self.lines = 0
+
+    def discard(self):
+        """Removes the shard being written without publishing it."""
+        if self.file is None:
+            return
+        self.file.close()
+        os.remove(f"{self.filename}.tmp")
+        logger.warning(f"Discarded partial batch {self.shard_index} of {self.filename}")
+        self.file = None
+        self.lines = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def compile_products(products, failed: set) -> Iterator[list]:
+    """Import entries of each product, collecting ids of failing ones in `failed`."""
+    for product in products:
+        try:
+            # Compiled in full first so a failing product writes no lines
+            yield list(compile_product_data(product))
+        except Exception as e:
+            logger.error(f"Error compiling {product['product_path']}: {e}")
+            failed.add(product["product_id"])
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> Dict[Tuple[str, str], str]:
+    """Maps (image uri, product id) of the previous import set to its line digest."""
+    snapshot = {}
+    try:
+        with open(path, "r") as f:
+            for row in f:
+                digest, product_id, image_uri = row.rstrip("\n").split("\t")
+                snapshot[(image_uri, product_id)] = digest
+    except FileNotFoundError:
+        logger.info(f"No import snapshot at {path}, every image is an addition")
+    return snapshot
+
+
+def write_full(products, write_date: str, run_id: str) -> List[str]:
+    with ShardWriter(write_date, run_id) as writer:
+        for entries in compile_products(products, set()):
+            for _, line in entries:
+                writer.write(line)
+    return writer.shards
+
+
+def write_diff(
+    products, write_date: str, run_id: str, path: str = SNAPSHOT_PATH
+) -> List[str]:
+    """Writes add, update and delete shards against the previous snapshot.
+
+    An image is keyed by (image uri, product id) and updated when its line,
+    which holds the display name, labels and box, changed. Images of products
+    that failed to compile are carried over rather than deleted. The snapshot
+    is replaced only once every shard is written, and left as is on failure.
+    """
+    previous = load_snapshot(path)
+    failed, seen = set(), set()
+    added, updated, deleted = (
+        ShardWriter(write_date, run_id, kind) for kind in ("add", "update", "delete")
+    )
+    with added, updated, deleted, open(f"{path}.tmp", "w") as snapshot:
+        for entries in compile_products(products, failed):
+            for key, line in entries:
+                # Variants listed as separate products can repeat an image
+                if key in seen:
+                    continue
+                seen.add(key)
+                digest = hashlib.sha1(line.encode()).hexdigest()
+                indexed = previous.pop(key, None)
+                if indexed is None:
+                    added.write(line)
+                elif indexed != digest:
+                    updated.write(line)
+                snapshot.write(f"{digest}\t{key[1]}\t{key[0]}\n")
+
+        for (image_uri, product_id), digest in previous.items():
+            if product_id in failed:
+                snapshot.write(f"{digest}\t{product_id}\t{image_uri}\n")
+                continue
+            image_id = reference_image_id(product_id, image_uri)
+            deleted.write(
+                f'"{image_uri}","{image_id}","{PRODUCT_SET_NAME}","{product_id}",,,,\n'
+            )
+    os.replace(f"{path}.tmp", path)
+    logger.info(
+        f"Import diff: {added.total} added, {updated.total} updated, "
+        f"{deleted.total} deleted"
+    )
+    return added.shards + updated.shards + deleted.shards
 
 
 # Main Logic
-def main():
-    product_paths = glob.glob(os.path.join(ROOT_DIR, "details", "**", "**"))
-    lines = []
-    lines_lock = Lock()
-
-    # Compile product data concurrently
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(
-            partial(compile_product_data, lines=lines, lines_lock=lines_lock),
-            product_paths,
-        )
-
-    # Write lines to files in batches
+def main(mode: str = IMPORT_LIST_MODE):
+    # Streams the catalog written during extraction, one brand at a time
+    products = iter_catalog(
+        [
+            "product_path",
+            "product_name",
+            "product_id",
+            "shop_name",
+            "price",
+            "category",
+            "images",
+        ]
+    )
     write_date = datetime.now(timezone.utc).strftime(DATETIME_FORMAT)
-    for i in range(0, len(lines), BATCH_SIZE):
-        batch = lines[i : i + BATCH_SIZE]
-        write_batch_to_file(
-            batch, batch_index=(i // BATCH_SIZE) + 1, write_date=write_date
-        )
+    run_id = new_run_id()
+    if mode == "diff":
+        return write_diff(products, write_date, run_id)
+    return write_full(products, write_date, run_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import threading
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from processing.logger import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# A Keras application that scales its own inputs, e.g. MobileNetV3Small/Large or
+# EfficientNetB0, so crops are fed as uint8 pixels
+EMBED_MODEL = os.getenv("EMBED_MODEL", "MobileNetV3Small")
+EMBED_IMAGE_SIZE = int(os.getenv("EMBED_IMAGE_SIZE", 224))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 4))
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """Loads the image encoder once, as a pooled feature extractor."""
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            # Imported here so reading or compacting an index never loads TensorFlow
+            import tensorflow as tf
+
+            model = getattr(tf.keras.applications, EMBED_MODEL)(
+                include_top=False,
+                weights="imagenet",
+                pooling="avg",
+                input_shape=(EMBED_IMAGE_SIZE, EMBED_IMAGE_SIZE, 3),
+            )
+            _encoder = tf.function(lambda images: model(images, training=False))
+            logger.info(f"Loaded {EMBED_MODEL} image encoder")
+        return _encoder
+
+
+def load_crop(image_file, box=None, image_size: int = EMBED_IMAGE_SIZE):
+    """Crops a box of an image into a padded uint8 square, None if undecodable.
+
+    `box` is (ymin, xmin, ymax, xmax) in original pixels, None for the whole
+    image. JPEGs are decoded at the smallest DCT reduction that still covers
+    the crop at `image_size`.
+    """
+    try:
+        with Image.open(image_file) as image:
+            width, height = image.size
+            ymin, xmin, ymax, xmax = box if box is not None else (0, 0, height, width)
+            ymin, ymax = max(0, ymin), min(height, ymax)
+            xmin, xmax = max(0, xmin), min(width, xmax)
+            if ymax <= ymin or xmax <= xmin:
+                return None
+
+            scale = image_size / max(ymax - ymin, xmax - xmin)
+            image.draft(
+                "RGB", (max(1, round(width * scale)), max(1, round(height * scale)))
+            )
+            x_factor, y_factor = image.size[0] / width, image.size[1] / height
+            target = (
+                max(1, round((xmax - xmin) * scale)),
+                max(1, round((ymax - ymin) * scale)),
+            )
+            crop = (
+                image.convert("RGB")
+                .crop(
+                    (
+                        round(xmin * x_factor),
+                        round(ymin * y_factor),
+                        round(xmax * x_factor),
+                        round(ymax * y_factor),
+                    )
+                )
+                .resize(target, Image.BILINEAR)
+            )
+        padded = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+        padded[: target[1], : target[0]] = crop
+        return padded
+    except Exception as e:
+        logger.error(f"Error cropping {image_file}: {e}")
+        return None
+
+
+def embed_images(images: np.ndarray) -> np.ndarray:
+    """L2-normalised float32 embeddings of a batch of uint8 crops."""
+    vectors = get_encoder()(images.astype(np.float32)).numpy()
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def embed_crops(
+    crops: List[Tuple[object, Optional[tuple]]],
+) -> Tuple[np.ndarray, List[int]]:
+    """Embeds (image file, box) crops, decoding on a thread pool.
+
+    Returns the embeddings of the crops that could be decoded and their
+    positions in `crops`.
+    """
+    vectors, embedded = [], []
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+        for start in range(0, len(crops), EMBED_BATCH_SIZE):
+            chunk = crops[start : start + EMBED_BATCH_SIZE]
+            images = list(executor.map(lambda crop: load_crop(*crop), chunk))
+            decoded = [i for i, image in enumerate(images) if image is not None]
+            if not decoded:
+                continue
+            vectors.append(embed_images(np.stack([images[i] for i in decoded])))
+            embedded.extend(start + i for i in decoded)
+            logger.info(f"Embedded {start + len(chunk)} of {len(crops)} crops")
+
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32), []
+    return np.concatenate(vectors), embedded
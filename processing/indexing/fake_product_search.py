@@ -0,0 +1,97 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import csv
+import threading
+from types import SimpleNamespace
+from google.api_core.exceptions import NotFound
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+
+
+class FakeOperation:
+    """Long-running operation that is done after `polls` calls to done()."""
+
+    def __init__(self, statuses, polls: int = 1):
+        self.statuses = statuses
+        self.polls = polls
+
+    def done(self) -> bool:
+        self.polls -= 1
+        return self.polls < 0
+
+    def result(self, timeout=None):
+        return SimpleNamespace(statuses=self.statuses)
+
+
+class FakeProductSearchClient:
+    """In-memory stand-in for vision.ProductSearchClient, for dry runs of index2.
+
+    Imports read the CSV from the local path under the gs:// uri and keep
+    products and reference images in dicts. Rows without a product id or
+    image uri fail the way Vision reports a bad line.
+    """
+
+    def __init__(self, polls: int = 1):
+        self.polls = polls
+        self.lock = threading.Lock()
+        self.products = {}  # product path -> product fields
+        self.reference_images = {}  # reference image path -> image uri
+        self.calls = []
+
+    def product_path(self, project, location, product):
+        return f"projects/{project}/locations/{location}/products/{product}"
+
+    def reference_image_path(self, project, location, product, reference_image):
+        product_path = self.product_path(project, location, product)
+        return f"{product_path}/referenceImages/{reference_image}"
+
+    def import_product_sets(self, parent, input_config):
+        uri = input_config.gcs_source.csv_file_uri
+        project, location = parent.split("/")[1::2]
+        with open(uri[len(f"gs://{BUCKET_NAME}/") :], "r", newline="") as f:
+            rows = list(csv.reader(f))
+
+        statuses = []
+        with self.lock:
+            self.calls.append(("import_product_sets", uri))
+            for row in rows:
+                image_uri, image_id, _, product_id, _, display_name, labels = row[:7]
+                if not image_uri or not product_id:
+                    statuses.append(SimpleNamespace(code=3, message="Invalid line"))
+                    continue
+                product = self.product_path(project, location, product_id)
+                # Like Vision, an existing product keeps its name and labels
+                self.products.setdefault(
+                    product, {"display_name": display_name, "labels": labels}
+                )
+                image = self.reference_image_path(
+                    project, location, product_id, image_id
+                )
+                self.reference_images[image] = image_uri
+                statuses.append(SimpleNamespace(code=0, message=""))
+        return FakeOperation(statuses, self.polls)
+
+    def delete_reference_image(self, name):
+        with self.lock:
+            self.calls.append(("delete_reference_image", name))
+            if self.reference_images.pop(name, None) is None:
+                raise NotFound(name)
+
+    def update_product(self, product, update_mask):
+        with self.lock:
+            self.calls.append(("update_product", product.name))
+            if product.name not in self.products:
+                raise NotFound(product.name)
+            self.products[product.name] = {
+                "display_name": product.display_name,
+                "labels": ",".join(
+                    f"{label.key}={label.value}" for label in product.product_labels
+                ),
+            }
+            return product
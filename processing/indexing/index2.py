@@ -3,11 +3,18 @@ import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 
+import csv
+import json
 import time
 from datetime import datetime
 import glob
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
 from processing.logger import logger
+from google.api_core.exceptions import NotFound
 from google.cloud import vision
+from google.protobuf import field_mask_pb2
 from datetime import timedelta, timezone
 
 from dotenv import load_dotenv
@@ -18,104 +25,275 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 LOCATION = os.getenv("LOCATION")
 DATETIME_FORMAT = os.getenv("DATETIME_FORMAT")
+# Shards imported at once; shards of later runs wait for earlier runs
+INDEX_MAX_CONCURRENT = int(os.getenv("INDEX_MAX_CONCURRENT", 4))
+INDEX_POLL_INTERVAL = float(os.getenv("INDEX_POLL_INTERVAL", 10))
+INDEX_OPERATION_TIMEOUT = float(os.getenv("INDEX_OPERATION_TIMEOUT", 3600))
+# Runs the scheduler against fake_product_search instead of Vision
+INDEX_DRY_RUN = os.getenv("INDEX_DRY_RUN") == "True"
+# Row errors logged per shard, the rest are only counted
+INDEX_ERROR_SAMPLES = 5
+# Row counts that keep a shard out of the checkpoint
+ROW_FAILURES = ("import_failed", "delete_failed", "update_failed")
 
-latest_index_file_path = "indices/latest.index"
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CHECKPOINT_PATH = os.path.join(ROOT_DIR, "indices/import_checkpoint.json")
 
 
-def get_latest_index_time():
-    """Retrieve the latest index time for product sets."""
+def load_checkpoint(path=CHECKPOINT_PATH):
+    """Status counts of every shard already applied, by shard file name."""
     try:
-        with open(latest_index_file_path, "r") as f:
-            latest_index_time = datetime.strptime(f.read(), DATETIME_FORMAT).tzinfo(
-                timezone.utc
-            )
-            return latest_index_time
-    except:
-        return datetime.min.replace(tzinfo=timezone.utc)
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Error reading import checkpoint {path}: {e}")
+        return {}
+
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_PATH):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(checkpoint, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
 
 
 def parse_index_date(file_path):
     """Extract and parse the date from an index file path."""
     try:
-        index_date_str = file_path.split("_")[2]
+        index_date_str = os.path.basename(file_path).split("_")[2]
         index_date = datetime.strptime(index_date_str, DATETIME_FORMAT)
         tz_date = index_date.replace(tzinfo=timezone.utc)  # Make it offset-aware
-        logger.info(f"Index {file_path} dated at {tz_date}")
         return tz_date
     except (IndexError, ValueError) as e:
         logger.error(f"Error parsing date from file {file_path}: {e}")
         return None
 
 
-def find_new_indices(latest_index_time):
-    """Find indices with dates newer than the latest indexed time."""
-    index_files = glob.glob(os.path.join(ROOT_DIR, "indices/*.csv"))
-    if not latest_index_time:
-        return index_files
-    new_indices = sorted([
+def parse_index_run(file_path):
+    """Run id of an import list shard, empty for lists named before run ids."""
+    parts = os.path.basename(file_path).split("_")
+    return parts[3] if len(parts) > 4 else ""
+
+
+def index_run(file_path):
+    return parse_index_date(file_path), parse_index_run(file_path)
+
+
+def find_new_indices(checkpoint):
+    """Index files not yet applied, grouped by the run that wrote them, oldest first.
+
+    Run ids start with the time in seconds, so runs of one date sort in order.
+    """
+    index_files = [
         index_file
-        for index_file in index_files
-        if (index_date := parse_index_date(index_file))
-        and index_date > latest_index_time
-    ])
-    logger.info(f"Valid indices to index found: {new_indices}")
-    return new_indices
+        for index_file in glob.glob(os.path.join(ROOT_DIR, "indices/*.csv"))
+        if os.path.basename(index_file) not in checkpoint
+        and parse_index_date(index_file)
+    ]
+    index_files.sort(key=lambda index_file: (index_run(index_file), index_file))
+    return [list(files) for _, files in groupby(index_files, key=index_run)]
 
 
-def import_product_set(client, index_path):
-    """Import a product set from a given index file."""
-    try:
-        logger.info(f"Indexing {index_path}")
-        location_path = f"projects/{PROJECT_ID}/locations/{LOCATION}"
-        csv_file_uri = f"gs://{BUCKET_NAME}/{index_path}"
+def shard_kind(index_path):
+    """add, update or delete for diff shards, add for full import lists."""
+    name = os.path.splitext(os.path.basename(index_path))[0]
+    kind = name.rsplit("_", 1)[-1].split("-")[0]
+    return kind if kind in ("update", "delete") else "add"
+
+
+def read_import_rows(index_path):
+    with open(index_path, "r", newline="") as f:
+        return list(csv.reader(f))
+
+
+def parse_labels(labels):
+    return [
+        vision.Product.KeyValue(key=key, value=value)
+        for key, value in (label.split("=", 1) for label in labels.split(",") if label)
+    ]
 
-        gcs_source = vision.ImportProductSetsGcsSource(csv_file_uri=csv_file_uri)
-        input_config = vision.ImportProductSetsInputConfig(gcs_source=gcs_source)
 
-        response = client.import_product_sets(
-            parent=location_path, input_config=input_config
+def delete_reference_images(client, rows):
+    """Delete the reference images of import rows, ignoring ones already gone."""
+    counts = Counter()
+    for image_uri, image_id, _, product_id, *_ in rows:
+        name = client.reference_image_path(
+            project=PROJECT_ID,
+            location=LOCATION,
+            product=product_id,
+            reference_image=image_id,
         )
-        result = response.result()  # Wait for the operation to complete
+        try:
+            client.delete_reference_image(name=name)
+            counts["deleted"] += 1
+        except NotFound:
+            counts["missing"] += 1
+        except Exception as e:
+            counts["delete_failed"] += 1
+            logger.error(f"Failed to delete reference image {image_uri}: {e}")
+    return counts
+
+
+def update_products(client, rows):
+    """Apply name and label changes, which imports skip for existing products."""
+    counts = Counter()
+    products = {row[3]: row for row in rows}
+    for product_id, (*_, display_name, labels, _) in products.items():
+        product = vision.Product(
+            name=client.product_path(
+                project=PROJECT_ID, location=LOCATION, product=product_id
+            ),
+            display_name=display_name,
+            product_labels=parse_labels(labels),
+        )
+        try:
+            client.update_product(
+                product=product,
+                update_mask=field_mask_pb2.FieldMask(
+                    paths=["display_name", "product_labels"]
+                ),
+            )
+            counts["products_updated"] += 1
+        except Exception as e:
+            counts["update_failed"] += 1
+            logger.error(f"Failed to update product {product_id}: {e}")
+    return counts
 
-        # Log statuses
-        for i, status in enumerate(result.statuses):
-            if status.code == 0:
-                logger.info(f"Line {i} processed successfully.")
-            else:
-                logger.error(f"Error on line {i}: {status.message}")
 
-        logger.info(f"Indexing completed for {index_path}.")
+def summarize_statuses(statuses, index_path):
+    """Counts row statuses of an import, logging only the first few errors."""
+    counts = Counter()
+    for i, status in enumerate(statuses):
+        if status.code == 0:
+            counts["imported"] += 1
+            continue
+        counts["import_failed"] += 1
+        if counts["import_failed"] <= INDEX_ERROR_SAMPLES:
+            logger.error(f"Error on line {i} of {index_path}: {status.message}")
+    return counts
+
+
+def wait_for_operation(operation, timeout=INDEX_OPERATION_TIMEOUT):
+    """Polls a long-running operation every INDEX_POLL_INTERVAL seconds."""
+    deadline = time.monotonic() + timeout
+    while not operation.done():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Operation not done after {timeout} seconds")
+        time.sleep(INDEX_POLL_INTERVAL)
+    return operation.result()
+
+
+def import_product_set(client, index_path):
+    """Import a product set from a given index file, returning row status counts."""
+    logger.info(f"Indexing {index_path}")
+    location_path = f"projects/{PROJECT_ID}/locations/{LOCATION}"
+    csv_file_uri = f"gs://{BUCKET_NAME}/{index_path}"
+
+    gcs_source = vision.ImportProductSetsGcsSource(csv_file_uri=csv_file_uri)
+    input_config = vision.ImportProductSetsInputConfig(gcs_source=gcs_source)
+
+    operation = client.import_product_sets(
+        parent=location_path, input_config=input_config
+    )
+    result = wait_for_operation(operation)
+    return summarize_statuses(result.statuses, index_path)
+
+
+def apply_shard(client, index_path):
+    """Import, update or delete the rows of an import list shard.
+
+    Updated images are deleted and imported again under the same id, since a
+    reference image's box cannot be changed in place. Returns status counts,
+    or None if the shard should be retried on the next run.
+    """
+    try:
+        kind = shard_kind(index_path)
+        if kind == "add":
+            return import_product_set(client, index_path)
+
+        rows = read_import_rows(index_path)
+        logger.info(f"Applying {len(rows)} {kind} rows from {index_path}")
+        counts = delete_reference_images(client, rows)
+        if kind == "update":
+            counts += update_products(client, rows)
+            counts += import_product_set(client, index_path)
+        return counts
     except Exception as e:
-        logger.error(f"Failed to import product set {index_path}: {e}")
+        logger.error(f"Failed to apply index shard {index_path}: {e}")
+        return None
+
+
+def failed_rows(counts):
+    return sum(counts[key] for key in ROW_FAILURES)
 
 
-def update_latest_index_time(index_file):
-    index_date_str = index_file.split("_")[2]
-    latest_index_time = datetime.strptime(index_date_str, DATETIME_FORMAT)
+def import_shards(client, index_files, checkpoint, max_concurrent=INDEX_MAX_CONCURRENT):
+    """Applies shards of one run concurrently, checkpointing each as it finishes.
 
-    with open(latest_index_file_path, "w+") as f:
-        f.write(str(latest_index_time))
-    logger.info(f"Updated index tracker to latest as {latest_index_time}")
+    Shards with failed rows are not checkpointed and are applied again in
+    full on the next run, which is safe since reference image ids are
+    deterministic and missing deletes are ignored.
+    """
+    totals = Counter()
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = {
+            executor.submit(apply_shard, client, index_file): index_file
+            for index_file in index_files
+        }
+        for future in as_completed(futures):
+            index_file = futures[future]
+            counts = future.result()
+            if counts is None:
+                totals["shards_failed"] += 1
+                continue
+            if failed_rows(counts):
+                logger.error(
+                    f"{failed_rows(counts)} rows of {index_file} failed, "
+                    f"retrying it next run: {dict(counts)}"
+                )
+                totals += counts
+                totals["shards_failed"] += 1
+                continue
+            logger.info(f"Applied {index_file}: {dict(counts)}")
+            checkpoint[os.path.basename(index_file)] = {
+                **counts,
+                "applied_at": datetime.now(timezone.utc).isoformat(),
+            }
+            save_checkpoint(checkpoint)
+            totals += counts
+            totals["shards"] += 1
+    return totals
 
 
-def main():
-    client = vision.ProductSearchClient()
-    latest_index_time = get_latest_index_time()
+def get_client():
+    if INDEX_DRY_RUN:
+        from processing.indexing.fake_product_search import FakeProductSearchClient
 
-    logger.info(f"Finding indices older than {latest_index_time}")
-    new_indices = find_new_indices(latest_index_time)
-    if not new_indices:
+        logger.info("Dry run, importing into a fake product search client")
+        return FakeProductSearchClient()
+    return vision.ProductSearchClient()
+
+
+def main(client=None):
+    client = client or get_client()
+    checkpoint = load_checkpoint()
+
+    runs = find_new_indices(checkpoint)
+    if not runs:
         logger.info("No new indices to process.")
         return
-    else:
-        logger.info(f"New indices found: {new_indices}")
-
-    logger.info(f"Found {len(new_indices)} new indices to process.")
-    for index_file in new_indices:
-        logger.info(f"Processing {index_file}")
-        import_product_set(client, index_file)
-        update_latest_index_time(index_file)
+
+    logger.info(f"Found {sum(map(len, runs))} new indices to process.")
+    totals = Counter()
+    for index_files in runs:
+        # Later runs can update or delete images added by earlier ones
+        counts = import_shards(client, index_files, checkpoint)
+        totals += counts
+        if counts["shards_failed"]:
+            logger.error("Stopping before later runs, failed shards retry next run")
+            break
+    logger.info(f"Indexing totals: {dict(totals)}")
 
 
 if __name__ == "__main__":
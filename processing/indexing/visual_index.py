@@ -0,0 +1,548 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import io
+import glob
+import json
+import time
+import shutil
+import hashlib
+import threading
+import faiss
+import numpy as np
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from processing.logger import logger
+from processing.extraction.catalog import image_sha, read_catalog
+from processing.detection.client import detect_image
+from processing.indexing.embed import (
+    EMBED_IMAGE_SIZE,
+    EMBED_MODEL,
+    embed_crops,
+    embed_images,
+    load_crop,
+)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+VISUAL_INDEX_DIR = os.path.join(ROOT_DIR, "visual_index")
+VISUAL_INDEX_HNSW_M = int(os.getenv("VISUAL_INDEX_HNSW_M", 32))
+VISUAL_INDEX_EF_CONSTRUCTION = int(os.getenv("VISUAL_INDEX_EF_CONSTRUCTION", 200))
+VISUAL_INDEX_EF_SEARCH = int(os.getenv("VISUAL_INDEX_EF_SEARCH", 64))
+VISUAL_SEARCH_TOP_K = int(os.getenv("VISUAL_SEARCH_TOP_K", 50))
+# Share of tombstoned slots past which a partition is rebuilt
+VISUAL_INDEX_MAX_TOMBSTONES = float(os.getenv("VISUAL_INDEX_MAX_TOMBSTONES", 0.2))
+VISUAL_INDEX_COMPACT_WORKERS = int(os.getenv("VISUAL_INDEX_COMPACT_WORKERS", 2))
+# Seconds between update passes, 0 updates once and exits
+VISUAL_INDEX_UPDATE_INTERVAL = int(os.getenv("VISUAL_INDEX_UPDATE_INTERVAL", 0))
+TAXONOMY_PATH = os.path.join(ROOT_DIR, "processing/indexing/taxonomy.json")
+LABEL_MAP_PATH = os.path.join(
+    ROOT_DIR, os.getenv("LABEL_MAP_DIR", ""), os.getenv("LABEL_MAP_FILE", "")
+)
+
+REFERENCE_SCHEMA = {
+    "id": pl.Int64,
+    "product_id": pl.String,
+    "product_name": pl.String,
+    "brand": pl.String,
+    "category": pl.String,
+    "image_path": pl.String,
+    "image_key": pl.String,
+    "box": pl.List(pl.Float64),
+    "slot": pl.Int64,
+}
+# Columns that change a reference's embedding; image changes give a new id
+EMBEDDING_COLUMNS = ("box",)
+METADATA_COLUMNS = ("product_id", "product_name", "brand", "category", "image_path")
+
+
+def load_taxonomy() -> Dict[str, int]:
+    """Maps product categories to the detection class they are indexed under."""
+    with open(TAXONOMY_PATH, "r") as mapping_file:
+        return {
+            category: int(mapped.split(": ")[0])
+            for category, mapped in json.load(mapping_file).items()
+        }
+
+
+def load_label_map() -> Dict[int, str]:
+    """Detection class names by id, from the `id:name` label map."""
+    label_map = {}
+    try:
+        with open(LABEL_MAP_PATH, "r") as f:
+            for line in f:
+                key, value = line.strip().split(":", 1)
+                label_map[int(key)] = value.strip()
+    except Exception as e:
+        logger.error(f"Error reading label map {LABEL_MAP_PATH}: {e}")
+    return label_map
+
+
+def reference_id(product_id: str, image_key: str) -> int:
+    """Stable non-negative int64 id of one product image."""
+    digest = hashlib.sha256(f"{product_id}/{image_key}".encode()).hexdigest()
+    return int(digest[:15], 16)
+
+
+def image_key(image: dict) -> str:
+    """Content hash of a catalog image, its storage path if it was never detected."""
+    return image_sha(os.path.join(ROOT_DIR, image["path"])) or image["storage_path"]
+
+
+def largest_box(image: dict, class_id: int) -> Optional[List[float]]:
+    """Largest (ymin, xmin, ymax, xmax) box of `class_id` in a catalog image."""
+    boxes = [
+        box
+        for detected_class, box in zip(image["classes"], image["boxes"])
+        if detected_class == class_id
+    ]
+    if not boxes:
+        return None
+    return max(boxes, key=lambda b: (b[2] - b[0]) * (b[3] - b[1]))
+
+
+def catalog_references() -> Dict[int, List[dict]]:
+    """Reference images of every catalogued product, by detection class.
+
+    Each image is cropped to the largest box of its product's class, or kept
+    whole when none was detected.
+    """
+    taxonomy = load_taxonomy()
+    catalog = read_catalog(
+        ["brand", "product_id", "product_name", "category", "images"]
+    )
+    references, seen = {}, set()
+    for product in catalog.iter_rows(named=True):
+        class_id = taxonomy.get(product["category"])
+        if class_id is None or not product["product_id"] or not product["images"]:
+            continue
+        for image in product["images"]:
+            key = image_key(image)
+            id_ = reference_id(product["product_id"], key)
+            # Variants listed as separate products can repeat a product id
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            references.setdefault(class_id, []).append(
+                {
+                    "id": id_,
+                    "product_id": product["product_id"],
+                    "product_name": product["product_name"],
+                    "brand": product["brand"],
+                    "category": product["category"],
+                    "image_path": image["path"],
+                    "image_key": key,
+                    "box": largest_box(image, class_id),
+                }
+            )
+    return references
+
+
+def encoder_config() -> dict:
+    """Settings that change embeddings, stored with every saved generation."""
+    return {"model": EMBED_MODEL, "image_size": EMBED_IMAGE_SIZE}
+
+
+def new_hnsw_index(dim: int):
+    index = faiss.IndexHNSWFlat(dim, VISUAL_INDEX_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = VISUAL_INDEX_EF_CONSTRUCTION
+    return index
+
+
+class CategoryIndex:
+    """HNSW inner-product index over the embeddings of one detection class.
+
+    Vectors are appended under sequential slots and never removed in place:
+    deleting or re-embedding a reference tombstones its old slot, searches
+    skip tombstoned slots, and `compact` rebuilds the graph from the live
+    vectors. Each save writes a new generation directory and then repoints
+    CURRENT, so readers in other processes never load a half-written pair.
+    Generations record the encoder config their vectors were embedded with.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self.lock = threading.RLock()
+        self.index = None
+        self.generation = None
+        self.encoder: Optional[dict] = None
+        self.references: Dict[int, dict] = {}  # id -> reference with its slot
+        self.slot_ids = np.zeros(0, dtype=np.int64)
+        self.tombstones = set()
+        self.selector = None
+        self.load()
+
+    @property
+    def current_path(self) -> str:
+        return os.path.join(self.index_dir, "CURRENT")
+
+    def current_generation(self) -> Optional[str]:
+        try:
+            with open(self.current_path, "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        generation = self.current_generation()
+        if generation is None:
+            return
+        generation_dir = os.path.join(self.index_dir, generation)
+        index = faiss.read_index(os.path.join(generation_dir, "index.faiss"))
+        references = pl.read_parquet(os.path.join(generation_dir, "references.parquet"))
+        try:
+            with open(os.path.join(generation_dir, "encoder.json"), "r") as f:
+                encoder = json.load(f)
+        except FileNotFoundError:
+            # Saved before encoder configs were recorded
+            encoder = None
+        with self.lock:
+            self.index = index
+            self.generation = generation
+            self.encoder = encoder
+            self.references = {
+                row["id"]: row for row in references.iter_rows(named=True)
+            }
+            self.slot_ids = np.full(index.ntotal, -1, dtype=np.int64)
+            for id_, reference in self.references.items():
+                self.slot_ids[reference["slot"]] = id_
+            self.tombstones = set(np.flatnonzero(self.slot_ids < 0).tolist())
+            self.selector = None
+
+    def refresh(self):
+        """Reloads the partition if another process saved a newer generation."""
+        if self.current_generation() != self.generation:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.references)
+
+    @property
+    def tombstone_ratio(self) -> float:
+        return len(self.tombstones) / max(len(self.slot_ids), 1)
+
+    def reset(self, encoder: dict):
+        """Drops every vector and reference, e.g. to re-embed with another encoder."""
+        with self.lock:
+            self.index = None
+            self.encoder = encoder
+            self.references = {}
+            self.slot_ids = np.zeros(0, dtype=np.int64)
+            self.tombstones = set()
+            self.selector = None
+
+    def _tombstone(self, slot: int):
+        self.tombstones.add(slot)
+        self.selector = None
+
+    def upsert(self, vectors: np.ndarray, references: List[dict]):
+        """Adds references under new slots, tombstoning slots they replace."""
+        with self.lock:
+            if self.index is None:
+                self.index = new_hnsw_index(vectors.shape[1])
+            start = self.index.ntotal
+            self.index.add(vectors)
+            ids = np.array(
+                [reference["id"] for reference in references], dtype=np.int64
+            )
+            self.slot_ids = np.concatenate([self.slot_ids, ids])
+            for slot, reference in enumerate(references, start):
+                replaced = self.references.get(reference["id"])
+                if replaced is not None:
+                    self._tombstone(replaced["slot"])
+                self.references[reference["id"]] = {**reference, "slot": slot}
+
+    def update_references(self, references: List[dict]):
+        """Replaces reference rows whose embedding is unchanged, keeping their slots."""
+        with self.lock:
+            for reference in references:
+                slot = self.references[reference["id"]]["slot"]
+                self.references[reference["id"]] = {**reference, "slot": slot}
+
+    def delete(self, ids: List[int]):
+        with self.lock:
+            for id_ in ids:
+                reference = self.references.pop(id_, None)
+                if reference is not None:
+                    self._tombstone(reference["slot"])
+
+    def search(
+        self, vectors: np.ndarray, k: int = VISUAL_SEARCH_TOP_K
+    ) -> List[List[dict]]:
+        """References nearest to each vector, with their cosine similarity as score."""
+        with self.lock:
+            if self.index is None or not len(self):
+                return [[] for _ in vectors]
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = max(VISUAL_INDEX_EF_SEARCH, k)
+            if self.tombstones:
+                if self.selector is None:
+                    tombstones = np.fromiter(self.tombstones, dtype=np.int64)
+                    self.selector = faiss.IDSelectorNot(
+                        faiss.IDSelectorBatch(tombstones)
+                    )
+                params.sel = self.selector
+            scores, slots = self.index.search(vectors, min(k, len(self)), params=params)
+            return [
+                [
+                    {**self.references[self.slot_ids[slot]], "score": float(score)}
+                    for score, slot in zip(row_scores, row_slots)
+                    if slot >= 0 and slot not in self.tombstones
+                ]
+                for row_scores, row_slots in zip(scores, slots.tolist())
+            ]
+
+    def compact(self):
+        """Rebuilds the graph from live vectors only, dropping tombstoned slots."""
+        with self.lock:
+            if self.index is None or not self.tombstones:
+                return
+            live = sorted(
+                self.references.values(), key=lambda reference: reference["slot"]
+            )
+            slots = np.array([reference["slot"] for reference in live], dtype=np.int64)
+            index = new_hnsw_index(self.index.d)
+            if len(slots):
+                index.add(self.index.reconstruct_batch(slots))
+            removed = len(self.tombstones)
+            self.index = index
+            self.references = {
+                reference["id"]: {**reference, "slot": slot}
+                for slot, reference in enumerate(live)
+            }
+            self.slot_ids = np.array(
+                [reference["id"] for reference in live], dtype=np.int64
+            )
+            self.tombstones = set()
+            self.selector = None
+            self.save()
+        logger.info(f"Compacted {self.index_dir}, dropped {removed} tombstones")
+
+    def save(self):
+        """Writes a new generation and points CURRENT at it.
+
+        The previous generation is kept for readers still loading it, older
+        ones are removed. A partition emptied by `reset` unpoints CURRENT.
+        """
+        with self.lock:
+            if self.index is None:
+                if self.generation is not None and os.path.exists(self.current_path):
+                    os.remove(self.current_path)
+                    self.generation = None
+                return
+            timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+            generation = f"gen-{timestamp}-{os.getpid()}"
+            generation_dir = os.path.join(self.index_dir, generation)
+            os.makedirs(generation_dir)
+            faiss.write_index(self.index, os.path.join(generation_dir, "index.faiss"))
+            references = pl.DataFrame(
+                list(self.references.values()), schema=REFERENCE_SCHEMA
+            )
+            references.write_parquet(
+                os.path.join(generation_dir, "references.parquet")
+            )
+            with open(os.path.join(generation_dir, "encoder.json"), "w") as f:
+                json.dump(self.encoder, f)
+            with open(f"{self.current_path}.tmp", "w") as f:
+                f.write(generation)
+            os.replace(f"{self.current_path}.tmp", self.current_path)
+
+            previous = self.generation
+            self.generation = generation
+            for stale in glob.glob(os.path.join(self.index_dir, "gen-*")):
+                if os.path.basename(stale) not in (generation, previous):
+                    shutil.rmtree(stale, ignore_errors=True)
+
+
+class VisualIndex:
+    """Per-class partitions under VISUAL_INDEX_DIR.
+
+    Partitions are loaded on first use and reloaded when the updater has
+    saved a newer generation.
+    """
+
+    def __init__(self, index_dir: str = VISUAL_INDEX_DIR):
+        self.index_dir = index_dir
+        self.partitions: Dict[int, CategoryIndex] = {}
+
+    def partition(self, class_id: int) -> Optional[CategoryIndex]:
+        if class_id not in self.partitions:
+            partition_dir = os.path.join(self.index_dir, str(class_id))
+            if not os.path.exists(os.path.join(partition_dir, "CURRENT")):
+                return None
+            self.partitions[class_id] = CategoryIndex(partition_dir)
+        partition = self.partitions[class_id]
+        partition.refresh()
+        # Vectors of another encoder are not comparable until the updater rebuilds
+        if partition.encoder != encoder_config():
+            logger.warning(
+                f"Skipping {partition.index_dir}, built with another encoder"
+            )
+            return None
+        return partition
+
+    def class_ids(self) -> List[int]:
+        return sorted(
+            int(os.path.basename(path))
+            for path in glob.glob(os.path.join(self.index_dir, "*"))
+            if os.path.basename(path).isdigit()
+        )
+
+
+def search_image(
+    image_bytes: bytes, index: VisualIndex, k: int = VISUAL_SEARCH_TOP_K
+) -> Optional[List[dict]]:
+    """Detects garments in an image and finds similar products for each.
+
+    Returns one entry per detection with an indexed class: its class id and
+    name, detection score, (ymin, xmin, ymax, xmax) box and the results, best
+    match per product first. Returns None if the detection service failed.
+    """
+    detections = detect_image(image_bytes)
+    if detections is None:
+        return None
+
+    label_map = load_label_map()
+    segments, crops = [], []
+    for box, class_id, score in zip(
+        detections["boxes"], detections["classes"], detections["scores"]
+    ):
+        if index.partition(class_id) is None:
+            continue
+        crop = load_crop(io.BytesIO(image_bytes), box)
+        if crop is None:
+            continue
+        segments.append(
+            {
+                "class_id": class_id,
+                "name": label_map.get(class_id, str(class_id)),
+                "score": score,
+                "box": box,
+            }
+        )
+        crops.append(crop)
+    if not segments:
+        return []
+
+    vectors = embed_images(np.stack(crops))
+    for segment, vector in zip(segments, vectors):
+        results = index.partition(segment["class_id"]).search(vector[None], k)[0]
+        # Several images of a product can match; keep its best one
+        best = {}
+        for result in results:
+            best.setdefault(result["product_id"], result)
+        segment["results"] = list(best.values())
+    return segments
+
+
+def diff_references(current: Dict[int, dict], indexed: Dict[int, dict]):
+    """Splits the current references against the indexed snapshot.
+
+    Returns references to embed (new or re-cropped), references whose
+    metadata alone changed, and ids of indexed references no longer current.
+    """
+    to_embed, to_update = [], []
+    for id_, reference in current.items():
+        snapshot = indexed.get(id_)
+        if snapshot is None or any(
+            snapshot[column] != reference[column] for column in EMBEDDING_COLUMNS
+        ):
+            to_embed.append(reference)
+        elif any(snapshot[column] != reference[column] for column in METADATA_COLUMNS):
+            to_update.append(reference)
+    to_delete = [id_ for id_ in indexed if id_ not in current]
+    return to_embed, to_update, to_delete
+
+
+def update_partition(partition: CategoryIndex, current: Dict[int, dict]) -> bool:
+    """Applies the diff between current references and a partition's snapshot.
+
+    Only new or re-cropped references are embedded, unless the partition was
+    built with another encoder config, in which case it is rebuilt from
+    scratch. Returns whether the partition changed.
+    """
+    encoder = encoder_config()
+    rebuild = partition.generation is not None and partition.encoder != encoder
+    if rebuild:
+        logger.info(
+            f"Rebuilding {partition.index_dir} for encoder {encoder}, "
+            f"was {partition.encoder}"
+        )
+        partition.reset(encoder)
+    partition.encoder = encoder
+
+    to_embed, to_update, to_delete = diff_references(current, partition.references)
+    if not (rebuild or to_embed or to_update or to_delete):
+        return False
+
+    crops = [
+        (os.path.join(ROOT_DIR, reference["image_path"]), reference["box"])
+        for reference in to_embed
+    ]
+    vectors, embedded = embed_crops(crops)
+    partition.delete(to_delete)
+    partition.update_references(to_update)
+    if embedded:
+        partition.upsert(vectors, [to_embed[i] for i in embedded])
+    partition.save()
+    logger.info(
+        f"Updated {partition.index_dir}: {len(embedded)} upserted, "
+        f"{len(to_update)} relabelled, {len(to_delete)} deleted, "
+        f"{len(partition.tombstones)} tombstones"
+    )
+    return True
+
+
+def compact_partition(partition: CategoryIndex):
+    try:
+        partition.compact()
+    except Exception as e:
+        logger.error(f"Error compacting {partition.index_dir}: {e}")
+
+
+def update_index(index_dir: str = VISUAL_INDEX_DIR):
+    """Brings every class partition up to date with the catalog.
+
+    Partitions whose tombstones pass VISUAL_INDEX_MAX_TOMBSTONES are
+    compacted in the background while later partitions are embedded.
+    """
+    references = catalog_references()
+    index = VisualIndex(index_dir)
+    class_ids = sorted(set(references) | set(index.class_ids()))
+    with ThreadPoolExecutor(max_workers=VISUAL_INDEX_COMPACT_WORKERS) as compactor:
+        for class_id in class_ids:
+            partition = CategoryIndex(os.path.join(index_dir, str(class_id)))
+            current = {
+                reference["id"]: reference for reference in references.get(class_id, [])
+            }
+            try:
+                update_partition(partition, current)
+            except Exception as e:
+                logger.error(f"Error updating visual index class {class_id}: {e}")
+                continue
+            if partition.tombstone_ratio > VISUAL_INDEX_MAX_TOMBSTONES:
+                compactor.submit(compact_partition, partition)
+
+
+def main():
+    """Updates the index once, or every VISUAL_INDEX_UPDATE_INTERVAL seconds if set."""
+    while True:
+        update_index()
+        if not VISUAL_INDEX_UPDATE_INTERVAL:
+            return
+        time.sleep(VISUAL_INDEX_UPDATE_INTERVAL)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    logger.info("Starting visual index update")
+    main()
+    logger.info(
+        f"Completed visual index update. Execution time: {timedelta(seconds=time.time() - start_time)}"
+    )
@@ -4,7 +4,12 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 from google.cloud import storage
 from processing.logger import logger
-from processing.utils.utils import download_from_gcs
+from processing.utils.utils import (
+    download_from_gcs,
+    COMPACTED_GROUPS,
+    delete_removed_locally,
+)
+from processing.utils.blob_store import IMAGE_STORE, get_blob_store
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 import threading
@@ -15,6 +20,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BUCKET_NAME = os.getenv("BUCKET_NAME")
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
 OVERWRITE_LOCAL = os.getenv("OVERWRITE_LOCAL") == "True"
 
 
@@ -58,6 +64,24 @@ def main():
     indices = client.list_blobs(BUCKET_NAME, prefix="indices/")
     thread(indices, bucket, download_count, download_lock)
 
+    detections = client.list_blobs(BUCKET_NAME, prefix="detections/")
+    thread(detections, bucket, download_count, download_lock)
+
+    catalog = client.list_blobs(BUCKET_NAME, prefix="catalog/")
+    thread(catalog, bucket, download_count, download_lock)
+
+    for group in COMPACTED_GROUPS:
+        delete_removed_locally(group)
+
+    visual_index = client.list_blobs(BUCKET_NAME, prefix="visual_index/")
+    thread(visual_index, bucket, download_count, download_lock)
+
+    # Blobs and their links are only used with the image store enabled
+    if IMAGE_STORE:
+        blobs = client.list_blobs(BUCKET_NAME, prefix="blobs/")
+        thread(blobs, bucket, download_count, download_lock)
+        get_blob_store().restore_links()
+
     logger.info(f"Total downloaded files: {download_count[0]}")
 
 if __name__ == "__main__":
@@ -5,7 +5,11 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".
 from google.cloud import storage
 import glob
 from processing.logger import logger
-from processing.utils.utils import upload_to_gcs
+from processing.utils.utils import (
+    upload_to_gcs,
+    COMPACTED_GROUPS,
+    delete_removed_from_gcs,
+)
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
@@ -41,6 +45,10 @@ def main(upload_list='all'):
         'listing': glob.glob(os.path.join(ROOT_DIR, "listing/**/*")),
         'details': glob.glob(os.path.join(ROOT_DIR, "details/**/*"), recursive=True),
         'indices': glob.glob(os.path.join(ROOT_DIR, "indices/*")),
+        'blobs': glob.glob(os.path.join(ROOT_DIR, "blobs/**/*"), recursive=True),
+        'catalog': glob.glob(os.path.join(ROOT_DIR, "catalog/**/*"), recursive=True),
+        'detections': glob.glob(os.path.join(ROOT_DIR, "detections/**/*"), recursive=True),
+        'visual_index': glob.glob(os.path.join(ROOT_DIR, "visual_index/**/*"), recursive=True),
     }
 
     # Select files to upload
@@ -52,8 +60,8 @@ def main(upload_list='all'):
         logger.error("Invalid upload_list argument")
         return
 
-    # Filter only valid files
-    files = [file for file in files if os.path.isfile(file)]
+    # Filter only valid files, symlinks into the blob store are restored from its index
+    files = [file for file in files if os.path.isfile(file) and not os.path.islink(file)]
     if not files:
         logger.info("No files to upload.")
         return
@@ -76,6 +84,12 @@ def main(upload_list='all'):
 
     logger.info(f"Total uploaded files: {upload_count}")
 
+    # After the upload, so compacted files are in GCS before their sources go
+    groups = file_groups if upload_list == 'all' else upload_list
+    for group in COMPACTED_GROUPS:
+        if group in groups:
+            delete_removed_from_gcs(bucket, group)
+
 
 if __name__ == "__main__":
     start_time = time.time()
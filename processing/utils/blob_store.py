@@ -0,0 +1,204 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+import json
+import hashlib
+import numpy as np
+from threading import Lock
+from typing import Dict, List, Optional
+from PIL import Image
+from processing.logger import logger
+from processing.utils.utils import create_dir_if_not_exists, save_json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+BLOB_DIR = os.path.join(ROOT_DIR, "blobs")
+IMAGE_STORE = os.getenv("IMAGE_STORE") == "True"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 4))
+
+PHASH_SIZE = 32
+PHASH_LOW_FREQ = 8
+# Splitting the 64 bits into max_distance + 1 bands guarantees that hashes
+# within max_distance share at least one band exactly (pigeonhole)
+PHASH_BANDS = [
+    (int(band[0]), int(band[-1]) + 1)
+    for band in np.array_split(np.arange(64), PHASH_MAX_DISTANCE + 1)
+]
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SIZE)
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def perceptual_hash(path: str) -> int:
+    """64-bit DCT perceptual hash of an image file."""
+    with Image.open(path) as image:
+        image.draft("L", (PHASH_SIZE * 2, PHASH_SIZE * 2))
+        pixels = np.asarray(
+            image.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR),
+            dtype=np.float64,
+        )
+    dct = DCT_MATRIX @ pixels @ DCT_MATRIX.T
+    low_freq = dct[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ].flatten()
+    bits = low_freq > np.median(low_freq[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def band_keys(phash: int):
+    bits = f"{phash:064b}"
+    return [(i, bits[start:end]) for i, (start, end) in enumerate(PHASH_BANDS)]
+
+
+class BlobStore:
+    """Content-addressed image store under blobs/.
+
+    Each distinct image is stored once as blobs/<sha[:2]>/<sha><ext>. Product
+    image paths become relative symlinks to the canonical blob, and images
+    whose perceptual hash is within PHASH_MAX_DISTANCE of a stored one are
+    collapsed onto it.
+    """
+
+    def __init__(self, blob_dir: str = BLOB_DIR):
+        self.blob_dir = blob_dir
+        self.index_path = os.path.join(blob_dir, "index.json")
+        self.lock = Lock()
+        self.blobs: Dict[str, dict] = {}  # sha -> phash, canonical sha, ext
+        self.links: Dict[str, str] = {}  # image path relative to ROOT_DIR -> sha
+        self.bands: Dict[tuple, List[str]] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            logger.error(f"Error decoding blob index {self.index_path}: {e}")
+            return
+
+        self.blobs = index.get("blobs", {})
+        self.links = index.get("links", {})
+        for sha, blob in self.blobs.items():
+            if blob["canonical"] == sha:
+                self._add_bands(sha, int(blob["phash"], 16))
+        logger.info(f"Loaded blob index with {len(self.blobs)} blobs")
+
+    def save(self):
+        with self.lock:
+            save_json({"blobs": self.blobs, "links": self.links}, self.index_path)
+
+    def _add_bands(self, sha: str, phash: int):
+        for key in band_keys(phash):
+            self.bands.setdefault(key, []).append(sha)
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.blob_dir, sha[:2], sha + self.blobs[sha]["ext"])
+
+    def find_near_duplicate(self, phash: int) -> Optional[str]:
+        candidates = {sha for key in band_keys(phash) for sha in self.bands.get(key, [])}
+        best = min(
+            candidates,
+            key=lambda sha: hamming_distance(phash, int(self.blobs[sha]["phash"], 16)),
+            default=None,
+        )
+        if best and hamming_distance(phash, int(self.blobs[best]["phash"], 16)) <= PHASH_MAX_DISTANCE:
+            return best
+        return None
+
+    def store(self, file_path: str) -> str:
+        """Moves a downloaded image into the store and links it back.
+
+        Returns the sha256 of the canonical blob the path now points to.
+        """
+        sha = file_sha256(file_path)
+        phash = perceptual_hash(file_path)
+
+        with self.lock:
+            if sha in self.blobs:
+                canonical = self.blobs[sha]["canonical"]
+            else:
+                canonical = self.find_near_duplicate(phash) or sha
+                self.blobs[sha] = {
+                    "phash": f"{phash:016x}",
+                    "canonical": canonical,
+                    "ext": os.path.splitext(file_path)[1] or ".jpg",
+                }
+                if canonical == sha:
+                    self._add_bands(sha, phash)
+                    blob_path = self.blob_path(sha)
+                    create_dir_if_not_exists(os.path.dirname(blob_path))
+                    os.replace(file_path, blob_path)
+                else:
+                    logger.info(f"Collapsed near-duplicate {file_path} onto blob {canonical}")
+
+        self.link(file_path, canonical)
+        return canonical
+
+    def link(self, file_path: str, sha: str):
+        """Points `file_path` at the blob `sha` with a relative symlink."""
+        blob_path = self.blob_path(sha)
+        temp_path = f"{file_path}.link"
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        os.symlink(os.path.relpath(blob_path, os.path.dirname(file_path)), temp_path)
+        os.replace(temp_path, file_path)
+        with self.lock:
+            self.links[os.path.relpath(file_path, ROOT_DIR)] = sha
+
+    def restore_links(self):
+        """Recreates product image symlinks, e.g. after syncing from GCS."""
+        restored = 0
+        for rel_path, sha in list(self.links.items()):
+            file_path = os.path.join(ROOT_DIR, rel_path)
+            if os.path.lexists(file_path) or not os.path.isfile(self.blob_path(sha)):
+                continue
+            create_dir_if_not_exists(os.path.dirname(file_path))
+            self.link(file_path, sha)
+            restored += 1
+        logger.info(f"Restored {restored} image links from the blob store")
+
+
+_blob_store = None
+_blob_store_lock = Lock()
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore()
+        return _blob_store
+
+
+def group_by_blob(image_paths: List[str]) -> Dict[str, List[str]]:
+    """Groups image paths that resolve to the same stored file, keeping order."""
+    groups = {}
+    for image_path in image_paths:
+        groups.setdefault(os.path.realpath(image_path), []).append(image_path)
+    return groups
+
+
+def storage_path(image_path: str) -> str:
+    """Path of the file actually holding an image, relative to ROOT_DIR."""
+    return os.path.relpath(os.path.realpath(image_path), ROOT_DIR)
@@ -2,11 +2,13 @@ import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+import glob
 import json
 import re
 from pathlib import Path
 from processing.logger import logger
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -40,6 +42,66 @@ def save_json(data: dict, file_path: str):
     logger.info(f"Saved data to {file_path}")
 
 
+def record_removed(directory: str, name: str, removed_files: list):
+    """Writes a tombstone of files compaction removed from `directory`.
+
+    Tombstones live in `directory`/_removed under a unique `name`, so they are
+    uploaded like any new file and let syncs delete the removed files' copies
+    in GCS and on other machines.
+    """
+    save_json(
+        [os.path.relpath(path, ROOT_DIR) for path in removed_files],
+        os.path.join(directory, "_removed", f"{name}.json"),
+    )
+
+
+def removed_files(directory: str) -> list:
+    """Paths, relative to ROOT_DIR, of every file tombstoned in `directory`."""
+    removed = []
+    for tombstone in glob.glob(os.path.join(directory, "_removed", "*.json")):
+        try:
+            with open(tombstone, "r") as f:
+                removed.extend(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Error reading tombstone {tombstone}: {e}")
+    return removed
+
+
+# Groups whose compaction removes files, see record_removed
+COMPACTED_GROUPS = ["catalog", "detections"]
+
+
+def delete_removed_from_gcs(bucket, group: str):
+    """Deletes the GCS copies of files compaction removed from a group."""
+    deleted = 0
+    for rel_path in removed_files(os.path.join(ROOT_DIR, group)):
+        # Named like upload_to_gcs names the uploaded file
+        blob = bucket.blob(Path(os.path.join(ROOT_DIR, rel_path)).as_posix())
+        try:
+            blob.delete()
+            deleted += 1
+        except NotFound:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to delete removed file {rel_path} from GCS: {e}")
+    if deleted:
+        logger.info(f"Deleted {deleted} compacted {group} files from GCS")
+
+
+def delete_removed_locally(group: str):
+    """Deletes local copies of files that compaction removed elsewhere."""
+    for rel_path in removed_files(os.path.join(ROOT_DIR, group)):
+        local_path = os.path.join(ROOT_DIR, rel_path)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+            logger.info(f"Removed compacted file {local_path}")
+            # Drop directories left empty
+            try:
+                os.rmdir(os.path.dirname(local_path))
+            except OSError:
+                pass
+
+
 def sanitize_product_name(product_name):
     sanitized_name = re.sub(r"[\n\t\/\|]+", " ", product_name).strip()
     return sanitized_name
@@ -1,10 +1,15 @@
+import os
 import streamlit as st
 from google.cloud import vision
 import requests
 from io import BytesIO
-import glob
 import numpy as np
 from PIL import Image
+from processing.extraction.catalog import catalog_version, read_catalog
+
+# "vision" queries Google Vision product sets, "local" the visual index built
+# by processing/indexing/visual_index.py
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "vision")
 
 CATEGORY_MAPPING = {
     "shirt": ["sweater", "shirt|blouse", "top|t-shirt|sweatshirt", "vest"],
@@ -60,6 +65,28 @@ def get_similar_products_file(project_id, location, product_set_id, product_cate
     response = image_annotator_client.product_search(image, image_context=image_context, max_results=max_results)
     return response.product_search_results.results, response.product_search_results.product_grouped_results
 
+@st.cache_resource(max_entries=1)
+def get_catalog_images(version):
+    """Map product name to (brand, image paths) from one scan of the product catalog.
+
+    Keyed on the catalog version so products extracted or synced since are picked up.
+    """
+    catalog = read_catalog(["brand", "product_name", "images"])
+    return {
+        product["product_name"]: (
+            product["brand"],
+            [image["path"] for image in product["images"]],
+        )
+        for product in catalog.iter_rows(named=True)
+    }
+
+@st.cache_resource
+def get_visual_index():
+    """Visual index partitions, kept loaded across queries."""
+    from processing.indexing.visual_index import VisualIndex
+
+    return VisualIndex()
+
 def segment_images(group_results, img_shape, img):
     """Extract segmented images from bounding boxes."""
     output = []
@@ -91,26 +118,82 @@ def toggle_item(item):
         st.session_state["selected_items"].add(item)
 
 
-def display_related_images(segment_similar, tab_name, tab_order):
-    """Display images in the selected tab."""
-    product_images = {}
-    for related_img in segment_similar:
-        product_name = related_img.product.display_name
+def vision_results(group_result, tab_name):
+    """Related products of a Vision segment in the tab's categories."""
+    results = []
+    valid_categories = CATEGORY_MAPPING.get(tab_name.lower(), None)
+    for related_img in group_result.results:
         category = next((label.value for label in related_img.product.product_labels if label.key == "category"), None)
-        mapped_category = map_category(category)
-        valid_categories = CATEGORY_MAPPING.get(tab_name.lower(), None)
         if valid_categories and category.lower() in valid_categories:
-            img_files = glob.glob(f"details/**/{product_name}/images/*.[jp][pn]g")
-            if img_files:
-                img_loc = img_files[0]
-                product_images[product_name] = {
-                    "img_loc": img_loc,
-                    "score": related_img.score,
-                    "brand": img_loc.split("/")[1],
-                    "category": mapped_category,
-                    "original_category": category,
-                    "all_images": img_files[1:] if len(img_files) > 1 else []
+            results.append({
+                "product_name": related_img.product.display_name,
+                "score": related_img.score,
+                "category": map_category(category),
+                "original_category": category,
+            })
+    return results
+
+def vision_search(input_image, img_array, index):
+    """Segments as (crop, name, score, results) from Google Vision product search."""
+    related_images, segments = get_similar_products_file(
+        project_id="argon-producer-437209-a7",
+        location="us-east1",
+        product_set_id=index,
+        product_category="apparel-v2",
+        file_path=input_image
+    )
+    segmented_images = segment_images(segments, img_array.shape, img_array)
+    return [
+        (seg_img, annot.name, annot.score, vision_results(segment, segment.object_annotations[0].name))
+        for segment, (seg_img, annot) in zip(segments, segmented_images)
+    ]
+
+def local_search(input_image, img_array):
+    """Segments as (crop, name, score, results) from the local visual index.
+
+    None if the detection service could not be reached.
+    """
+    from processing.indexing.visual_index import search_image
+
+    segments = search_image(input_image, get_visual_index())
+    if segments is None:
+        return None
+    return [
+        (
+            img_array[int(ymin):int(ymax), int(xmin):int(xmax)],
+            segment["name"],
+            segment["score"],
+            [
+                {
+                    "product_name": result["product_name"],
+                    "score": result["score"],
+                    "category": segment["name"],
+                    "original_category": result["category"],
                 }
+                for result in segment["results"]
+            ],
+        )
+        for segment in segments
+        for ymin, xmin, ymax, xmax in [segment["box"]]
+    ]
+
+def display_related_images(results, tab_order):
+    """Display images in the selected tab."""
+    product_images = {}
+    catalog_images = get_catalog_images(catalog_version())
+    for result in results:
+        product_name = result["product_name"]
+        brand, img_files = catalog_images.get(product_name, (None, []))
+        if img_files:
+            img_loc = img_files[0]
+            product_images[product_name] = {
+                "img_loc": img_loc,
+                "score": result["score"],
+                "brand": brand,
+                "category": result["category"],
+                "original_category": result["original_category"],
+                "all_images": img_files[1:] if len(img_files) > 1 else []
+            }
 
     num_cols = 7
     max_images = num_cols * 3
@@ -181,22 +264,22 @@ elif image_url:
 
 if input_image:
     st.image(input_image, caption="Input Image", use_container_width="auto")
-    index = st.selectbox("Select an Index", ('test-set', 'set_A', 'set_B'))
-    related_images, segments = get_similar_products_file(
-        project_id="argon-producer-437209-a7",
-        location="us-east1",
-        product_set_id=index,
-        product_category="apparel-v2",
-        file_path=input_image
-    )
-    segmented_images = segment_images(segments, img_array.shape, img_array)
-    seg_cols = st.columns(len(segments))
-    for idx, (seg_img, annot) in enumerate(segmented_images):
-        seg_cols[idx % 5].image(seg_img, use_container_width="auto", caption=f"{annot.name}\n{round(annot.score, 5)}")
-    
-    st.write("Similar Images:")
-    tab_names = [s.object_annotations[0].name for s in segments]
-    similar_tabs = st.tabs(tab_names)
-    for i, tab in enumerate(similar_tabs):
-        with tab:
-            display_related_images(segments[i].results, tab_names[i], i)
+    if SEARCH_BACKEND == "local":
+        segments = local_search(input_image, img_array)
+    else:
+        index = st.selectbox("Select an Index", ('test-set', 'set_A', 'set_B'))
+        segments = vision_search(input_image, img_array, index)
+    if segments is None:
+        st.error("The detection service is unavailable, please try again later.")
+    elif segments:
+        seg_cols = st.columns(len(segments))
+        for idx, (seg_img, name, score, _) in enumerate(segments):
+            seg_cols[idx % 5].image(seg_img, use_container_width="auto", caption=f"{name}\n{round(score, 5)}")
+
+        st.write("Similar Images:")
+        similar_tabs = st.tabs([name for _, name, _, _ in segments])
+        for i, tab in enumerate(similar_tabs):
+            with tab:
+                display_related_images(segments[i][3], i)
+    else:
+        st.write("No products detected in the image.")
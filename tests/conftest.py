@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Pipeline modules import their siblings by name, as when run as scripts
+for module_dir in (
+    "processing/indexing",
+    "processing/detection",
+    "processing/collection",
+    "",
+):
+    sys.path.insert(0, os.path.join(ROOT_DIR, module_dir))
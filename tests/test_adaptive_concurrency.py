@@ -0,0 +1,43 @@
+import asyncio
+
+from rate_limit import AdaptiveConcurrency
+
+
+def test_burst_of_throttles_halves_the_limit_once():
+    async def burst():
+        concurrency = AdaptiveConcurrency("listing", maximum=64)
+        assert concurrency.limit == 16
+        started = [await concurrency.acquire() for _ in range(8)]
+        for start in started:
+            await concurrency.release(start, throttled=True)
+        after_burst = concurrency.limit
+
+        # A request sent after the decrease can lower it again
+        await concurrency.release(await concurrency.acquire(), throttled=True)
+        return after_burst, concurrency.limit
+
+    assert asyncio.run(burst()) == (8, 4)
+
+
+def test_successes_grow_the_limit_up_to_the_maximum():
+    async def successes():
+        concurrency = AdaptiveConcurrency("listing", maximum=8)
+        for _ in range(200):
+            await concurrency.release(await concurrency.acquire())
+        return concurrency.limit
+
+    assert asyncio.run(successes()) == 8
+
+
+def test_acquire_waits_for_a_free_slot():
+    async def saturate():
+        concurrency = AdaptiveConcurrency("listing", maximum=4, minimum=1)
+        held = await concurrency.acquire()
+        waiter = asyncio.ensure_future(concurrency.acquire())
+        await asyncio.sleep(0.01)
+        blocked = not waiter.done()
+        await concurrency.release(held)
+        await asyncio.wait_for(waiter, 1)
+        return blocked
+
+    assert asyncio.run(saturate())
@@ -0,0 +1,77 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from processing.utils import blob_store
+from processing.utils.blob_store import (
+    BlobStore,
+    group_by_blob,
+    hamming_distance,
+    perceptual_hash,
+)
+
+
+def photo(path, seed=0, noise=0, quality=95):
+    """Smooth random image, saved as a JPEG with optional pixel noise."""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8))
+    pixels = np.asarray(coarse.resize((128, 128), Image.BICUBIC), dtype=np.float64)
+    if noise:
+        pixels += np.random.default_rng(100).normal(0, noise, pixels.shape)
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(
+        path, quality=quality
+    )
+    return str(path)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(blob_store, "ROOT_DIR", str(tmp_path))
+    (tmp_path / "details").mkdir()
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+def test_perceptual_hash_tolerates_recompression(tmp_path):
+    original = perceptual_hash(photo(tmp_path / "a.jpg"))
+    recompressed = perceptual_hash(photo(tmp_path / "b.jpg", noise=2, quality=60))
+    other = perceptual_hash(photo(tmp_path / "c.jpg", seed=1))
+    assert hamming_distance(original, recompressed) <= blob_store.PHASH_MAX_DISTANCE
+    assert hamming_distance(original, other) > blob_store.PHASH_MAX_DISTANCE
+
+
+def test_exact_and_near_duplicates_share_one_blob(store, tmp_path):
+    details = tmp_path / "details"
+    first = photo(details / "first.jpg")
+    copy = str(details / "copy.jpg")
+    shutil.copy(first, copy)
+    near = photo(details / "near.jpg", noise=2, quality=60)
+    other = photo(details / "other.jpg", seed=1)
+
+    canonical = store.store(first)
+    assert store.store(copy) == canonical
+    assert store.store(near) == canonical
+    assert store.store(other) != canonical
+
+    for path in (first, copy, near):
+        assert os.path.islink(path)
+        assert os.path.realpath(path) == os.path.realpath(store.blob_path(canonical))
+    groups = group_by_blob([first, copy, near, other])
+    assert sorted(map(len, groups.values())) == [1, 3]
+    # The near duplicate's own bytes are not kept as a second blob
+    stored = [name for _, _, files in os.walk(store.blob_dir) for name in files]
+    assert len(stored) == 2
+
+
+def test_index_round_trip_restores_links(store, tmp_path):
+    path = photo(tmp_path / "details" / "image.jpg")
+    canonical = store.store(path)
+    store.save()
+    os.remove(path)
+
+    reloaded = BlobStore(store.blob_dir)
+    assert reloaded.links == {"details/image.jpg": canonical}
+    reloaded.restore_links()
+    assert os.path.realpath(path) == os.path.realpath(reloaded.blob_path(canonical))
@@ -0,0 +1,97 @@
+import csv
+import os
+
+import pytest
+
+from processing.indexing import create_import_list2
+from processing.indexing.create_import_list2 import write_diff
+
+WRITE_DATE = "20261018UTC06"
+
+
+def product(product_id, name="Parka", category="jaket-parka-wanita", images=1):
+    return {
+        "product_path": f"details/acme/{product_id}.json",
+        "product_name": name,
+        "product_id": product_id,
+        "shop_name": "Acme",
+        "price": 100,
+        "category": category,
+        "images": [
+            {
+                "path": f"details/acme/images/{product_id}_{i}.jpg",
+                "storage_path": f"images/{product_id}_{i}.jpg",
+                "classes": [5],
+                "boxes": [[10, 20, 110, 220]],
+            }
+            for i in range(images)
+        ],
+    }
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(create_import_list2, "OUTPUT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def run(output_dir, products, run_id):
+    shards = write_diff(
+        iter(products), WRITE_DATE, run_id, path=str(output_dir / "snapshot.tsv")
+    )
+    rows = {}
+    for shard in shards:
+        kind = os.path.basename(shard).rsplit("_", 1)[1].split("-")[0]
+        with open(shard, "r", newline="") as f:
+            rows.setdefault(kind, []).extend(tuple(row[:4]) for row in csv.reader(f))
+    return shards, rows
+
+
+def product_ids(rows):
+    return sorted(row[3] for row in rows)
+
+
+def test_diff_shards_against_previous_snapshot(output_dir):
+    shards, rows = run(output_dir, [product("1"), product("2", images=2)], "run1")
+    assert list(rows) == ["add"]
+    assert product_ids(rows["add"]) == ["1", "2", "2"]
+    assert all(f"_{WRITE_DATE}_run1_add-" in shard for shard in shards)
+
+    assert run(output_dir, [product("1"), product("2", images=2)], "run2") == ([], {})
+
+    _, rows = run(output_dir, [product("1", name="Coat"), product("3")], "run3")
+    assert product_ids(rows["add"]) == ["3"]
+    assert product_ids(rows["update"]) == ["1"]
+    assert product_ids(rows["delete"]) == ["2", "2"]
+
+
+def test_failed_products_are_not_deleted(output_dir):
+    run(output_dir, [product("1"), product("2")], "run1")
+
+    _, rows = run(output_dir, [product("1"), product("2", category="x")], "run2")
+    assert rows == {}
+    # The failed product stays in the snapshot, so it is diffed again next run
+    _, rows = run(output_dir, [product("1")], "run3")
+    assert product_ids(rows["delete"]) == ["2"]
+
+
+def test_failure_publishes_no_partial_shard(output_dir):
+    snapshot = output_dir / "snapshot.tsv"
+    run(output_dir, [product("1")], "run1")
+    before = snapshot.read_text()
+
+    def failing():
+        yield product("2")
+        raise RuntimeError("catalog read failed")
+
+    with pytest.raises(RuntimeError):
+        run(output_dir, failing(), "run2")
+    assert not [name for name in os.listdir(output_dir) if "run2" in name]
+    assert snapshot.read_text() == before
+
+
+def test_existing_shard_is_never_overwritten(output_dir):
+    run(output_dir, [product("1")], "run1")
+    os.remove(output_dir / "snapshot.tsv")
+    with pytest.raises(FileExistsError):
+        run(output_dir, [product("1")], "run1")
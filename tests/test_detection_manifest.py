@@ -0,0 +1,46 @@
+import os
+
+import detection_manifest
+from detection_manifest import image_sha
+
+
+def blob_group(root):
+    """Three product image paths linked to one stored blob."""
+    blob = root / "blobs" / "ab" / "blob.jpg"
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(b"image bytes")
+    group = []
+    for product in ("a", "b", "c"):
+        images = root / "details" / "acme" / product / "images"
+        images.mkdir(parents=True)
+        os.symlink(blob, images / "1.jpg")
+        group.append(str(images / "1.jpg"))
+    return group
+
+
+def test_image_sha_is_cached_by_size_and_mtime(tmp_path, monkeypatch):
+    monkeypatch.setattr(detection_manifest, "ROOT_DIR", str(tmp_path))
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"first")
+    manifest = {"images": {}, "detections": {}}
+
+    sha = image_sha(manifest, str(image))
+    assert manifest["images"]["image.jpg"]["sha"] == sha
+    manifest["images"]["image.jpg"]["sha"] = "cached"
+    assert image_sha(manifest, str(image)) == "cached"
+
+    image.write_bytes(b"second, longer")
+    assert image_sha(manifest, str(image)) not in ("cached", sha)
+
+
+def test_group_sha_records_every_path_of_a_blob(tmp_path, monkeypatch):
+    from detect import group_sha
+
+    monkeypatch.setattr(detection_manifest, "ROOT_DIR", str(tmp_path))
+    group = blob_group(tmp_path)
+    manifest = {"images": {}, "detections": {}}
+
+    sha = group_sha(manifest, group)
+
+    for path in group:
+        assert manifest["images"][os.path.relpath(path, tmp_path)]["sha"] == sha
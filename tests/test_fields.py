@@ -0,0 +1,104 @@
+from jsonpath_ng.ext import parse
+
+from processing.extraction.fields import build_product_info, collect_fields
+
+QUERIES = {
+    "basic_info": "$..basicInfo",
+    "parent_id": "$..parentID",
+    "description": "$..content[?(@.title=='Deskripsi')].subtitle",
+    "price": "$..price.value",
+}
+BREADCRUMB_URL = "https://www.tokopedia.com/p/fashion/atasan/kemeja"
+
+
+def variant(product_id, *options):
+    return {"productID": product_id, "optionName": list(options)}
+
+
+def pdp_response():
+    return [
+        {
+            "data": {
+                "children": [{"productID": "outside-layout"}],
+                "pdpGetLayout": {
+                    "basicInfo": {
+                        "id": "100",
+                        "shopID": "7",
+                        "shopName": "Acme",
+                        "url": "https://www.tokopedia.com/acme/shirt",
+                        "category": {"breadcrumbURL": BREADCRUMB_URL},
+                        "nested": {"basicInfo": {"id": "shadowed"}},
+                    },
+                    "components": [
+                        {
+                            "name": "product_content",
+                            "data": [{"price": {"value": 150000, "currency": "IDR"}}],
+                        },
+                        {
+                            "name": "product_detail",
+                            "data": [
+                                {
+                                    "content": [
+                                        {"title": "Etalase", "subtitle": "Semua"},
+                                        {"title": "Deskripsi", "subtitle": "Katun"},
+                                    ]
+                                }
+                            ],
+                        },
+                        {
+                            "name": "variant",
+                            "data": [
+                                {
+                                    "parentID": "99",
+                                    "children": [
+                                        variant("101", "Red", "S"),
+                                        variant("102", "Red", "M"),
+                                    ],
+                                },
+                                {"children": [variant("103", "Blue")]},
+                            ],
+                        },
+                        {"data": [{"price": {"value": 1}, "parentID": "later"}]},
+                    ],
+                },
+            }
+        }
+    ]
+
+
+def jsonpath_fields(document):
+    fields = {}
+    for field, query in QUERIES.items():
+        matches = [match.value for match in parse(query).find(document)]
+        fields[field] = matches[0] if matches else None
+    fields["children"] = [
+        match.value for match in parse("$..pdpGetLayout..children[*]").find(document)
+    ]
+    return fields
+
+
+def test_fields_match_jsonpath():
+    document = pdp_response()
+    assert collect_fields(document) == jsonpath_fields(document)
+
+
+def test_missing_fields_match_jsonpath():
+    document = {"data": {"pdpGetLayout": {"components": [{"content": []}]}}}
+    fields = collect_fields(document)
+    assert fields == jsonpath_fields(document)
+    assert fields["basic_info"] is None and fields["children"] == []
+
+
+def test_build_product_info():
+    info = build_product_info(collect_fields(pdp_response()))
+    assert info["product_id"] == "100"
+    assert info["price"] == 150000
+    assert info["parent_id"] == "99"
+    assert info["description"] == "Katun"
+    assert info["category"] == "kemeja"
+    assert info["category_tree"] == ["fashion", "atasan", "kemeja"]
+    assert info["children"] == [
+        {"productID": "101", "optionName": "Red, S"},
+        {"productID": "102", "optionName": "Red, M"},
+        {"productID": "103", "optionName": "Blue"},
+    ]
@@ -0,0 +1,130 @@
+import csv
+from functools import partial
+
+import pytest
+
+from processing.indexing import index2
+from processing.indexing.fake_product_search import FakeProductSearchClient
+
+WRITE_DATE = "20261018UTC06"
+FIRST_RUN = "20261018060000-aaaaaaaa"
+SECOND_RUN = "20261018063000-bbbbbbbb"
+
+
+def row(product_id, name="Shirt", image_id=None):
+    image_uri = f"gs://bucket/images/{product_id}.jpg"
+    return [
+        image_uri,
+        image_id or f"image-{product_id}",
+        "test-set",
+        product_id,
+        "apparel-v2",
+        name,
+        "category=tops,brand=Acme",
+        "",
+    ]
+
+
+def write_shard(indices_dir, run, kind, rows):
+    path = indices_dir / f"index_test-set_{WRITE_DATE}_{run}_{kind}-1.csv"
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+    return path.name
+
+
+@pytest.fixture
+def indices(tmp_path, monkeypatch):
+    indices_dir = tmp_path / "indices"
+    indices_dir.mkdir()
+    checkpoint_path = str(indices_dir / "import_checkpoint.json")
+    monkeypatch.setattr(index2, "ROOT_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        index2, "load_checkpoint", partial(index2.load_checkpoint, path=checkpoint_path)
+    )
+    monkeypatch.setattr(
+        index2, "save_checkpoint", partial(index2.save_checkpoint, path=checkpoint_path)
+    )
+    return indices_dir
+
+
+class CrashingClient(FakeProductSearchClient):
+    """Fails imports of shards whose uri contains `crash_on`."""
+
+    def __init__(self, crash_on):
+        super().__init__(polls=0)
+        self.crash_on = crash_on
+
+    def import_product_sets(self, parent, input_config):
+        if self.crash_on and self.crash_on in input_config.gcs_source.csv_file_uri:
+            raise RuntimeError("import crashed")
+        return super().import_product_sets(parent, input_config)
+
+
+def reference_image(client, product_id, image_id):
+    return client.reference_image_path(
+        index2.PROJECT_ID, index2.LOCATION, product_id, image_id
+    )
+
+
+def product(client, product_id):
+    return client.products[
+        client.product_path(index2.PROJECT_ID, index2.LOCATION, product_id)
+    ]
+
+
+def test_runs_apply_adds_then_updates_and_deletes(indices):
+    shards = [
+        write_shard(indices, FIRST_RUN, "add", [row("p1"), row("p2")]),
+        write_shard(indices, SECOND_RUN, "update", [row("p1", name="Blouse")]),
+        write_shard(indices, SECOND_RUN, "delete", [row("p2")[:4] + [""] * 4]),
+    ]
+    client = FakeProductSearchClient(polls=0)
+
+    index2.main(client)
+
+    assert set(client.reference_images) == {
+        reference_image(client, "p1", "image-p1")
+    }
+    assert product(client, "p1")["display_name"] == "Blouse"
+    assert set(index2.load_checkpoint()) == set(shards)
+
+
+def test_resume_after_crash_only_applies_unfinished_shards(indices):
+    added = write_shard(indices, FIRST_RUN, "add", [row("p1"), row("p2")])
+    updated = write_shard(indices, SECOND_RUN, "update", [row("p1", name="Blouse")])
+    client = CrashingClient(crash_on=updated)
+
+    index2.main(client)
+
+    assert set(index2.load_checkpoint()) == {added}
+    # The update deleted the old reference image before its import crashed
+    assert reference_image(client, "p1", "image-p1") not in client.reference_images
+
+    client.crash_on = None
+    client.calls.clear()
+    index2.main(client)
+
+    assert set(index2.load_checkpoint()) == {added, updated}
+    assert reference_image(client, "p1", "image-p1") in client.reference_images
+    assert product(client, "p1")["display_name"] == "Blouse"
+    imported = [uri for call, uri in client.calls if call == "import_product_sets"]
+    assert len(imported) == 1 and imported[0].endswith(updated)
+
+
+def test_shard_with_failed_rows_is_retried_and_blocks_later_runs(indices):
+    failing = write_shard(indices, FIRST_RUN, "add", [row("p1"), row("")])
+    later = write_shard(indices, SECOND_RUN, "delete", [row("p1")[:4] + [""] * 4])
+    client = FakeProductSearchClient(polls=0)
+
+    index2.main(client)
+
+    assert index2.load_checkpoint() == {}
+    assert reference_image(client, "p1", "image-p1") in client.reference_images
+    assert not any(later in str(call) for call in client.calls)
+
+    counts = index2.import_shards(
+        client, [str(indices / failing)], index2.load_checkpoint()
+    )
+    assert counts["import_failed"] == 1
+    assert counts["shards_failed"] == 1
+    assert index2.load_checkpoint() == {}
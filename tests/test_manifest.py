@@ -0,0 +1,117 @@
+from manifest import (
+    diff_products,
+    load_manifest,
+    record_delisted,
+    record_fetched,
+    save_manifest,
+)
+
+
+def listing(product_id, brand="acme", name="Shirt", price="Rp10.000"):
+    return {
+        "product_id": product_id,
+        "brand": brand,
+        "name": name,
+        "product_url": f"https://example.com/{brand}/{product_id}",
+        "price": {"text_idr": price},
+    }
+
+
+def test_new_products_are_changed():
+    changed, delisted = diff_products({}, [listing(1), listing(2)])
+    assert [product["product_id"] for product in changed] == [1, 2]
+    assert delisted == []
+
+
+def test_unchanged_listing_is_skipped_and_changes_refetched():
+    manifest = {}
+    for product in (listing(1), listing(2)):
+        record_fetched(manifest, product, {"details": product["product_id"]})
+
+    changed, delisted = diff_products(
+        manifest, [listing(1), listing(2, price="Rp12.000")]
+    )
+    assert [product["product_id"] for product in changed] == [2]
+    assert delisted == []
+
+
+def test_missing_products_are_delisted_only_for_crawled_brands():
+    manifest = {}
+    record_fetched(manifest, listing(1), {})
+    record_fetched(manifest, listing(2), {})
+    record_fetched(manifest, listing(3, brand="other"), {})
+
+    changed, delisted = diff_products(manifest, [listing(1)])
+    assert changed == []
+    assert delisted == ["2"]
+
+    record_delisted(manifest, delisted)
+    assert manifest["2"]["delisted_at"]
+    # Delisted products are not reported twice, and a relisting is refetched
+    assert diff_products(manifest, [listing(1)])[1] == []
+    changed, _ = diff_products(manifest, [listing(1), listing(2)])
+    assert [product["product_id"] for product in changed] == [2]
+
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    assert load_manifest(path) == {}
+
+    manifest = {}
+    record_fetched(manifest, listing(1), {"a": 1})
+    save_manifest(manifest, path)
+    assert load_manifest(path) == manifest
+
+
+def test_corrupt_manifest_starts_empty(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text("{not json")
+    assert load_manifest(str(path)) == {}
+
+
+def test_incomplete_brands_are_not_delisted():
+    manifest = {}
+    for product in (listing(1), listing(2), listing(3, brand="other")):
+        record_fetched(manifest, product, {})
+
+    changed, delisted = diff_products(
+        manifest, [listing(1), listing(3, brand="other")], {"acme"}
+    )
+    assert changed == []
+    assert delisted == []
+
+
+def listing_page(products, next_page=""):
+    """One saved ShopProducts page holding the listing fields of `products`."""
+    fields = ("product_id", "name", "product_url", "price")
+    shop_products = {
+        "data": [{key: product[key] for key in fields} for product in products],
+        "links": {"next": next_page},
+    }
+    return [{"data": {"GetShopProduct": shop_products}}]
+
+
+def test_truncated_listing_does_not_delist(tmp_path, monkeypatch):
+    import collect
+
+    monkeypatch.setattr(collect, "LISTING_DIR", str(tmp_path))
+    manifest = {}
+    for product in (listing(1), listing(2), listing(3, brand="other")):
+        record_fetched(manifest, product, {})
+
+    def save(brand, date, pages):
+        collect.save_json(pages, str(tmp_path / brand / f"listing_{date}.json"))
+
+    save("acme", "2026-10-17", [listing_page([listing(1), listing(2)])])
+    # Today's listing of acme stopped after its first page
+    save("acme", "2026-10-18", [listing_page([listing(1)], next_page="p2")])
+    save("other", "2026-10-18", [listing_page([])])
+
+    incomplete = set()
+    products = collect.load_listing_products(latest_only=True, incomplete=incomplete)
+    assert incomplete == {"acme"}
+    assert [product["product_id"] for product in products] == [1]
+
+    changed, delisted = diff_products(manifest, products, incomplete)
+    assert changed == []
+    assert delisted == []
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from pycocotools import mask as mask_api
+
+from utils import mask_utils
+
+HEIGHT, WIDTH = 60, 80
+
+
+def random_masks(seed, count=6, size=28):
+    rng = np.random.default_rng(seed)
+    masks = rng.uniform(0, 1, (count, size, size)).astype(np.float32)
+    # Boxes as (x, y, width, height), some overlapping or outside the image
+    boxes = np.stack(
+        [
+            rng.uniform(-20, WIDTH, count),
+            rng.uniform(-20, HEIGHT, count),
+            rng.uniform(1, 50, count),
+            rng.uniform(1, 50, count),
+        ],
+        axis=-1,
+    )
+    return masks, boxes
+
+
+def full_mask(crop, offset):
+    y_0, x_0 = offset
+    mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    mask[y_0 : y_0 + crop.shape[0], x_0 : x_0 + crop.shape[1]] = crop
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cropped_paste_matches_full_paste(seed):
+    masks, boxes = random_masks(seed)
+    pasted = mask_utils.paste_instance_masks(masks, boxes, HEIGHT, WIDTH)
+    crops = mask_utils.paste_instance_masks_cropped(masks, boxes, HEIGHT, WIDTH)
+
+    for expected, (crop, offset) in zip(pasted, crops):
+        np.testing.assert_array_equal(full_mask(crop, offset), expected)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_cropped_rle_matches_pycocotools(seed):
+    masks, boxes = random_masks(seed)
+    crops = mask_utils.paste_instance_masks_cropped(masks, boxes, HEIGHT, WIDTH)
+
+    for crop, offset in crops:
+        counts = mask_utils.encode_cropped_mask(crop, offset, HEIGHT, WIDTH)
+        encoded = mask_api.frPyObjects(
+            {"counts": counts, "size": [HEIGHT, WIDTH]}, HEIGHT, WIDTH
+        )
+        expected = mask_api.encode(np.asfortranarray(full_mask(crop, offset)))
+        assert encoded["counts"] == expected["counts"]
+
+
+@pytest.mark.parametrize(
+    "region",
+    [
+        (slice(0, HEIGHT), slice(0, WIDTH)),  # Whole image
+        (slice(HEIGHT - 5, HEIGHT), slice(WIDTH - 3, WIDTH)),  # Last pixel
+        (slice(0, HEIGHT), slice(10, 12)),  # Runs across columns
+        (slice(0, 0), slice(0, 0)),  # Empty
+    ],
+)
+def test_edge_crops_match_pycocotools(region):
+    full = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    full[region] = 1
+    rows, cols = region
+    crop = full[rows, cols]
+    counts = mask_utils.encode_cropped_mask(
+        crop, (rows.start, cols.start), HEIGHT, WIDTH
+    )
+    encoded = mask_api.frPyObjects(
+        {"counts": counts, "size": [HEIGHT, WIDTH]}, HEIGHT, WIDTH
+    )
+    assert encoded["counts"] == mask_api.encode(np.asfortranarray(full))["counts"]
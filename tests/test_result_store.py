@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+from processing.detection.result_store import DetectionStore, ShardWriter
+from processing.utils import utils
+
+
+def detection(count, height=480, width=640, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "boxes": rng.uniform(0, 400, (count, 4)).tolist(),
+        "scores": rng.uniform(0, 1, count).tolist(),
+        "classes": rng.integers(1, 20, count).tolist(),
+        "attributes": rng.uniform(0, 1, (count, 3)).tolist(),
+        "masks": [
+            {"size": [height, width], "counts": f"mask-{seed}-{i}".encode()}
+            for i in range(count)
+        ],
+        "height": height,
+        "width": width,
+    }
+
+
+def assert_round_trip(store, sha, result):
+    stored = store.get(sha)
+    for key in ("boxes", "scores", "classes", "attributes"):
+        expected = np.reshape(result[key], stored[key].shape)
+        np.testing.assert_allclose(stored[key], expected, rtol=1e-6)
+    assert (stored["height"], stored["width"]) == (result["height"], result["width"])
+    assert store.get_masks(sha) == result["masks"]
+
+
+def test_shards_round_trip(tmp_path):
+    flushed = []
+    writer = ShardWriter(str(tmp_path), shard_size=2, on_flush=flushed.extend)
+    results = {f"sha{i}": detection(i % 3, seed=i) for i in range(5)}
+    for sha, result in results.items():
+        writer.add(sha, f"{sha}.jpg", result)
+    assert len(flushed) == 4
+    writer.flush()
+    assert sorted(flushed) == sorted((sha, f"{sha}.jpg") for sha in results)
+
+    store = DetectionStore(str(tmp_path))
+    assert len(store.shards) == 3
+    assert len(store) == 5
+    for sha, result in results.items():
+        assert_round_trip(store, sha, result)
+    assert store.get("unknown") is None and store.get_masks("unknown") == []
+
+
+def test_later_shards_win(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=1)
+    writer.add("sha", "a.jpg", detection(1, seed=1))
+    writer.add("sha", "a.jpg", detection(2, seed=2))
+
+    assert_round_trip(DetectionStore(str(tmp_path)), "sha", detection(2, seed=2))
+
+
+def test_largest_box(tmp_path):
+    result = {
+        "boxes": [[0, 0, 10, 10], [0, 0, 50, 40], [0, 0, 100, 100]],
+        "scores": [0.9, 0.8, 0.7],
+        "classes": [1, 1, 2],
+        "height": 100,
+        "width": 100,
+    }
+    ShardWriter(str(tmp_path), shard_size=1).add("sha", "a.jpg", result)
+
+    store = DetectionStore(str(tmp_path))
+    assert store.largest_box("sha", 1) == (0, 0, 40, 50)
+    assert store.largest_box("sha", 3) is None
+
+
+def test_compact_merges_shards_and_records_removed_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ROOT_DIR", str(tmp_path))
+    writer = ShardWriter(str(tmp_path), shard_size=1)
+    results = {f"sha{i}": detection(2, seed=i) for i in range(3)}
+    for sha, result in results.items():
+        writer.add(sha, f"{sha}.jpg", result)
+    store = DetectionStore(str(tmp_path))
+    old_shards = [shard["dir"] for shard in store.shards]
+
+    store.compact(max_shards=2)
+
+    assert len(store.shards) == 1
+    assert not any(os.path.exists(shard_dir) for shard_dir in old_shards)
+    for sha, result in results.items():
+        assert_round_trip(store, sha, result)
+    removed = utils.removed_files(str(tmp_path))
+    assert {os.path.dirname(path) for path in removed} == {
+        os.path.relpath(shard_dir, tmp_path) for shard_dir in old_shards
+    }
@@ -0,0 +1,72 @@
+import json
+
+import rate_limit
+from rate_limit import RetryQueue
+
+
+def queue_lines(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_due(queue):
+    for entry in queue.load().values():
+        entry["next_attempt"] = 0
+
+
+def test_failed_job_is_queued_once_with_attempts_carried(tmp_path):
+    queue = RetryQueue(str(tmp_path / "retry.jsonl"))
+    queue.push("details", {"url": "a"})
+    queue.push("details", {"url": "a"})
+
+    jobs = list(queue.load().values())
+    assert len(jobs) == 1
+    assert jobs[0]["attempts"] == 1
+
+
+def test_jobs_stay_queued_until_completed(tmp_path):
+    path = str(tmp_path / "retry.jsonl")
+    queue = RetryQueue(path)
+    queue.push("details", {"url": "a"})
+    queue.push("listing", {"brand": "b"})
+    make_due(queue)
+
+    assert len(queue.due()) == 2
+    # A crash mid-retry loses nothing
+    assert len(RetryQueue(path).load()) == 2
+
+    queue.complete("details", {"url": "a"})
+    reloaded = RetryQueue(path)
+    assert [job["kind"] for job in reloaded.load().values()] == ["listing"]
+
+
+def test_backoff_keeps_jobs_from_being_due(tmp_path):
+    queue = RetryQueue(str(tmp_path / "retry.jsonl"))
+    queue.push("details", {"url": "a"})
+    assert queue.due() == []
+
+
+def test_gives_up_after_max_attempts(tmp_path, monkeypatch):
+    monkeypatch.setattr(rate_limit, "RETRY_QUEUE_MAX_ATTEMPTS", 2)
+    path = str(tmp_path / "retry.jsonl")
+    queue = RetryQueue(path)
+    for _ in range(3):
+        queue.push("details", {"url": "a"})
+
+    assert queue.load() == {}
+    assert RetryQueue(path).load() == {}
+
+
+def test_load_compacts_superseded_lines(tmp_path):
+    path = str(tmp_path / "retry.jsonl")
+    queue = RetryQueue(path)
+    queue.push("details", {"url": "a"})
+    queue.push("details", {"url": "a"})
+    queue.push("details", {"url": "b"})
+    queue.complete("details", {"url": "b"})
+    assert len(queue_lines(path)) == 4
+
+    RetryQueue(path).load()
+    lines = queue_lines(path)
+    assert len(lines) == 1
+    assert lines[0]["payload"] == {"url": "a"} and lines[0]["attempts"] == 1
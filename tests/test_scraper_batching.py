@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import async_scraper
+import tokped_scraper
+from tokped_scraper import fill_missing, listing_window, missing_items
+
+PRODUCT_URLS = [
+    "https://www.tokopedia.com/brand/product-a",
+    "not a product url",
+    "https://www.tokopedia.com/brand/product-b",
+]
+OPERATION = {"data": {"pdpGetLayout": {"name": "A"}}}
+# The batch returns the first product and fails the second
+BATCH_RESPONSE = [OPERATION, {"errors": ["boom"], "data": None}]
+EXPECTED = [[OPERATION], None, ("single", PRODUCT_URLS[2])]
+
+
+class FakeResponse:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return BATCH_RESPONSE
+
+
+class FakeSession:
+    def post(self, *args, **kwargs):
+        return FakeResponse()
+
+
+def test_fill_missing_keeps_batched_results_in_order():
+    results = ["a", None, "c", None]
+
+    assert missing_items([1, 2, 3, 4], results) == [2, 4]
+    assert fill_missing(results, ["b", "d"]) == ["a", "b", "c", "d"]
+
+
+def test_listing_window_batches_pages(monkeypatch):
+    monkeypatch.setattr(tokped_scraper, "LISTING_BATCH_SIZE", 2)
+
+    assert listing_window(2, 6, concurrency=4) == ([[2, 3], [4, 5], [6]], 7)
+    # Past the estimated page count pages are requested speculatively
+    assert listing_window(7, 6, concurrency=2) == ([[7, 8], [9, 10]], 11)
+
+
+def test_sync_details_batch(monkeypatch):
+    monkeypatch.setattr(tokped_scraper, "SESSION", FakeSession())
+    monkeypatch.setattr(tokped_scraper, "throttle", lambda uri: None)
+    monkeypatch.setattr(tokped_scraper, "get_item_details", lambda url: ("single", url))
+
+    assert tokped_scraper.get_item_details_batch(PRODUCT_URLS) == EXPECTED
+
+
+def test_async_details_batch(monkeypatch):
+    async def post_json(session, uri, headers, data):
+        return BATCH_RESPONSE
+
+    async def get_item_details(session, url):
+        return ("single", url)
+
+    monkeypatch.setattr(async_scraper, "post_json", post_json)
+    monkeypatch.setattr(async_scraper, "get_item_details", get_item_details)
+
+    details = asyncio.run(async_scraper.get_item_details_batch(None, PRODUCT_URLS))
+    assert details == EXPECTED
+
+
+@pytest.mark.parametrize("product_urls", [["not a product url"], []])
+def test_details_batch_without_valid_products(product_urls):
+    details = tokped_scraper.get_item_details_batch(product_urls)
+    assert details == [None] * len(product_urls)
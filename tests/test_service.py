@@ -0,0 +1,114 @@
+import io
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from service import DetectionHandler, DynamicBatcher
+
+IMAGE_SIZE = 4
+
+
+class RecordingRunner:
+    """Echoes each image's first pixel, failing batches holding a 255 pixel."""
+
+    model_path = "memory"
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, images):
+        self.batches.append(images.shape[0])
+        if (images[:, 0, 0, 0] == 255).any():
+            raise RuntimeError("bad batch")
+        return {"value": images[:, 0, 0, 0].astype(np.int64)}
+
+
+def image(value):
+    return np.full((IMAGE_SIZE, IMAGE_SIZE, 3), value, dtype=np.uint8)
+
+
+@pytest.fixture
+def batcher():
+    return DynamicBatcher(
+        RecordingRunner(), batch_size=4, image_size=IMAGE_SIZE, max_latency=0.05
+    )
+
+
+def test_batches_are_padded_and_results_routed(batcher):
+    futures = [batcher.submit(image(value)) for value in range(6)]
+    assert [int(future.result(5)["value"]) for future in futures] == list(range(6))
+    assert set(batcher.runner.batches) == {4}
+
+
+def test_wrong_shape_is_rejected_at_submit(batcher):
+    with pytest.raises(ValueError):
+        batcher.submit(np.zeros((IMAGE_SIZE + 1, IMAGE_SIZE, 3), dtype=np.uint8))
+
+
+def test_failed_batch_fails_only_its_requests(batcher):
+    with pytest.raises(RuntimeError):
+        batcher.submit(image(255)).result(5)
+    # The batching thread survives and serves later requests
+    assert int(batcher.submit(image(3)).result(5)["value"]) == 3
+
+
+@pytest.fixture
+def server(batcher):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DetectionHandler)
+    server.batcher = batcher
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post_infer(server, images):
+    buffer = io.BytesIO()
+    np.save(buffer, images)
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_port}/infer",
+        data=buffer.getvalue(),
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return np.load(io.BytesIO(response.read()))
+
+
+def test_infer_returns_one_output_per_image(server):
+    outputs = post_infer(server, np.stack([image(1), image(2), image(3)]))
+    assert outputs["value"].tolist() == [1, 2, 3]
+
+
+def test_infer_rejects_malformed_batches(server):
+    for images in (
+        np.zeros((2, IMAGE_SIZE, IMAGE_SIZE - 1, 3), dtype=np.uint8),
+        np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8),
+    ):
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post_infer(server, images)
+        assert error.value.code == 400
+    assert server.batcher.runner.batches == []
+
+
+def test_detect_sends_only_real_images_to_padding_runners():
+    from detect import DETECT_BATCH_SIZE, DETECT_IMAGE_SIZE, infer_batch
+
+    padded = np.zeros((DETECT_IMAGE_SIZE, DETECT_IMAGE_SIZE, 3), dtype=np.uint8)
+    batch = [(["a.jpg"], (padded, (10, 10), 1.0))] * 3
+    shapes = []
+
+    class Runner:
+        pads_batches = False
+
+        def __call__(self, images):
+            shapes.append(len(images))
+            return {}
+
+    infer_batch(Runner(), batch)
+    Runner.pads_batches = True
+    infer_batch(Runner(), batch)
+    assert shapes == [DETECT_BATCH_SIZE, 3]
@@ -0,0 +1,52 @@
+import os
+
+from processing.utils import utils
+from processing.utils.utils import (
+    delete_removed_from_gcs,
+    delete_removed_locally,
+    record_removed,
+)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.deleted = []
+
+    def blob(self, name):
+        bucket = self
+
+        class Blob:
+            def delete(self):
+                bucket.deleted.append(name)
+
+        return Blob()
+
+
+def compact(root, monkeypatch):
+    """Tombstones one catalog shard the way compaction does."""
+    monkeypatch.setattr(utils, "ROOT_DIR", str(root))
+    shard = root / "catalog" / "2024" / "shard_0.json"
+    shard.parent.mkdir(parents=True)
+    shard.write_text("{}")
+    record_removed(str(root / "catalog"), "run_1", [str(shard)])
+    return shard
+
+
+def test_delete_removed_locally(tmp_path, monkeypatch):
+    shard = compact(tmp_path, monkeypatch)
+
+    delete_removed_locally("catalog")
+
+    assert not shard.exists()
+    assert not shard.parent.exists()
+    assert os.listdir(tmp_path / "catalog" / "_removed") == ["run_1.json"]
+
+
+def test_delete_removed_from_gcs_names_blobs_like_uploads(tmp_path, monkeypatch):
+    shard = compact(tmp_path, monkeypatch)
+    bucket = FakeBucket()
+
+    delete_removed_from_gcs(bucket, "catalog")
+
+    assert bucket.deleted == [shard.as_posix()]
+    assert shard.exists()
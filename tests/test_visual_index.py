@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+
+from processing.indexing import visual_index
+from processing.indexing.visual_index import (
+    CategoryIndex,
+    diff_references,
+    update_partition,
+)
+
+DIM = 8
+
+
+def reference(id_, box=None, name="Shirt"):
+    return {
+        "id": id_,
+        "product_id": f"p{id_}",
+        "product_name": name,
+        "brand": "Acme",
+        "category": "tops",
+        "image_path": f"details/{id_}.jpg",
+        "image_key": f"key{id_}",
+        "box": box,
+    }
+
+
+def vector(id_, box=None):
+    """Unit vector determined by a reference's id and box, like a real embedding."""
+    seed = id_ * 1000 + int(sum(box or []))
+    v = np.random.default_rng(seed).normal(size=DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """Fakes embed_crops, recording the image paths embedded."""
+    calls = []
+
+    def embed_crops(crops):
+        calls.extend(path for path, _ in crops)
+        ids = [int(path.rsplit("/", 1)[1].split(".")[0]) for path, _ in crops]
+        vectors = np.stack([vector(id_, box) for id_, (_, box) in zip(ids, crops)])
+        return vectors, list(range(len(crops)))
+
+    monkeypatch.setattr(visual_index, "embed_crops", embed_crops)
+    return calls
+
+
+def current(*references):
+    return {reference["id"]: reference for reference in references}
+
+
+def test_diff_references():
+    indexed = current(reference(1), reference(2), reference(3), reference(4))
+    to_embed, to_update, to_delete = diff_references(
+        current(
+            reference(1),
+            reference(2, box=[0, 0, 5, 5]),
+            reference(3, name="Blouse"),
+            reference(5),
+        ),
+        indexed,
+    )
+    assert [r["id"] for r in to_embed] == [2, 5]
+    assert [r["id"] for r in to_update] == [3]
+    assert to_delete == [4]
+
+
+def test_update_embeds_only_changes(tmp_path, embedded):
+    partition = CategoryIndex(str(tmp_path))
+    assert update_partition(partition, current(reference(1), reference(2)))
+    assert len(embedded) == 2
+
+    embedded.clear()
+    assert not update_partition(partition, current(reference(1), reference(2)))
+    assert update_partition(
+        partition, current(reference(1, name="Blouse"), reference(3))
+    )
+    assert [path.rsplit("/", 1)[1] for path in embedded] == ["3.jpg"]
+
+    reloaded = CategoryIndex(str(tmp_path))
+    assert sorted(reloaded.references) == [1, 3]
+    assert reloaded.references[1]["product_name"] == "Blouse"
+    assert len(reloaded.tombstones) == 1
+
+
+def test_search_skips_tombstones_and_survives_compaction(tmp_path, embedded):
+    partition = CategoryIndex(str(tmp_path))
+    update_partition(partition, current(reference(1), reference(2), reference(3)))
+    update_partition(
+        partition, current(reference(1), reference(2, box=[0, 0, 9, 9]))
+    )
+    assert len(partition.tombstones) == 2
+
+    def top_hit(id_, box=None):
+        return partition.search(vector(id_, box)[None], k=1)[0][0]
+
+    assert top_hit(2, [0, 0, 9, 9])["id"] == 2
+    results = partition.search(vector(3)[None], k=5)[0]
+    assert sorted(result["id"] for result in results) == [1, 2]
+
+    partition.compact()
+    assert partition.tombstones == set()
+    assert len(partition.slot_ids) == 2
+    assert top_hit(1)["id"] == 1
+    assert top_hit(2, [0, 0, 9, 9])["score"] == pytest.approx(1, abs=1e-5)
+    assert sorted(CategoryIndex(str(tmp_path)).references) == [1, 2]
+
+
+def test_encoder_change_rebuilds_partition(tmp_path, embedded, monkeypatch):
+    partition = CategoryIndex(str(tmp_path))
+    update_partition(partition, current(reference(1), reference(2)))
+    assert CategoryIndex(str(tmp_path)).encoder == visual_index.encoder_config()
+
+    monkeypatch.setattr(visual_index, "EMBED_MODEL", "OtherModel")
+    index = visual_index.VisualIndex(str(tmp_path.parent))
+    index.partitions[0] = CategoryIndex(str(tmp_path))
+    # Stale vectors are never searched with the new encoder
+    assert index.partition(0) is None
+
+    embedded.clear()
+    partition = CategoryIndex(str(tmp_path))
+    assert update_partition(partition, current(reference(1), reference(2)))
+    assert len(embedded) == 2
+    assert partition.tombstones == set()
+    reloaded = CategoryIndex(str(tmp_path))
+    assert reloaded.encoder["model"] == "OtherModel"
+    assert sorted(reloaded.references) == [1, 2]
+
+
+def test_search_image_tells_service_failure_from_no_detections(tmp_path, monkeypatch):
+    index = visual_index.VisualIndex(str(tmp_path))
+    monkeypatch.setattr(visual_index, "detect_image", lambda image_bytes: None)
+    assert visual_index.search_image(b"image", index) is None
+
+    no_detections = {"boxes": [], "classes": [], "scores": []}
+    monkeypatch.setattr(visual_index, "detect_image", lambda image_bytes: no_detections)
+    monkeypatch.setattr(visual_index, "load_label_map", lambda: {})
+    assert visual_index.search_image(b"image", index) == []